@@ -5,10 +5,14 @@ A unified CMS system for ESP32 devices with over-the-air update capabilities.
 
 Initializes database, creates sample data, and starts the server
 Single entry point for the entire PersonalCMS system
+
+    python START_PERSONALCMS_OTA.py                 # Development server
+    python START_PERSONALCMS_OTA.py --production    # gunicorn (Linux/macOS) or waitress (Windows)
 """
 
 import os
 import sys
+import argparse
 import subprocess
 from datetime import datetime, timezone
 
@@ -144,8 +148,55 @@ def check_dependencies():
         print("   ✅ All required packages are available")
         return True
 
+def run_production(app, host, port, workers, threads):
+    """
+    Serve with a production WSGI server
+    
+    gunicorn (preforking, Linux/macOS) replaces this process; waitress (any
+    platform, one process) runs in it. Falls back to the threaded development
+    server if neither is installed.
+    """
+    try:
+        import gunicorn  # noqa: F401
+        gunicorn_available = os.name != 'nt'
+    except ImportError:
+        gunicorn_available = False
+    
+    if gunicorn_available:
+        print(f"   🦄 gunicorn: {workers} workers x {threads} threads")
+        os.environ['PERSONALCMS_BIND'] = f"{host}:{port}"
+        os.environ['PERSONALCMS_WORKERS'] = str(workers)
+        os.environ['PERSONALCMS_THREADS'] = str(threads)
+        sys.stdout.flush()
+        os.execvp(sys.executable, [sys.executable, '-m', 'gunicorn', '-c', 'gunicorn.conf.py', 'wsgi:app'])
+    
+    try:
+        from waitress import serve
+    except ImportError:
+        print("   ⚠️  Neither gunicorn nor waitress is installed (pip install gunicorn / waitress)")
+        print("      Falling back to the threaded development server")
+        app.run(host=host, port=port, debug=False, threaded=True)
+        return
+    
+    # One process: the thread pool is the whole concurrency budget
+    print(f"   🍽️  waitress: {workers * threads} threads")
+    serve(app, host=host, port=port, threads=workers * threads,
+          connection_limit=1000, channel_timeout=120, cleanup_interval=30)
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Start PersonalCMS with OTA support')
+    parser.add_argument('--production', action='store_true',
+                        help='Serve with gunicorn or waitress instead of the development server')
+    parser.add_argument('--host', default='0.0.0.0')
+    parser.add_argument('--port', type=int, default=5000)
+    parser.add_argument('--workers', type=int, default=min((os.cpu_count() or 1) * 2 + 1, 8),
+                        help='Worker processes (gunicorn)')
+    parser.add_argument('--threads', type=int, default=8, help='Threads per worker')
+    return parser.parse_args(argv)
+
 def main():
     """Main application entry point"""
+    args = parse_args()
     print("\n" + "=" * 80)
     print("🚀 PersonalCMS with OTA Support - Starting Up")
     print("=" * 80)
@@ -161,7 +212,8 @@ def main():
     
     # Import after ensuring dependencies are available
     try:
-        from unified_cms import app, db
+        from unified_cms import create_app
+        app = create_app()
     except ImportError as e:
         print(f"\n❌ Failed to import unified_cms: {e}")
         print("   Make sure unified_cms.py is in the current directory")
@@ -217,12 +269,15 @@ def main():
     print(f"   4. Device will auto-update thereafter")
     
     print("\n" + "=" * 80)
-    print("✅ PersonalCMS Ready - Listening on http://0.0.0.0:5000")
+    print(f"✅ PersonalCMS Ready - Listening on http://{args.host}:{args.port}")
     print("=" * 80)
     
     # Start the Flask app
     try:
-        app.run(host='0.0.0.0', port=5000, debug=False)  # Set debug=False for production
+        if args.production:
+            run_production(app, args.host, args.port, args.workers, args.threads)
+        else:
+            app.run(host=args.host, port=args.port, debug=False)
     except KeyboardInterrupt:
         print("\n\n👋 PersonalCMS shutting down gracefully...")
     except Exception as e:
@@ -0,0 +1,167 @@
+"""
+Atomic Frame Files
+Frames are written to a temp file next to their destination and renamed over it,
+so a device downloading a dashboard while it is re-rendered gets either the old
+frame or the new one, never a torn mix. Files with the same bytes share one
+content-addressed blob through hardlinks, so a dashboard's current and fallback
+copies are encoded and written once.
+"""
+
+import os
+import time
+import errno
+import hashlib
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger(__name__)
+
+FSYNC_NONE = 'none'  # Rely on the OS to write back; a crash may leave an empty frame
+FSYNC_FILE = 'file'  # Flush the data before the rename
+FSYNC_FULL = 'full'  # Also flush the directory, so the rename itself survives a crash
+
+BLOB_DIR = '.blobs'
+BLOB_MIN_AGE_SECONDS = 60  # Unlinked blobs younger than this may be about to be linked
+_last_collect = {}  # blob_dir -> when this process last swept it
+
+
+def _fsync_dir(directory):
+    try:
+        fd = os.open(directory, os.O_RDONLY)
+    except OSError:
+        return  # Windows can't open directories
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+
+def _replace(src, dst):
+    # Windows refuses to replace a file that is open for reading; it is usually closed within moments
+    for attempt in range(5):
+        try:
+            os.replace(src, dst)
+            return
+        except PermissionError:
+            if os.name != 'nt' or attempt == 4:
+                raise
+            time.sleep(0.05 * (attempt + 1))
+
+
+def atomic_write(path, data, fsync=FSYNC_FILE):
+    """
+    Write bytes to path so readers see the old or the new contents, nothing in between
+
+    Args:
+        path: Destination file
+        data: Complete file contents
+        fsync: FSYNC_NONE, FSYNC_FILE or FSYNC_FULL
+    """
+    directory = os.path.dirname(os.path.abspath(path))
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=f".{os.path.basename(path)}.", suffix='.tmp')
+    try:
+        with os.fdopen(fd, 'wb') as tmp:
+            tmp.write(data)
+            if fsync != FSYNC_NONE:
+                tmp.flush()
+                os.fsync(tmp.fileno())
+        _replace(tmp_path, path)
+    except BaseException:
+        _remove_quietly(tmp_path)
+        raise
+    if fsync == FSYNC_FULL:
+        _fsync_dir(directory)
+
+
+def _remove_quietly(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+def publish_blob(data, paths, blob_dir, suffix='', fsync=FSYNC_FILE):
+    """
+    Store data once under its SHA-256 and hardlink it into place at every path
+
+    Each path is switched over atomically. Where hardlinks aren't supported
+    (e.g. FAT volumes) each path gets its own atomic copy instead.
+
+    Returns:
+        str: Hex SHA-256 of the data
+    """
+    digest = hashlib.sha256(data).hexdigest()
+    os.makedirs(blob_dir, exist_ok=True)
+    blob_path = os.path.join(blob_dir, digest + suffix)
+    try:
+        os.utime(blob_path)  # Recently used blobs are never collected
+    except FileNotFoundError:
+        atomic_write(blob_path, data, fsync)
+
+    for path in paths:
+        if _same_file(blob_path, path):
+            continue  # Unchanged frame: nothing to write
+        tmp_path = os.path.join(os.path.dirname(os.path.abspath(path)), f".{os.path.basename(path)}.{os.getpid()}.{threading.get_ident()}.link")
+        _remove_quietly(tmp_path)
+        try:
+            os.link(blob_path, tmp_path)
+        except FileNotFoundError:
+            # Collected by another process between the check and the link
+            atomic_write(blob_path, data, fsync)
+            os.link(blob_path, tmp_path)
+        except OSError as e:
+            if e.errno not in (errno.EXDEV, errno.EPERM, errno.EMLINK, errno.ENOTSUP, errno.EACCES):
+                raise
+            atomic_write(path, data, fsync)
+            continue
+        try:
+            _replace(tmp_path, path)
+        except BaseException:
+            _remove_quietly(tmp_path)
+            raise
+
+    if fsync == FSYNC_FULL:
+        for directory in {os.path.dirname(os.path.abspath(path)) for path in paths}:
+            _fsync_dir(directory)
+    collect_blobs(blob_dir)
+    return digest
+
+
+def _same_file(a, b):
+    try:
+        return os.path.samefile(a, b)
+    except OSError:
+        return False
+
+
+def collect_blobs(blob_dir, min_age=BLOB_MIN_AGE_SECONDS, interval=60, now=None):
+    """
+    Delete blobs no file links to any more
+
+    Runs at most once per interval per process.
+
+    Returns:
+        int: Blobs removed
+    """
+    now = now or time.time()
+    if now - _last_collect.get(blob_dir, 0) < interval:
+        return 0
+    _last_collect[blob_dir] = now
+    removed = 0
+    try:
+        entries = list(os.scandir(blob_dir))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        try:
+            stat = os.stat(entry.path)  # DirEntry.stat() has no link count on Windows
+        except OSError:
+            continue
+        if entry.name.startswith('.') or stat.st_nlink > 1 or now - stat.st_mtime < min_age:
+            continue
+        _remove_quietly(entry.path)
+        removed += 1
+    if removed:
+        logger.info(f"Removed {removed} unreferenced frame blobs from {blob_dir}")
+    return removed
@@ -0,0 +1,213 @@
+"""
+Content Change Notification
+Per-device content version numbers and long-poll waiters, so devices can hold one
+request open until their content changes instead of re-fetching it on a timer
+"""
+
+import math
+import time
+import threading
+import logging
+from sqlalchemy import select, update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, ContentVersion
+
+logger = logging.getLogger(__name__)
+
+ALL_DEVICES = '*'  # Counter bumped when content shared by every device changes
+
+
+class ContentVersionBoard:
+    """
+    Content versions and the requests waiting on them
+
+    A device's version is its own counter, plus the fleet-wide counter, plus the number
+    of elapsed content refresh periods (so rotating jokes/news still reach devices).
+    It is opaque to devices: they only compare it for equality. Counters live in the
+    content_versions table so every worker sees a bump; each process polls for rows
+    changed since its last look and wakes its local waiters.
+    """
+
+    def __init__(self, refresh_interval=900, poll_interval=1.0):
+        self.refresh_interval = refresh_interval
+        self.poll_interval = poll_interval
+        self._counters = {}  # device_id (or ALL_DEVICES) -> last counter seen
+        self._waiters = {}  # device_id -> set of wake-up callables
+        self._last_poll = time.time()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def refresh_epoch(self, now=None):
+        if not self.refresh_interval:
+            return 0
+        return int((now if now is not None else time.time()) // self.refresh_interval)
+
+    def seconds_to_refresh(self, now=None):
+        """Seconds until the next refresh period starts (None if periodic refresh is off)"""
+        if not self.refresh_interval:
+            return None
+        now = now if now is not None else time.time()
+        return self.refresh_interval - now % self.refresh_interval
+
+    def bump(self, device_ids, reason=''):
+        """
+        Advance the content version of devices, waking anything waiting on them
+
+        Args:
+            device_ids: A device_id, an iterable of them, or ALL_DEVICES
+            reason: What changed (logged)
+        """
+        ids = sorted({device_ids} if isinstance(device_ids, str) else set(device_ids))
+        if not ids:
+            return
+        try:
+            self._increment(ids)
+            db.session.commit()
+        except IntegrityError:
+            # Another worker created one of the missing rows first
+            db.session.rollback()
+            self._increment(ids)
+            db.session.commit()
+        self.remember(db.session.execute(self.counters_query(*ids)).all(), notify=True)
+        logger.info(f"Content version bumped for {', '.join(ids)}{f' ({reason})' if reason else ''}")
+
+    def _increment(self, ids):
+        now = time.time()
+        t = ContentVersion
+        db.session.execute(update(t).where(t.device_id.in_(ids)).values(version=t.version + 1, changed_at=now))
+        existing = set(db.session.scalars(select(t.device_id).where(t.device_id.in_(ids))))
+        db.session.add_all([ContentVersion(device_id=device_id, version=1, changed_at=now)
+                            for device_id in ids if device_id not in existing])
+        db.session.flush()
+
+    def forget(self, device_id):
+        """Drop a removed device's counter (caller commits)"""
+        db.session.execute(ContentVersion.__table__.delete().where(ContentVersion.device_id == device_id))
+        with self._lock:
+            self._counters.pop(device_id, None)
+
+    @staticmethod
+    def counters_query(*device_ids):
+        """Statement selecting (device_id, version) rows; usable from sync and async sessions"""
+        return select(ContentVersion.device_id, ContentVersion.version).where(
+            ContentVersion.device_id.in_(device_ids)
+        )
+
+    def remember(self, rows, notify=False):
+        """
+        Record counters read from the database
+
+        Args:
+            rows: (device_id, version) pairs
+            notify: Wake waiters of counters that advanced
+        """
+        wake = []
+        with self._lock:
+            for device_id, version in rows:
+                if version <= self._counters.get(device_id, 0):
+                    continue
+                self._counters[device_id] = version
+                if not notify:
+                    continue
+                if device_id == ALL_DEVICES:
+                    for callbacks in self._waiters.values():
+                        wake.extend(callbacks)
+                else:
+                    wake.extend(self._waiters.get(device_id, ()))
+        for callback in wake:
+            callback()
+
+    def version(self, device_id, now=None):
+        """A device's content version from the counters seen so far"""
+        with self._lock:
+            counters = self._counters.get(device_id, 0) + self._counters.get(ALL_DEVICES, 0)
+        return counters + self.refresh_epoch(now)
+
+    def current_version(self, device_id):
+        """A device's content version, read from the database"""
+        self.remember(db.session.execute(self.counters_query(device_id, ALL_DEVICES)).all(), notify=True)
+        return self.version(device_id)
+
+    def watch(self, device_id, callback):
+        """
+        Call `callback` (from any thread) when the device's counters advance
+
+        Returns:
+            callable: Stops watching
+        """
+        with self._lock:
+            self._waiters.setdefault(device_id, set()).add(callback)
+
+        def unwatch():
+            with self._lock:
+                callbacks = self._waiters.get(device_id)
+                if callbacks is not None:
+                    callbacks.discard(callback)
+                    if not callbacks:
+                        del self._waiters[device_id]
+        return unwatch
+
+    def wait_timeout(self, timeout, now=None):
+        """How long a long-poll may wait: its timeout, cut at the next refresh period"""
+        until_refresh = self.seconds_to_refresh(now)
+        if until_refresh is None:
+            return timeout
+        return min(timeout, math.ceil(until_refresh))
+
+    def wait(self, device_id, since, timeout):
+        """
+        Block until the device's version differs from `since` or the timeout expires
+
+        Returns:
+            int: The device's version
+        """
+        changed = threading.Event()
+        unwatch = self.watch(device_id, changed.set)
+        try:
+            version = self.current_version(device_id)
+            if version != since:
+                return version
+            db.session.close()  # Don't hold a pooled connection while waiting
+            changed.wait(self.wait_timeout(timeout))
+            return self.version(device_id)
+        finally:
+            unwatch()
+
+    def poll(self, now=None):
+        """Pick up bumps made by other workers (only while something is waiting)"""
+        now = now if now is not None else time.time()
+        since, self._last_poll = self._last_poll, now
+        with self._lock:
+            if not self._waiters:
+                return 0
+        # Small overlap so commits racing the previous poll are not missed
+        rows = db.session.execute(
+            select(ContentVersion.device_id, ContentVersion.version).where(
+                ContentVersion.changed_at >= since - 2 * self.poll_interval
+            )
+        ).all()
+        self.remember(rows, notify=True)
+        return len(rows)
+
+    def start(self, app):
+        """Start the background change poller"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            while not self._stop.wait(self.poll_interval):
+                with app.app_context():
+                    try:
+                        self.poll()
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.error(f"Content version poll failed: {e}")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='content-versions', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
@@ -0,0 +1,284 @@
+"""
+Device API Handlers
+The request handling shared by the Flask app and the async device API
+(device_api_asgi.py): which Device columns a request sets, what the services are
+told and what goes back to the device. Each tier keeps only its own database
+access, request parsing and response objects, so the two can't drift apart.
+"""
+
+import json
+from datetime import datetime
+
+from models import Device
+
+REGISTRATION_REQUIRED = ('device_id', 'device_name', 'occupation', 'device_type')
+HEARTBEAT_FIELDS = {'version': 'firmware_version', 'uptime': 'uptime_seconds',
+                    'free_heap': 'free_heap', 'wifi_rssi': 'wifi_rssi'}
+SENSOR_FIELDS = ('temperature', 'humidity', 'motion_detected', 'sleep_mode')
+
+
+def registration_fields(data):
+    """
+    Device columns a registration sets
+
+    Returns:
+        dict or None: Column values, or None when a required field is missing
+    """
+    if not all(data.get(name) for name in REGISTRATION_REQUIRED):
+        return None
+    return dict(
+        device_name=data['device_name'],
+        occupation=data['occupation'],
+        device_type=data['device_type'],
+        wifi_ssid=data.get('wifi_ssid'),
+        preferences=json.dumps(data.get('preferences', {})),
+        nickname=data.get('nickname'),
+        last_seen=datetime.utcnow(),
+        is_connected=True,
+        is_active=True
+    )
+
+
+def apply_registration(device, device_id, fields):
+    """
+    Update a registered device, or create it
+
+    Returns:
+        Device: The new device (to be added to the session), or None if it was updated
+    """
+    if device is None:
+        return Device(device_id=device_id, **fields)
+    for name, value in fields.items():
+        setattr(device, name, value)
+    return None
+
+
+def registration_response(device_id, poll_seconds, ingest_key=None, ingest_port=None):
+    """Full and compact register responses, with the UDP ingest key when one was issued"""
+    payload = {'success': True, 'message': 'Device registered successfully', 'device_id': device_id,
+               'next_poll_seconds': poll_seconds}
+    compact = {'success': True, 'next_poll_seconds': poll_seconds}
+    if ingest_key:
+        payload['ingest_key'] = compact['ingest_key'] = ingest_key
+        payload['ingest_port'] = compact['ingest_port'] = ingest_port
+    return payload, compact
+
+
+def heartbeat_device(device_id, data):
+    """Device created by the first heartbeat of an unregistered OTA-enabled device"""
+    return Device(
+        device_id=device_id,
+        device_name=data.get('device_name', device_id),
+        occupation=data.get('occupation', 'Device User'),  # Provide default occupation
+        device_type=data.get('device_type', 'ESP32_OTA'),
+        last_seen=datetime.utcnow(),
+        is_connected=True,
+        is_active=True
+    )
+
+
+def apply_heartbeat(device, data):
+    """Copy heartbeat data onto the device; last_seen goes through the batched presence writer"""
+    device.is_connected = True
+    for key, column in HEARTBEAT_FIELDS.items():
+        if key in data:
+            setattr(device, column, data[key])
+
+
+def observe_heartbeat(device, data, rollout_guard, fleet_telemetry):
+    """Feed a heartbeat to the rollout guard and fleet telemetry"""
+    rollout_guard.observe(device.device_id, device.firmware_version,
+                          free_heap=data.get('free_heap'), uptime=data.get('uptime'))
+    fleet_telemetry.record(
+        device.firmware_version,
+        device.device_type,
+        free_heap=data.get('free_heap'),
+        wifi_rssi=data.get('wifi_rssi'),
+        uptime=data.get('uptime')
+    )
+
+
+def heartbeat_response(poll_seconds):
+    """Full and compact heartbeat responses"""
+    return (
+        {'status': 'heartbeat_received', 'timestamp': datetime.utcnow().isoformat(), 'next_poll_seconds': poll_seconds},
+        {'status': 'heartbeat_received', 'next_poll_seconds': poll_seconds}
+    )
+
+
+def apply_sensor_data(device, data):
+    """
+    Copy a sensor reading onto the device
+
+    Returns:
+        list: Names of the fields the reading contained
+    """
+    updated_fields = [field for field in SENSOR_FIELDS if field in data]
+    for field in updated_fields:
+        setattr(device, field, data[field])
+    if updated_fields:
+        device.sensor_last_update = datetime.utcnow()
+    return updated_fields
+
+
+def record_sensor_reading(sensor_history, device, data):
+    """Keep a reading in the history store (batched insert in the background)"""
+    sensor_history.record(
+        device.id,
+        temperature=data.get('temperature'),
+        humidity=data.get('humidity'),
+        motion=data.get('motion_detected'),
+        sleep=data.get('sleep_mode')
+    )
+
+
+def sensor_response(device, updated_fields, poll_seconds):
+    """Full and compact sensor-data responses; binary clients only get the status"""
+    return (
+        {
+            'status': 'success',
+            'message': f'Sensor data updated: {", ".join(updated_fields)}',
+            'device': device.to_dict(),
+            'next_poll_seconds': poll_seconds
+        },
+        {'status': 'success', 'next_poll_seconds': poll_seconds}
+    )
+
+
+def is_assigned(image, device_id):
+    """Whether an uploaded image is assigned to a device"""
+    return device_id in json.loads(image.device_assignments or '[]')
+
+
+def auto_registered_device(device_id):
+    """Device created when an unknown device asks for content"""
+    return Device(
+        device_id=device_id,
+        device_name=f"ESP32 Device {device_id}",
+        device_type="ESP32_DevKit_V1",
+        occupation="Auto-registered Device"
+    )
+
+
+def images_sequence_response(device_id, images, content, content_version, poll_seconds):
+    """Full and compact images-sequence responses"""
+    assigned_images = [{
+        'id': img.id,
+        'filename': img.filename,
+        'url': f"/uploads/{img.filename}",
+        'bmp_url': f"/uploads/{img.filename}/bmp",
+        'file_size': img.file_size
+    } for img in images]
+    payload = {
+        'success': True,
+        'message': 'Content generated',
+        'device_id': device_id,
+        'dashboard_url': f"/dashboards/{device_id}_current.bmp",
+        'fallback_url': f"/dashboards/{device_id}_fallback.bmp",
+        'assigned_images': assigned_images,
+        'content_categories': list(content.keys()) if content else [],
+        'content_version': content_version,
+        'next_poll_seconds': poll_seconds
+    }
+    compact = {
+        'success': True,
+        'dashboard_url': payload['dashboard_url'],
+        'content_version': content_version,
+        'next_poll_seconds': poll_seconds,
+        'assigned_images': [
+            {'filename': img['filename'], 'bmp_url': img['bmp_url']} for img in assigned_images
+        ]
+    }
+    return payload, compact
+
+
+def content_response(device_id, images, content, content_version, poll_seconds):
+    """JSON response of the content endpoint"""
+    return {
+        'device_id': device_id,
+        'timestamp': datetime.utcnow().isoformat(),
+        'dashboard_url': f"/dashboards/{device_id}_current.bmp",
+        'fallback_url': f"/dashboards/{device_id}_fallback.bmp",
+        'images': [{
+            'filename': img.filename,
+            'bmp_url': f"/uploads/{img.filename}/bmp",
+            'upload_date': img.uploaded_at.isoformat() if img.uploaded_at else None
+        } for img in images],
+        'content': content,
+        'content_version': content_version,
+        'next_poll_seconds': poll_seconds,
+        'status': 'success'
+    }
+
+
+def content_error_response(device_id, error, status='error'):
+    """JSON body of a failed content request"""
+    return {
+        'device_id': device_id,
+        'error': str(error),
+        'status': status,
+        'timestamp': datetime.utcnow().isoformat()
+    }
+
+
+def content_version_response(device_id, version, since, poll_seconds):
+    """Full and compact content-version responses"""
+    changed = since is not None and version != since
+    return (
+        {'device_id': device_id, 'version': version, 'changed': changed, 'next_poll_seconds': poll_seconds},
+        {'version': version, 'changed': changed, 'next_poll_seconds': poll_seconds}
+    )
+
+
+def offer_firmware(update_info, device_id, url_root, governor):
+    """
+    Turn an available update into a download offer
+
+    The firmware URL is made absolute and carries a slot token; when no download
+    slot is free the device is told when to retry instead.
+    """
+    firmware_url = update_info['firmware_url']
+    if not firmware_url.startswith('http'):
+        firmware_url = url_root.rstrip('/') + firmware_url
+
+    # Reserve a download slot; without one the device will be told to retry later
+    firmware_key = update_info.get('firmware_key') or firmware_url.split('?')[0].rsplit('/', 1)[-1]
+    slot_token = governor.issue_slot_token(device_id, firmware_key)
+    if slot_token:
+        separator = '&' if '?' in firmware_url else '?'
+        firmware_url = f"{firmware_url}{separator}slot={slot_token}"
+    else:
+        update_info['retry_after'] = governor.retry_after(update_info.get('file_size'))
+    update_info['firmware_url'] = firmware_url
+    return update_info
+
+
+def firmware_range(requested_range, file_size):
+    """
+    Byte range a firmware download serves and whether it counts as a download
+
+    Only requests starting at the first byte count; later ranges resume a download
+    that was already counted. Multi-range requests get the whole file.
+
+    Args:
+        requested_range: Parsed Range header (werkzeug Range) or None
+
+    Returns:
+        tuple: ((start, stop) or None for the whole file, counts), or None when the
+            range can't be satisfied (416)
+    """
+    if requested_range is None or requested_range.units != 'bytes' or len(requested_range.ranges) != 1:
+        return None, True
+    byte_range = requested_range.range_for_length(file_size)
+    if byte_range is None:
+        return None
+    return byte_range, byte_range[0] == 0
+
+
+def firmware_integrity_headers(ota_manager, firmware_key):
+    """Integrity headers (x-MD5 is verified by the ESP32 HTTPUpdate client)"""
+    hashes = ota_manager.get_firmware_hashes(firmware_key)
+    if not hashes:
+        return {}
+    return {'X-Firmware-SHA256': hashes[0], 'x-MD5': hashes[1]}
+
@@ -0,0 +1,705 @@
+"""
+PersonalCMS Device API (ASGI)
+Async serving of the endpoints ESP32 devices poll, so thousands of slow or idle
+connections cost a coroutine each instead of a worker thread. Uses the same models,
+services and wire encodings as the Flask app, which stays mounted underneath for the
+admin UI and every other route.
+
+Run with:
+    uvicorn device_api_asgi:app --host 0.0.0.0 --port 5000 --workers 4
+
+Requires the packages in requirements-asgi.txt (starlette, uvicorn, httpx,
+SQLAlchemy's asyncio extra and aiosqlite); use asyncpg or aiomysql for other
+databases. a2wsgi is used for the Flask mount when installed.
+"""
+
+import os
+import json
+import asyncio
+import logging
+import contextlib
+from datetime import datetime
+
+import httpx
+from sqlalchemy import select, update, event
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.concurrency import run_in_threadpool
+from starlette.responses import Response, JSONResponse, StreamingResponse, FileResponse
+from starlette.routing import Route, Mount
+from werkzeug.datastructures import MIMEAccept
+from werkzeug.http import parse_accept_header, parse_range_header, parse_etags, http_date
+from werkzeug.security import safe_join
+
+try:
+    from a2wsgi import WSGIMiddleware
+except ImportError:
+    from starlette.middleware.wsgi import WSGIMiddleware
+
+import unified_cms
+from content_versions import ALL_DEVICES
+from models import db, Device, UserImage, ContentAPI, ContentSource, DefaultContent
+from device_codec import MSGPACK_MIMETYPE, MSGPACK_MIMETYPES, packb, unpackb, wants_msgpack, expect_map, DecodeError
+from static_offload import proxy_headers, firmware_offload_mode
+from frame_cache import frame_variant
+import device_api
+from render_service import RenderBusy
+
+logger = logging.getLogger(__name__)
+
+# Sync driver -> async driver for the same database
+ASYNC_DRIVERS = {
+    'sqlite': 'sqlite+aiosqlite',
+    'postgresql': 'postgresql+asyncpg',
+    'mysql': 'mysql+aiomysql'
+}
+
+# Per-process state, set up in lifespan()
+flask_app = None
+async_session = None
+http_client = None
+content_fetcher = None
+
+
+class AsyncContentFetcher:
+    """
+    Async version of PerDeviceCMS.get_content_for_device
+
+    Content sources and APIs are loaded with one query each and the upstream content
+    APIs are fetched concurrently, so a device with several API-backed categories
+    waits for the slowest API rather than the sum of them.
+    """
+
+    def __init__(self, cms, client):
+        self.cms = cms
+        self.client = client
+
+    async def get_content_for_device(self, session, device):
+        """Get default content based on device preferences and content sources"""
+        if not device.preferences:
+            return {}
+        try:
+            prefs = json.loads(device.preferences)
+        except:
+            return {}
+
+        presets = self.cms.default_content_sources
+        content = {category: {} for category in prefs if category in presets}
+        wanted = [(category, subcategory) for category in content for subcategory in prefs[category]]
+        if not wanted:
+            return content
+
+        api_content = await self._fetch_api_content(session, wanted)
+        for category, subcategory in wanted:
+            items = api_content.get((category, subcategory))
+            if items:
+                content[category][subcategory] = items
+            elif subcategory in presets[category]:
+                content[category][subcategory] = presets[category][subcategory]()
+            else:
+                # If subcategory doesn't exist in preset, try to get from default content
+                items = await self._get_default_content_items(session, category, subcategory)
+                if items:
+                    content[category][subcategory] = items
+        return content
+
+    async def _fetch_api_content(self, session, wanted):
+        """Fetch every API-backed category/subcategory at once"""
+        categories = {category for category, _ in wanted}
+        sources = {}
+        rows = await session.scalars(
+            select(ContentSource).where(ContentSource.category.in_(categories)).order_by(ContentSource.id)
+        )
+        for source in rows:
+            sources.setdefault((source.category, source.subcategory), source)
+        api_pairs = [pair for pair in wanted if pair in sources and sources[pair].source_type == 'api']
+        if not api_pairs:
+            return {}
+
+        endpoints = {}
+        rows = await session.scalars(
+            select(ContentAPI).where(ContentAPI.category.in_(categories)).order_by(ContentAPI.id)
+        )
+        for endpoint in rows:
+            endpoints.setdefault((endpoint.category, endpoint.subcategory), endpoint)
+        pairs = [pair for pair in api_pairs if pair in endpoints]
+        if not pairs:
+            return {}
+
+        results = await asyncio.gather(*(self._fetch(endpoints[pair], *pair) for pair in pairs))
+
+        # Update API statistics
+        now = datetime.utcnow()
+        for pair, items in zip(pairs, results):
+            endpoint_id = endpoints[pair].id
+            if items is None:
+                values = {'error_count': ContentAPI.error_count + 1}
+            else:
+                values = {'success_count': ContentAPI.success_count + 1, 'last_fetched': now}
+            await session.execute(update(ContentAPI).where(ContentAPI.id == endpoint_id).values(**values))
+        await session.commit()
+        return {pair: items for pair, items in zip(pairs, results) if items is not None}
+
+    async def _fetch(self, api_endpoint, category, subcategory):
+        """Fetch one content API, joining a request for it already in flight"""
+        if self.cms.single_flight is None:
+            return await self._fetch_once(api_endpoint, category, subcategory)
+        return await self.cms.single_flight.do_async(
+            ('api', category, subcategory), self._fetch_once, api_endpoint, category, subcategory
+        )
+
+    async def _fetch_once(self, api_endpoint, category, subcategory):
+        try:
+            response = await self.client.get(api_endpoint.api_url, headers=self.cms.api_headers(api_endpoint))
+            response.raise_for_status()
+            content = self.cms.extract_api_content(api_endpoint, response.json())
+            logger.info(f"Successfully fetched {len(content)} items from API for {category}/{subcategory}")
+            return content
+        except Exception as e:
+            logger.error(f"Error fetching API content for {category}/{subcategory}: {str(e)}")
+            return None
+
+    async def _get_default_content_items(self, session, category, subcategory):
+        """Get default content items from database for given category/subcategory"""
+        try:
+            for candidate in (subcategory, 'default'):
+                items = (await session.scalars(
+                    select(DefaultContent)
+                    .filter_by(category=category, subcategory=candidate, is_active=True)
+                    .order_by(DefaultContent.created_at.desc())
+                    .limit(10)
+                )).all()
+                if items:
+                    break
+            return self.cms.format_default_items(category, items)
+        except Exception as e:
+            logger.error(f"Error fetching default content for {category}/{subcategory}: {str(e)}")
+            return []
+
+
+def async_database_url(url):
+    """The configured database URL with its async driver"""
+    driver = ASYNC_DRIVERS.get(url.get_backend_name())
+    if driver is None:
+        raise RuntimeError(f"No async driver known for database '{url.get_backend_name()}'")
+    return url.set(drivername=driver)
+
+
+@contextlib.asynccontextmanager
+async def lifespan(app):
+    """Start this process's services and open the async database and HTTP clients"""
+    global flask_app, async_session, http_client, content_fetcher
+
+    # Same services as the Flask app: presence, telemetry, OTA manager, download governor
+    flask_app = await run_in_threadpool(unified_cms.create_app)
+    with flask_app.app_context():
+        url = db.engine.url
+    engine = create_async_engine(async_database_url(url), pool_pre_ping=True)
+    if url.get_backend_name() == 'sqlite':
+        event.listen(engine.sync_engine, 'connect', unified_cms._enable_sqlite_wal)
+    async_session = async_sessionmaker(engine, expire_on_commit=False)
+    http_client = httpx.AsyncClient(timeout=10, limits=httpx.Limits(max_connections=100))
+    content_fetcher = AsyncContentFetcher(unified_cms.per_device_cms, http_client)
+    logger.info(f"Async device API ready ({engine.url.drivername})")
+    try:
+        yield
+    finally:
+        await http_client.aclose()
+        await engine.dispose()
+
+
+async def run_sync(fn, *args, **kwargs):
+    """Run blocking service code (file registry, PIL) in the threadpool with an app context"""
+    def call():
+        with flask_app.app_context():
+            return fn(*args, **kwargs)
+    return await run_in_threadpool(call)
+
+
+async def read_payload(request, force_json=False):
+    """
+    Request body as a dict from either JSON or MessagePack
+
+    Raises:
+        DecodeError: The MessagePack body is malformed, or the body isn't a map
+    """
+    mimetype = request.headers.get('content-type', '').split(';')[0].strip().lower()
+    body = await request.body()
+    if mimetype in MSGPACK_MIMETYPES:
+        return expect_map(unpackb(body))
+    if not (force_json or mimetype == 'application/json' or mimetype.endswith('+json')):
+        return None
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return None
+    return expect_map(payload)
+
+
+def device_response(request, payload, compact=None, status=200):
+    """Respond in the encoding the device asked for (see device_codec.device_response)"""
+    accept = parse_accept_header(request.headers.get('accept'), MIMEAccept)
+    if wants_msgpack(accept):
+        response = Response(packb(compact if compact is not None else payload), status_code=status,
+                            media_type=MSGPACK_MIMETYPE)
+    else:
+        response = JSONResponse(payload, status_code=status)
+    response.headers['Vary'] = 'Accept'
+    return response
+
+
+def send_file(filepath, media_type=None, download_name=None, limit_rate=None):
+    """File response, handed to the front proxy when an offload mode is configured"""
+    headers = proxy_headers(filepath, flask_app.config, download_name, limit_rate)
+    if headers:
+        return Response(status_code=200, headers=headers, media_type=media_type or 'application/octet-stream')
+    return FileResponse(filepath, media_type=media_type, filename=download_name)
+
+
+def send_frame(request, filepath):
+    """
+    Dashboard or converted BMP from the in-memory frame cache (see unified_cms.send_frame)
+
+    Returns None if the file doesn't exist.
+    """
+    headers = proxy_headers(filepath, flask_app.config)
+    if headers:
+        if not os.path.isfile(filepath):
+            return None
+        return Response(status_code=200, headers=headers, media_type='image/bmp')
+    variant = frame_variant(request.query_params.get('format'), request.headers.get('accept-encoding'))
+    frame = unified_cms.frame_cache.get(filepath, variant)
+    if frame is None:
+        return None
+    etag = f"{frame.digest[:32]}-{variant}"
+    headers = {
+        'ETag': f'"{etag}"',
+        'Last-Modified': http_date(frame.mtime),
+        'Cache-Control': 'no-cache',
+        'Vary': 'Accept-Encoding'
+    }
+    if variant == 'gzip':
+        headers['Content-Encoding'] = 'gzip'
+    if parse_etags(request.headers.get('if-none-match')).contains(etag):
+        return Response(status_code=304, headers=headers)
+    return Response(frame.data, headers=headers,
+                    media_type='application/octet-stream' if variant == 'raw' else 'image/bmp')
+
+
+def _folder(key):
+    """Configured folder, relative to the app root like Flask's send_from_directory"""
+    return os.path.join(flask_app.root_path, flask_app.config[key])
+
+
+async def _get_device(session, device_id):
+    return await session.scalar(select(Device).filter_by(device_id=device_id))
+
+
+async def _device_exists(device_id):
+    """Check a device is registered, sharing the presence tracker's cache of positive lookups"""
+    presence = unified_cms.presence_tracker
+    if presence.is_known(device_id):
+        return True
+    generation = presence.known_generation
+    async with async_session() as session:
+        if await session.scalar(select(Device.id).filter_by(device_id=device_id)) is None:
+            return False
+    presence.remember(device_id, generation)
+    return True
+
+
+async def _content_version(session, device_id):
+    """A device's content version, read from the database"""
+    board = unified_cms.content_versions
+    rows = (await session.execute(board.counters_query(device_id, ALL_DEVICES))).all()
+    board.remember(rows, notify=True)
+    return board.version(device_id)
+
+
+async def _assigned_images(session, device_id):
+    """Uploaded images assigned to a device (pre-filtered in SQL, confirmed from the JSON)"""
+    images = await session.scalars(
+        select(UserImage).where(UserImage.device_assignments.contains(f'"{device_id}"')).order_by(UserImage.id)
+    )
+    return [img for img in images if device_api.is_assigned(img, device_id)]
+
+
+def _issue_ingest_key(device_id):
+    key = unified_cms.udp_ingest.issue_key(device_id)
+    db.session.commit()
+    return key
+
+
+async def register_device(request):
+    """Register or update a device"""
+    try:
+        data = await read_payload(request, force_json=True)
+        device_id = data.get('device_id')
+        fields = device_api.registration_fields(data)
+        if fields is None:
+            return device_response(request, {'success': False, 'message': 'Missing required fields'}, status=400)
+
+        async with async_session() as session:
+            new_device = device_api.apply_registration(await _get_device(session, device_id), device_id, fields)
+            if new_device is not None:
+                session.add(new_device)
+            await session.commit()
+
+        unified_cms.presence_tracker.touch(device_id)  # Start tracking its offline deadline
+        await run_sync(unified_cms.content_versions.bump, device_id, 'registered')
+        logger.info(f"Device registered: {device_id} ({fields['device_name']})")
+        ingest = unified_cms.udp_ingest
+        # A fresh UDP signing key on every registration
+        ingest_key = await run_sync(_issue_ingest_key, device_id) if ingest.enabled else None
+        payload, compact = device_api.registration_response(device_id, unified_cms.next_poll(device_id),
+                                                            ingest_key, ingest.port)
+        return device_response(request, payload, compact=compact)
+
+    except DecodeError as e:
+        return device_response(request, {'success': False, 'message': f'Invalid payload: {e}'}, status=400)
+    except Exception as e:
+        logger.error(f"Device registration error: {str(e)}")
+        return device_response(request, {'success': False, 'message': f'Registration failed: {str(e)}'}, status=500)
+
+
+async def device_heartbeat(request):
+    """Receive heartbeat from OTA-enabled devices"""
+    device_id = request.path_params['device_id']
+    try:
+        data = await read_payload(request) or {}
+
+        async with async_session() as session:
+            device = await _get_device(session, device_id)
+            if not device:
+                # Create device if it doesn't exist (for OTA-enabled devices)
+                device = device_api.heartbeat_device(device_id, data)
+                session.add(device)
+            device_api.apply_heartbeat(device, data)
+            unified_cms.presence_tracker.touch(device_id)
+            await session.commit()
+
+        # A reported version may complete a delivered forced update
+        if 'version' in data:
+            await run_sync(unified_cms.ota_manager.acknowledge_forced_update, device_id, data['version'])
+
+        device_api.observe_heartbeat(device, data, unified_cms.rollout_guard, unified_cms.fleet_telemetry)
+
+        logger.info(f"Heartbeat received from {device_id}")
+        payload, compact = device_api.heartbeat_response(unified_cms.next_poll(device_id, sleep_mode=device.sleep_mode))
+        return device_response(request, payload, compact=compact)
+
+    except DecodeError as e:
+        return device_response(request, {'error': f'Invalid payload: {e}'}, status=400)
+    except Exception as e:
+        logger.error(f"Heartbeat processing failed for {device_id}: {str(e)}")
+        return device_response(request, {'error': 'Heartbeat processing failed'}, status=500)
+
+
+async def update_sensor_data(request):
+    """Update sensor data for a specific device"""
+    device_id = request.path_params['device_id']
+    try:
+        data = await read_payload(request)
+        if not data:
+            logger.warning(f"No sensor data provided for {device_id}")
+            return device_response(request, {'error': 'No JSON data provided'}, status=400)
+
+        async with async_session() as session:
+            device = await _get_device(session, device_id)
+            if not device:
+                logger.warning(f"Device {device_id} not found")
+                return device_response(request, {'error': 'Device not found'}, status=404)
+
+            updated_fields = device_api.apply_sensor_data(device, data)
+            await session.commit()
+            await session.refresh(device)
+
+        unified_cms.presence_tracker.touch(device_id)
+        if updated_fields:
+            device_api.record_sensor_reading(unified_cms.sensor_history, device, data)
+
+        logger.info(f"Sensor data updated for {device_id}: {updated_fields}")
+        payload, compact = device_api.sensor_response(device, updated_fields,
+                                                      unified_cms.next_poll(device_id, sleep_mode=device.sleep_mode))
+        return device_response(request, payload, compact=compact)
+
+    except DecodeError as e:
+        return device_response(request, {'error': f'Invalid payload: {e}'}, status=400)
+    except Exception as e:
+        logger.error(f"Sensor data update failed for {device_id}: {e}")
+        return device_response(request, {'error': 'Internal server error'}, status=500)
+
+
+async def get_images_sequence(request):
+    """Get images sequence for a device"""
+    device_id = request.path_params['device_id']
+    try:
+        async with async_session() as session:
+            device = await _get_device(session, device_id)
+            if not device:
+                logger.warning(f"Device not found: {device_id}")
+                return device_response(request, {'success': False, 'message': 'Device not found'}, status=404)
+
+            unified_cms.presence_tracker.touch(device_id)
+            content = await content_fetcher.get_content_for_device(session, device)
+            images = await _assigned_images(session, device_id)
+            content_version = await _content_version(session, device_id)
+
+        # Dashboard rendering is CPU-bound PIL work
+        await run_sync(unified_cms.render_dashboard, device, content)
+
+        payload, compact = device_api.images_sequence_response(
+            device_id, images, content, content_version, unified_cms.next_poll(device_id, sleep_mode=device.sleep_mode)
+        )
+        logger.info(f"Images sequence for {device_id}: dashboard + {len(images)} images")
+        return device_response(request, payload, compact=compact)
+
+    except RenderBusy as e:
+        logger.warning(f"Images sequence for {device_id} refused, renderer busy: {e}")
+        response = device_response(request, {'success': False, 'message': str(e)}, status=503)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
+    except Exception as e:
+        logger.error(f"Images sequence error for {device_id}: {str(e)}")
+        return device_response(request, {'success': False, 'message': str(e)}, status=500)
+
+
+async def api_device_content(request):
+    """API endpoint for ESP32 devices to get content (JSON response)"""
+    device_id = request.path_params['device_id']
+    try:
+        async with async_session() as session:
+            device = await _get_device(session, device_id)
+            if not device:
+                logger.warning(f"Device {device_id} not found, creating new device")
+                device = device_api.auto_registered_device(device_id)
+                session.add(device)
+                await session.commit()
+
+            unified_cms.presence_tracker.touch(device_id)
+            content = await content_fetcher.get_content_for_device(session, device)
+            images = await _assigned_images(session, device_id)
+            content_version = await _content_version(session, device_id)
+
+        await run_sync(unified_cms.render_dashboard, device, content)
+
+        logger.info(f"Content for {device_id}: dashboard + {len(images)} images")
+        return JSONResponse(device_api.content_response(
+            device_id, images, content, content_version, unified_cms.next_poll(device_id, sleep_mode=device.sleep_mode)
+        ))
+
+    except RenderBusy as e:
+        logger.warning(f"Content for {device_id} refused, renderer busy: {e}")
+        return JSONResponse(device_api.content_error_response(device_id, e, 'busy'),
+                            status_code=503, headers={'Retry-After': str(e.retry_after)})
+    except Exception as e:
+        logger.error(f"Content API error for {device_id}: {str(e)}")
+        return JSONResponse(device_api.content_error_response(device_id, e), status_code=500)
+
+
+async def wait_content_version(request):
+    """
+    Long-poll for a content change
+
+    With ?since=<version> the request is held until the device's content version
+    differs or ?timeout= seconds pass; a held request costs only a coroutine.
+    """
+    device_id = request.path_params['device_id']
+    board = unified_cms.content_versions
+    try:
+        since = request.query_params.get('since')
+        since = int(since) if since is not None and since.lstrip('-').isdigit() else None
+        limit = flask_app.config['CONTENT_LONGPOLL_TIMEOUT_SECONDS']
+        try:
+            timeout = min(max(float(request.query_params.get('timeout', limit)), 0), limit)
+        except ValueError:
+            timeout = limit
+
+        if not await _device_exists(device_id):
+            return device_response(request, {'error': 'Device not found'}, status=404)
+        unified_cms.presence_tracker.touch(device_id)
+
+        loop = asyncio.get_running_loop()
+        changed = asyncio.Event()
+        unwatch = board.watch(device_id, lambda: loop.call_soon_threadsafe(changed.set))
+        try:
+            async with async_session() as session:
+                version = await _content_version(session, device_id)
+            if since is not None and version == since:
+                with contextlib.suppress(asyncio.TimeoutError):
+                    await asyncio.wait_for(changed.wait(), board.wait_timeout(timeout))
+                version = board.version(device_id)
+        finally:
+            unwatch()
+
+        # Long-poll clients reconnect right away; the hint only spreads the reconnects
+        payload, compact = device_api.content_version_response(device_id, version, since,
+                                                               unified_cms.next_poll(device_id, due_in=0))
+        return device_response(request, payload, compact=compact)
+
+    except Exception as e:
+        logger.error(f"Content version wait failed for {device_id}: {str(e)}")
+        return device_response(request, {'error': 'Content version check failed'}, status=500)
+
+
+async def check_ota_update(request):
+    """Check for OTA updates for a specific device"""
+    device_id = request.path_params['device_id']
+    try:
+        # Only existence matters here; positive lookups are cached
+        if not await _device_exists(device_id):
+            return JSONResponse({'error': 'Device not found'}, status_code=404)
+
+        current_version = request.headers.get('X-Device-Version', '1.0.0')
+        device_type = request.headers.get('X-Device-Type', 'ESP32_PersonalCMS')
+        logger.info(f"OTA check for {device_id}: current={current_version}, type={device_type}")
+
+        update_info = await run_sync(unified_cms.ota_manager.check_update_for_device,
+                                     device_id, current_version, device_type)
+        unified_cms.presence_tracker.touch(device_id)
+
+        if update_info.get('update_available'):
+            device_api.offer_firmware(update_info, device_id, str(request.base_url), unified_cms.download_governor)
+        update_info['next_poll_seconds'] = unified_cms.next_poll(device_id, due_in=update_info.get('retry_after'))
+
+        logger.info(f"OTA response for {device_id}: {update_info}")
+        return JSONResponse(update_info)
+
+    except Exception as e:
+        logger.error(f"OTA check failed for {device_id}: {str(e)}")
+        return JSONResponse({'error': 'OTA check failed'}, status_code=500)
+
+
+async def download_firmware(request):
+    """Download firmware file (slot-admitted and bandwidth-shaped, without holding a thread)"""
+    firmware_key = request.path_params['firmware_key']
+    ota_manager = unified_cms.ota_manager
+    governor = unified_cms.download_governor
+    try:
+        firmware_path = ota_manager.get_firmware_path(firmware_key)
+        if not firmware_path or not os.path.exists(firmware_path):
+            return JSONResponse({'error': 'Firmware not found'}, status_code=404)
+
+        integrity_headers = device_api.firmware_integrity_headers(ota_manager, firmware_key)
+
+        if request.method == 'HEAD':
+            # Metadata only - no bytes to shape, so skip admission
+            return FileResponse(firmware_path, filename=f"{firmware_key}.bin", headers=integrity_headers)
+
+        file_size = os.path.getsize(firmware_path)
+        requested = device_api.firmware_range(parse_range_header(request.headers.get('range')), file_size)
+        if requested is None:
+            return JSONResponse({'error': 'Requested range not satisfiable'}, status_code=416,
+                                headers={'Content-Range': f"bytes */{file_size}"})
+        byte_range, counts = requested
+
+        client_ip = request.client.host if request.client else ''
+        lease = governor.admit(firmware_key, client_ip, request.query_params.get('slot'))
+        if lease is None:
+            retry_after = governor.retry_after(file_size)
+            logger.warning(f"Firmware download refused (at capacity): {firmware_key}, retry in {retry_after}s")
+            return JSONResponse({'error': 'Download capacity exhausted', 'retry_after': retry_after},
+                                status_code=503, headers={'Retry-After': str(retry_after)})
+
+        try:
+            per_stream_rate = governor.per_stream_rate()
+            headers = None
+            if firmware_offload_mode(flask_app.config) != 'none':
+                headers = proxy_headers(firmware_path, flask_app.config, f"{firmware_key}.bin", per_stream_rate)
+            if headers:
+                # Accounting stays in Python; the proxy serves the same range
+                if counts:
+                    await run_sync(ota_manager.record_download, firmware_key)
+                # The proxy moves (and range-serves) the bytes; hold the slot for the estimated transfer
+                lease.hold_for(file_size / per_stream_rate if per_stream_rate else 0)
+                headers.update(integrity_headers)
+                logger.info(f"Offloaded firmware download: {firmware_key}")
+                return Response(status_code=200, headers=headers, media_type='application/octet-stream')
+
+            start, stop = byte_range if byte_range else (0, file_size)
+            if counts:
+                await run_sync(ota_manager.record_download, firmware_key)
+        except Exception:
+            lease.release()
+            raise
+
+        headers = {
+            'Content-Length': str(stop - start),
+            'Accept-Ranges': 'bytes',
+            'Content-Disposition': f'attachment; filename={firmware_key}.bin',
+            **integrity_headers
+        }
+        if byte_range:
+            headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+
+        logger.info(f"Serving firmware download: {firmware_key} ({start}-{stop - 1}/{file_size})")
+        # The stream releases the lease when it finishes or the client goes away
+        return StreamingResponse(
+            governor.astream_file(lease, firmware_path, start, stop - start),
+            status_code=206 if byte_range else 200,
+            media_type='application/octet-stream',
+            headers=headers
+        )
+
+    except Exception as e:
+        logger.error(f"Firmware download failed for {firmware_key}: {str(e)}")
+        return JSONResponse({'error': 'Download failed'}, status_code=500)
+
+
+async def serve_dashboard(request):
+    """Serve generated dashboard BMP files"""
+    filepath = safe_join(_folder('DASHBOARD_FOLDER'), request.path_params['filename'])
+    response = send_frame(request, filepath) if filepath else None
+    if response is None:
+        return JSONResponse({'error': 'Dashboard file not found'}, status_code=404)
+    return response
+
+
+async def serve_uploaded_image_bmp(request):
+    """Serve BMP version of uploaded image files for ESP32"""
+    filename = request.path_params['filename']
+    try:
+        upload_folder = _folder('UPLOAD_FOLDER')
+        original_path = safe_join(upload_folder, filename)
+        if original_path is None or not os.path.exists(original_path):
+            return JSONResponse({'error': 'Original image not found'}, status_code=404)
+
+        bmp_dir = os.path.join(upload_folder, 'bmp')
+        bmp_path = os.path.join(bmp_dir, os.path.splitext(filename)[0] + '.bmp')
+        os.makedirs(bmp_dir, exist_ok=True)
+
+        # Convert to BMP if not already exists or if original is newer
+        if not os.path.exists(bmp_path) or os.path.getmtime(original_path) > os.path.getmtime(bmp_path):
+            success = await run_in_threadpool(unified_cms.convert_upload_bmp, original_path, bmp_path)
+            if not success:
+                return JSONResponse({'error': 'BMP conversion failed'}, status_code=500)
+
+        response = send_frame(request, bmp_path)
+        if response is None:
+            return JSONResponse({'error': 'BMP file not found'}, status_code=404)
+        return response
+
+    except RenderBusy as e:
+        logger.warning(f"BMP conversion of {filename} refused, renderer busy: {e}")
+        return JSONResponse({'error': 'Renderer busy'}, status_code=503, headers={'Retry-After': str(e.retry_after)})
+    except Exception as e:
+        logger.error(f"BMP image serve error: {str(e)}")
+        return JSONResponse({'error': 'BMP conversion error'}, status_code=500)
+
+
+routes = [
+    Route('/api/devices/register', register_device, methods=['POST']),
+    Route('/api/devices/{device_id}/heartbeat', device_heartbeat, methods=['POST']),
+    Route('/api/devices/{device_id}/sensor-data', update_sensor_data, methods=['POST']),
+    Route('/api/devices/{device_id}/images-sequence', get_images_sequence, methods=['GET']),
+    Route('/api/devices/{device_id}/content', api_device_content, methods=['GET']),
+    Route('/api/devices/{device_id}/content-version', wait_content_version, methods=['GET']),
+    Route('/api/ota/check/{device_id}', check_ota_update, methods=['GET']),
+    Route('/api/ota/download/{firmware_key}', download_firmware, methods=['GET', 'HEAD']),
+    Route('/dashboards/{filename}', serve_dashboard, methods=['GET', 'HEAD']),
+    Route('/uploads/{filename}/bmp', serve_uploaded_image_bmp, methods=['GET', 'HEAD']),
+    # Admin UI and every other endpoint stay on Flask
+    Mount('/', app=WSGIMiddleware(unified_cms.app))
+]
+
+app = Starlette(routes=routes, lifespan=lifespan)
@@ -0,0 +1,263 @@
+"""
+Device Wire Encoding
+Content negotiation between JSON and MessagePack for the endpoints ESP32 devices poll.
+MessagePack is what ArduinoJson already speaks (serializeMsgPack / deserializeMsgPack),
+so firmware can switch encodings without a new library.
+"""
+
+import struct
+import logging
+from flask import Response, jsonify, request
+
+try:
+    import msgpack
+    MSGPACK_AVAILABLE = True
+except ImportError:
+    MSGPACK_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+MSGPACK_MIMETYPE = 'application/msgpack'
+MSGPACK_MIMETYPES = (MSGPACK_MIMETYPE, 'application/x-msgpack', 'application/vnd.msgpack')
+# Deepest array/map nesting the built-in decoder accepts (ArduinoJson's own default is 10)
+MAX_NESTING = 32
+
+
+class DecodeError(ValueError):
+    """Malformed MessagePack payload, or a body that isn't a map"""
+
+
+def packb(obj):
+    """Encode an object as MessagePack"""
+    if MSGPACK_AVAILABLE:
+        return msgpack.packb(obj, use_bin_type=True)
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def unpackb(data):
+    """Decode a single MessagePack object"""
+    if MSGPACK_AVAILABLE:
+        try:
+            return msgpack.unpackb(data, raw=False, strict_map_key=False)
+        except Exception as e:
+            raise DecodeError(str(e)) from e
+    try:
+        obj, offset = _unpack(memoryview(data), 0)
+    except (IndexError, struct.error, UnicodeDecodeError, TypeError) as e:
+        raise DecodeError(f"Truncated or invalid MessagePack: {e}") from e
+    if offset != len(data):
+        raise DecodeError("Trailing bytes after MessagePack object")
+    return obj
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        if 0 <= obj <= 0x7f:
+            out.append(obj)
+        elif -32 <= obj < 0:
+            out.append(obj & 0xff)
+        elif 0 <= obj <= 0xff:
+            out += struct.pack('>BB', 0xcc, obj)
+        elif 0 <= obj <= 0xffff:
+            out += struct.pack('>BH', 0xcd, obj)
+        elif 0 <= obj <= 0xffffffff:
+            out += struct.pack('>BI', 0xce, obj)
+        elif 0 <= obj <= 0xffffffffffffffff:
+            out += struct.pack('>BQ', 0xcf, obj)
+        elif -0x80 <= obj < 0:
+            out += struct.pack('>Bb', 0xd0, obj)
+        elif -0x8000 <= obj < 0:
+            out += struct.pack('>Bh', 0xd1, obj)
+        elif -0x80000000 <= obj < 0:
+            out += struct.pack('>Bi', 0xd2, obj)
+        elif -0x8000000000000000 <= obj < 0:
+            out += struct.pack('>Bq', 0xd3, obj)
+        else:
+            raise OverflowError("Integer out of MessagePack range")
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        n = len(data)
+        if n <= 31:
+            out.append(0xa0 | n)
+        elif n <= 0xff:
+            out += struct.pack('>BB', 0xd9, n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xda, n)
+        else:
+            out += struct.pack('>BI', 0xdb, n)
+        out += data
+    elif isinstance(obj, (bytes, bytearray, memoryview)):
+        data = bytes(obj)
+        n = len(data)
+        if n <= 0xff:
+            out += struct.pack('>BB', 0xc4, n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xc5, n)
+        else:
+            out += struct.pack('>BI', 0xc6, n)
+        out += data
+    elif isinstance(obj, (list, tuple)):
+        n = len(obj)
+        if n <= 15:
+            out.append(0x90 | n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xdc, n)
+        else:
+            out += struct.pack('>BI', 0xdd, n)
+        for item in obj:
+            _pack(item, out)
+    elif isinstance(obj, dict):
+        n = len(obj)
+        if n <= 15:
+            out.append(0x80 | n)
+        elif n <= 0xffff:
+            out += struct.pack('>BH', 0xde, n)
+        else:
+            out += struct.pack('>BI', 0xdf, n)
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError(f"Cannot encode {type(obj).__name__} as MessagePack")
+
+
+# Fixed-width formats: type byte -> (struct format, size)
+_FIXED = {
+    0xca: ('>f', 4), 0xcb: ('>d', 8),
+    0xcc: ('>B', 1), 0xcd: ('>H', 2), 0xce: ('>I', 4), 0xcf: ('>Q', 8),
+    0xd0: ('>b', 1), 0xd1: ('>h', 2), 0xd2: ('>i', 4), 0xd3: ('>q', 8)
+}
+# Length-prefixed formats: type byte -> (length format, length size, kind)
+_SIZED = {
+    0xd9: ('>B', 1, 'str'), 0xda: ('>H', 2, 'str'), 0xdb: ('>I', 4, 'str'),
+    0xc4: ('>B', 1, 'bin'), 0xc5: ('>H', 2, 'bin'), 0xc6: ('>I', 4, 'bin'),
+    0xdc: ('>H', 2, 'array'), 0xdd: ('>I', 4, 'array'),
+    0xde: ('>H', 2, 'map'), 0xdf: ('>I', 4, 'map')
+}
+
+
+def _unpack(data, offset, depth=0):
+    code = data[offset]
+    offset += 1
+
+    if code <= 0x7f:
+        return code, offset
+    if code >= 0xe0:
+        return code - 0x100, offset
+    if code == 0xc0:
+        return None, offset
+    if code == 0xc2:
+        return False, offset
+    if code == 0xc3:
+        return True, offset
+    if code in _FIXED:
+        fmt, size = _FIXED[code]
+        if offset + size > len(data):
+            raise IndexError("Truncated number")
+        return struct.unpack_from(fmt, data, offset)[0], offset + size
+
+    if 0xa0 <= code <= 0xbf:
+        kind, length = 'str', code & 0x1f
+    elif 0x90 <= code <= 0x9f:
+        kind, length = 'array', code & 0x0f
+    elif 0x80 <= code <= 0x8f:
+        kind, length = 'map', code & 0x0f
+    elif code in _SIZED:
+        fmt, size, kind = _SIZED[code]
+        length = struct.unpack_from(fmt, data, offset)[0]
+        offset += size
+    else:
+        raise DecodeError(f"Unsupported MessagePack type 0x{code:02x}")
+    if kind in ('array', 'map') and depth >= MAX_NESTING:
+        raise DecodeError(f"MessagePack nested deeper than {MAX_NESTING} levels")
+
+    if kind in ('str', 'bin'):
+        end = offset + length
+        if end > len(data):
+            raise IndexError("Truncated string")
+        chunk = data[offset:end]
+        return (str(chunk, 'utf-8') if kind == 'str' else bytes(chunk)), end
+    if kind == 'array':
+        items = []
+        for _ in range(length):
+            item, offset = _unpack(data, offset, depth + 1)
+            items.append(item)
+        return items, offset
+    result = {}
+    for _ in range(length):
+        key, offset = _unpack(data, offset, depth + 1)
+        value, offset = _unpack(data, offset, depth + 1)
+        result[key] = value
+    return result, offset
+
+
+def is_msgpack_request():
+    """True when the request body is MessagePack"""
+    return request.mimetype in MSGPACK_MIMETYPES
+
+
+def wants_msgpack(accept=None):
+    """
+    True when the client prefers a MessagePack response (JSON wins ties and */*)
+
+    Args:
+        accept: Parsed Accept header (defaults to the current Flask request's)
+    """
+    if accept is None:
+        accept = request.accept_mimetypes
+    if not accept:
+        return False
+    best = accept.best_match(('application/json',) + MSGPACK_MIMETYPES)
+    return best in MSGPACK_MIMETYPES
+
+
+def expect_map(payload):
+    """
+    Check a decoded request body is a map (or absent)
+
+    Raises:
+        DecodeError: The body is an array, string or number
+    """
+    if payload is not None and not isinstance(payload, dict):
+        raise DecodeError(f"Expected a map, got {type(payload).__name__}")
+    return payload
+
+
+def read_payload(force_json=False):
+    """
+    Request body as a dict from either JSON or MessagePack
+
+    Raises:
+        DecodeError: The MessagePack body is malformed, or the body isn't a map
+    """
+    if is_msgpack_request():
+        return expect_map(unpackb(request.get_data()))
+    return expect_map(request.get_json(force=force_json, silent=True))
+
+
+def device_response(payload, compact=None, status=200):
+    """
+    Respond in the encoding the device asked for
+
+    Args:
+        payload: Full JSON response (unchanged for JSON clients)
+        compact: Trimmed response for MessagePack clients (defaults to payload)
+        status: HTTP status code
+    """
+    if wants_msgpack():
+        response = Response(packb(compact if compact is not None else payload), mimetype=MSGPACK_MIMETYPE)
+    else:
+        response = jsonify(payload)
+    response.status_code = status
+    response.vary.add('Accept')
+    return response
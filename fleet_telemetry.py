@@ -0,0 +1,336 @@
+"""
+Fleet Telemetry
+Streams heartbeat metrics (free heap, WiFi RSSI, uptime) into per-interval quantile
+sketches grouped by firmware version and device type, so p50/p95/p99 per build can be
+compared without storing every sample
+"""
+
+import json
+import math
+import time
+import threading
+import logging
+from sqlalchemy import select, delete
+
+from models import db, FleetTelemetrySketch
+
+logger = logging.getLogger(__name__)
+
+METRICS = ('free_heap', 'wifi_rssi', 'uptime')
+QUANTILES = (0.5, 0.95, 0.99)
+
+HOUR = 3600
+DAY = 86400
+
+
+def is_metric(value):
+    """Whether a reported value is a finite number (bools are not)"""
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+class QuantileSketch:
+    """
+    DDSketch-style quantile sketch
+
+    Values are counted in logarithmic buckets, so every quantile is returned within
+    `relative_accuracy` of a real sample and sketches merge by adding bucket counts.
+    Negative values (RSSI) use a mirrored set of buckets.
+    """
+
+    def __init__(self, relative_accuracy=0.01):
+        self.relative_accuracy = relative_accuracy
+        self.gamma = (1 + relative_accuracy) / (1 - relative_accuracy)
+        self._log_gamma = math.log(self.gamma)
+        self.positive = {}  # bucket index -> count
+        self.negative = {}
+        self.zero_count = 0
+        self.count = 0
+        self.sum = 0.0
+        self.min = None
+        self.max = None
+
+    def _index(self, value):
+        return math.ceil(math.log(value) / self._log_gamma)
+
+    def _value(self, index):
+        return 2 * self.gamma ** index / (self.gamma + 1)
+
+    def add(self, value):
+        if value > 0:
+            index = self._index(value)
+            self.positive[index] = self.positive.get(index, 0) + 1
+        elif value < 0:
+            index = self._index(-value)
+            self.negative[index] = self.negative.get(index, 0) + 1
+        else:
+            self.zero_count += 1
+        self.count += 1
+        self.sum += value
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def merge(self, other):
+        """Add another sketch's samples to this one"""
+        if other.relative_accuracy != self.relative_accuracy:
+            raise ValueError("Cannot merge sketches with different accuracy")
+        for index, count in other.positive.items():
+            self.positive[index] = self.positive.get(index, 0) + count
+        for index, count in other.negative.items():
+            self.negative[index] = self.negative.get(index, 0) + count
+        self.zero_count += other.zero_count
+        self.count += other.count
+        self.sum += other.sum
+        if other.count:
+            self.min = other.min if self.min is None else min(self.min, other.min)
+            self.max = other.max if self.max is None else max(self.max, other.max)
+        return self
+
+    def quantile(self, q):
+        """Approximate value at quantile q (0..1), or None if empty"""
+        if not self.count:
+            return None
+        if q <= 0:
+            return self.min
+        if q >= 1:
+            return self.max
+        rank = q * (self.count - 1)
+        return min(max(self._rank_value(rank), self.min), self.max)
+
+    def _rank_value(self, rank):
+        seen = 0
+        # Ascending value order: most negative first, then zero, then positive
+        for index in sorted(self.negative, reverse=True):
+            seen += self.negative[index]
+            if seen > rank:
+                return -self._value(index)
+        seen += self.zero_count
+        if seen > rank:
+            return 0.0
+        for index in sorted(self.positive):
+            seen += self.positive[index]
+            if seen > rank:
+                return self._value(index)
+        return self.max
+
+    def summary(self):
+        """Count, min, max, mean and the standard quantiles"""
+        result = {
+            'count': self.count,
+            'min': self.min,
+            'max': self.max,
+            'mean': round(self.sum / self.count, 2) if self.count else None
+        }
+        for q in QUANTILES:
+            value = self.quantile(q)
+            result[f'p{round(q * 100)}'] = round(value, 2) if value is not None else None
+        return result
+
+    def to_json(self):
+        return json.dumps({
+            'a': self.relative_accuracy,
+            'p': self.positive,
+            'n': self.negative,
+            'z': self.zero_count,
+            'c': self.count,
+            's': self.sum,
+            'min': self.min,
+            'max': self.max
+        }, separators=(',', ':'))
+
+    @classmethod
+    def from_json(cls, text):
+        data = json.loads(text)
+        sketch = cls(data['a'])
+        sketch.positive = {int(k): v for k, v in data['p'].items()}
+        sketch.negative = {int(k): v for k, v in data['n'].items()}
+        sketch.zero_count = data['z']
+        sketch.count = data['c']
+        sketch.sum = data['s']
+        sketch.min = data['min']
+        sketch.max = data['max']
+        return sketch
+
+
+class FleetTelemetry:
+    """
+    Heartbeat metric aggregation
+
+    Samples are added to in-memory sketches and written every `flush_interval`
+    seconds as partial sketches (append-only, so several workers can write the same
+    interval); queries merge the partials.
+    """
+
+    def __init__(self, interval=300, flush_interval=30.0, retention=30 * DAY, relative_accuracy=0.01):
+        self.interval = interval
+        self.flush_interval = flush_interval
+        self.retention = retention
+        self.relative_accuracy = relative_accuracy
+        self._sketches = {}  # (metric, bucket, firmware_version, device_type) -> QuantileSketch
+        self._last_retention = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def record(self, firmware_version, device_type, free_heap=None, wifi_rssi=None, uptime=None, ts=None):
+        """
+        Add one heartbeat's metrics; non-numeric values are ignored
+
+        Returns:
+            int: Number of metrics recorded
+        """
+        ts = int(ts if ts is not None else time.time())
+        bucket = ts - ts % self.interval
+        group = (firmware_version or 'unknown', device_type or 'unknown')
+        values = {'free_heap': free_heap, 'wifi_rssi': wifi_rssi, 'uptime': uptime}
+        recorded = 0
+        with self._lock:
+            for metric, value in values.items():
+                if not is_metric(value):
+                    continue
+                key = (metric, bucket) + group
+                sketch = self._sketches.get(key)
+                if sketch is None:
+                    sketch = self._sketches[key] = QuantileSketch(self.relative_accuracy)
+                sketch.add(value)
+                recorded += 1
+        return recorded
+
+    def flush(self):
+        """
+        Write the pending sketches
+
+        Returns:
+            int: Number of sketch rows written
+        """
+        with self._lock:
+            if not self._sketches:
+                return 0
+            pending, self._sketches = self._sketches, {}
+
+        try:
+            db.session.add_all([
+                FleetTelemetrySketch(
+                    metric=metric,
+                    bucket=bucket,
+                    firmware_version=firmware_version,
+                    device_type=device_type,
+                    count=sketch.count,
+                    sketch=sketch.to_json()
+                )
+                for (metric, bucket, firmware_version, device_type), sketch in pending.items()
+            ])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Fleet telemetry flush failed: {e}")
+            # Merge the samples back so they are written next time
+            with self._lock:
+                for key, sketch in pending.items():
+                    current = self._sketches.get(key)
+                    self._sketches[key] = sketch.merge(current) if current else sketch
+            return 0
+        return len(pending)
+
+    def apply_retention(self, now=None):
+        """Delete sketches older than the retention window"""
+        if not self.retention:
+            return 0
+        cutoff = int(now if now is not None else time.time()) - self.retention
+        result = db.session.execute(delete(FleetTelemetrySketch).where(FleetTelemetrySketch.bucket < cutoff))
+        db.session.commit()
+        return result.rowcount
+
+    def _rows(self, metric, start, end, firmware_version=None, device_type=None):
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric '{metric}'")
+        if start > end:
+            raise ValueError("start must not be after end")
+        t = FleetTelemetrySketch
+        stmt = select(t.bucket, t.firmware_version, t.device_type, t.sketch).where(
+            t.metric == metric,
+            t.bucket >= start - start % self.interval,
+            t.bucket <= end
+        )
+        if firmware_version:
+            stmt = stmt.where(t.firmware_version == firmware_version)
+        if device_type:
+            stmt = stmt.where(t.device_type == device_type)
+        return db.session.execute(stmt).all()
+
+    def summary(self, metric, start, end, firmware_version=None, device_type=None):
+        """
+        Quantiles of a metric over a time range per firmware version and device type
+
+        Returns:
+            list: One dict per group, newest firmware first
+        """
+        merged = {}
+        for _, version, dtype, text in self._rows(metric, start, end, firmware_version, device_type):
+            sketch = QuantileSketch.from_json(text)
+            group = (version, dtype)
+            merged[group] = merged[group].merge(sketch) if group in merged else sketch
+        groups = [
+            dict(firmware_version=version, device_type=dtype, **sketch.summary())
+            for (version, dtype), sketch in merged.items()
+        ]
+        groups.sort(key=lambda g: (g['device_type'], _version_key(g['firmware_version'])), reverse=True)
+        return groups
+
+    def timeseries(self, metric, start, end, firmware_version=None, device_type=None, resolution=None):
+        """
+        Quantiles of a metric per interval, one series per firmware version
+
+        Args:
+            resolution: Point width in seconds (a multiple of the interval, default the interval)
+
+        Returns:
+            dict: firmware_version -> list of points ordered by time
+        """
+        resolution = max(self.interval, (resolution or self.interval) // self.interval * self.interval)
+        merged = {}
+        for bucket, version, _, text in self._rows(metric, start, end, firmware_version, device_type):
+            key = (version, bucket - bucket % resolution)
+            sketch = QuantileSketch.from_json(text)
+            merged[key] = merged[key].merge(sketch) if key in merged else sketch
+        series = {}
+        for (version, bucket), sketch in sorted(merged.items(), key=lambda item: item[0][1]):
+            series.setdefault(version, []).append(dict(ts=bucket, **sketch.summary()))
+        return series
+
+    def run_once(self):
+        self.flush()
+        now = time.time()
+        if now - self._last_retention < HOUR:
+            return
+        self._last_retention = now
+        try:
+            self.apply_retention(now)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Fleet telemetry retention failed: {e}")
+
+    def start(self, app):
+        """Start the background writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                with app.app_context():
+                    self.run_once()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='fleet-telemetry', daemon=True)
+        self._thread.start()
+
+    def stop(self, app=None):
+        """Stop the writer thread, writing anything still pending"""
+        self._stop.set()
+        if app is not None:
+            with app.app_context():
+                self.flush()
+
+
+def _version_key(version):
+    """Sort key that orders 1.10.0 after 1.9.0 and tolerates non-numeric versions"""
+    return tuple((0, int(part)) if part.isdigit() else (1, part) for part in str(version).split('.'))
@@ -0,0 +1,169 @@
+"""
+Durable Forced Update Queue
+Forced firmware updates stored in the database so every worker process sees them
+"""
+
+import json
+import threading
+import logging
+from functools import wraps
+from datetime import datetime, timedelta
+from sqlalchemy import update
+
+from models import db, ForcedUpdate, StateGeneration
+
+logger = logging.getLogger(__name__)
+
+
+def _rollback_on_error(method):
+    """Leave the session usable for the caller if a queue write fails"""
+    @wraps(method)
+    def wrapper(*args, **kwargs):
+        try:
+            return method(*args, **kwargs)
+        except Exception:
+            db.session.rollback()
+            raise
+    return wrapper
+
+
+class ForcedUpdateStore:
+    """
+    Forced updates with a TTL and pending -> delivered -> acknowledged states
+
+    Each worker keeps the set of device ids with open forced updates and only
+    reloads it when the shared generation counter moves, so the common OTA
+    check (no forced update for this device) costs one primary-key lookup.
+    """
+
+    GENERATION_NAME = 'forced_updates'
+
+    def __init__(self, ttl_seconds=86400):
+        self.ttl_seconds = ttl_seconds
+        self._generation = None
+        self._pending = frozenset()
+        self._delivered = frozenset()
+        self._lock = threading.Lock()
+
+    def _read_generation(self):
+        row = db.session.get(StateGeneration, self.GENERATION_NAME)
+        return row.generation if row else 0
+
+    def _bump_generation(self):
+        """Increment the shared generation inside the current transaction"""
+        updated = db.session.execute(
+            update(StateGeneration)
+            .where(StateGeneration.name == self.GENERATION_NAME)
+            .values(generation=StateGeneration.generation + 1)
+        ).rowcount
+        if not updated:
+            db.session.add(StateGeneration(name=self.GENERATION_NAME, generation=1))
+
+    def _refresh(self):
+        """Reload the open device sets if another writer changed the queue"""
+        generation = self._read_generation()
+        if generation == self._generation:
+            return
+
+        rows = db.session.query(ForcedUpdate.device_id, ForcedUpdate.status).filter(
+            ForcedUpdate.status.in_(['pending', 'delivered'])
+        ).all()
+        with self._lock:
+            self._pending = frozenset(device_id for device_id, status in rows if status == 'pending')
+            self._delivered = frozenset(device_id for device_id, status in rows if status == 'delivered')
+            self._generation = generation
+
+    @_rollback_on_error
+    def set(self, device_id, update_info):
+        """Queue a forced update for a device, replacing any previous one"""
+        now = datetime.utcnow()
+        ForcedUpdate.query.filter_by(device_id=device_id).delete()
+        # Expired entries will never be served; drop them while we hold the write lock
+        ForcedUpdate.query.filter(
+            ForcedUpdate.status == 'pending',
+            ForcedUpdate.expires_at <= now
+        ).delete()
+        db.session.add(ForcedUpdate(
+            device_id=device_id,
+            version=update_info['version'],
+            update_info=json.dumps(update_info),
+            status='pending',
+            created_at=now,
+            expires_at=now + timedelta(seconds=self.ttl_seconds)
+        ))
+        self._bump_generation()
+        db.session.commit()
+
+    @_rollback_on_error
+    def claim(self, device_id):
+        """
+        Atomically take a pending forced update for delivery
+
+        Returns:
+            dict or None: The update info, or None if nothing is pending
+        """
+        self._refresh()
+        if device_id not in self._pending:
+            return None
+
+        now = datetime.utcnow()
+        claimed = db.session.execute(
+            update(ForcedUpdate)
+            .where(
+                ForcedUpdate.device_id == device_id,
+                ForcedUpdate.status == 'pending',
+                ForcedUpdate.expires_at > now
+            )
+            .values(status='delivered', delivered_at=now)
+        ).rowcount
+        if not claimed:
+            # Expired, or another worker delivered it first
+            db.session.commit()
+            return None
+
+        row = ForcedUpdate.query.filter_by(device_id=device_id).first()
+        self._bump_generation()
+        db.session.commit()
+        return json.loads(row.update_info)
+
+    @_rollback_on_error
+    def acknowledge(self, device_id, version):
+        """Mark a delivered forced update as installed once the device reports its version"""
+        self._refresh()
+        if device_id not in self._delivered:
+            return False
+
+        acknowledged = db.session.execute(
+            update(ForcedUpdate)
+            .where(
+                ForcedUpdate.device_id == device_id,
+                ForcedUpdate.status == 'delivered',
+                ForcedUpdate.version == version
+            )
+            .values(status='acknowledged', acknowledged_at=datetime.utcnow())
+        ).rowcount
+        if acknowledged:
+            self._bump_generation()
+        db.session.commit()
+        return bool(acknowledged)
+
+    @_rollback_on_error
+    def clear(self, device_id):
+        """Remove a not-yet-delivered forced update"""
+        deleted = ForcedUpdate.query.filter_by(device_id=device_id, status='pending').delete()
+        if deleted:
+            self._bump_generation()
+        db.session.commit()
+        return bool(deleted)
+
+    def get_pending(self):
+        """Get all forced updates still waiting for their device"""
+        rows = ForcedUpdate.query.filter(
+            ForcedUpdate.status == 'pending',
+            ForcedUpdate.expires_at > datetime.utcnow()
+        ).all()
+        return {row.device_id: json.loads(row.update_info) for row in rows}
+
+    def get_all(self):
+        """Get every forced update record with its delivery state"""
+        return [row.to_dict() for row in ForcedUpdate.query.order_by(ForcedUpdate.created_at.desc()).all()]
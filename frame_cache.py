@@ -0,0 +1,192 @@
+"""
+Dashboard Frame Cache
+Keeps recently rendered frames in memory so serving a dashboard is a dictionary
+lookup instead of a file read. Frames are keyed by file path and content hash,
+and each lookup checks the file's stat signature, so a frame re-rendered by
+another worker process is picked up from disk. Disk remains the persistence
+layer and the fallback on a miss.
+"""
+
+import os
+import io
+import gzip
+import hashlib
+import logging
+import threading
+from collections import OrderedDict, namedtuple
+
+from PIL import Image
+from werkzeug.http import parse_accept_header
+
+logger = logging.getLogger(__name__)
+
+VARIANTS = ('bmp', 'gzip', 'raw')
+
+Frame = namedtuple('Frame', ['data', 'digest', 'mtime'])
+
+
+def frame_variant(format_arg, accept_encoding):
+    """
+    Pick the encoding to serve for a request
+
+    Gzip is only chosen when the client gives it a non-zero quality, so
+    "gzip;q=0" or "identity;q=1,*;q=0" (arduino-esp32's default) get the plain BMP.
+
+    Args:
+        format_arg: The ?format= query argument
+        accept_encoding: Raw Accept-Encoding header, or None
+
+    Returns:
+        str: One of VARIANTS
+    """
+    if format_arg == 'raw':
+        return 'raw'
+    return 'gzip' if parse_accept_header(accept_encoding)['gzip'] > 0 else 'bmp'
+
+
+def _signature(stat):
+    return (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+
+class _Entry:
+    """One frame's encodings"""
+    __slots__ = ('variants', 'size')
+
+    def __init__(self, data):
+        self.variants = {'bmp': data}
+        self.size = len(data)
+
+
+class FrameCache:
+    """
+    Size-bounded LRU of encoded frames
+
+    Frames are stored once per content hash; a dashboard's current and fallback
+    files (and identical frames of different devices) share one entry.
+    """
+
+    def __init__(self, max_bytes=128 * 1024 * 1024, max_frame_bytes=2 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.max_frame_bytes = max_frame_bytes
+        self._frames = OrderedDict()  # digest -> _Entry, least recently used first
+        self._paths = {}  # path -> (stat signature, digest, mtime) of the frame last seen there
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self._stats = {'hits': 0, 'misses': 0, 'stale': 0, 'evictions': 0}
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('FRAME_CACHE_MAX_BYTES', 128 * 1024 * 1024))
+
+    @property
+    def enabled(self):
+        return self.max_bytes > 0
+
+    def put(self, path, data, digest=None):
+        """Cache the frame just written to path"""
+        if not self.enabled or len(data) > self.max_frame_bytes:
+            return
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return
+        digest = digest or hashlib.sha256(data).hexdigest()
+        with self._lock:
+            self._paths[path] = (_signature(stat), digest, stat.st_mtime)
+            self._add(digest, data)
+
+    def _add(self, digest, data):
+        entry = self._frames.get(digest)
+        if entry is not None:
+            self._frames.move_to_end(digest)
+            return entry
+        entry = self._frames[digest] = _Entry(data)
+        self._bytes += entry.size
+        self._evict()
+        return entry
+
+    def _evict(self):
+        while self._bytes > self.max_bytes and len(self._frames) > 1:
+            _, evicted = self._frames.popitem(last=False)
+            self._bytes -= evicted.size
+            self._stats['evictions'] += 1
+
+    def get(self, path, variant='bmp'):
+        """
+        A frame from memory, or read from disk (and cached) if it isn't current there
+
+        Args:
+            path: The frame's file
+            variant: 'bmp', 'gzip' (gzip-compressed BMP) or 'raw' (packed 1-bit pixels)
+
+        Returns:
+            Frame or None if the file doesn't exist
+        """
+        if variant not in VARIANTS:
+            raise ValueError(f"Unknown frame variant: {variant}")
+        path = os.path.abspath(path)
+        try:
+            stat = os.stat(path)
+        except OSError:
+            return None
+        signature = _signature(stat)
+        with self._lock:
+            known = self._paths.get(path)
+            entry = self._frames.get(known[1]) if known and known[0] == signature else None
+            if entry is not None:
+                self._frames.move_to_end(known[1])
+                self._stats['hits'] += 1
+                data = entry.variants.get(variant)
+                if data is not None:
+                    return Frame(data, known[1], known[2])
+            else:
+                if known and known[0] != signature:
+                    self._stats['stale'] += 1  # Re-rendered by another process
+                self._stats['misses'] += 1
+
+        if entry is None:
+            try:
+                with open(path, 'rb') as frame_file:
+                    data = frame_file.read()
+            except OSError:
+                return None
+            known = (signature, hashlib.sha256(data).hexdigest(), stat.st_mtime)
+            if self.enabled and len(data) <= self.max_frame_bytes:
+                with self._lock:
+                    self._paths[path] = known
+                    entry = self._add(known[1], data)
+            else:
+                entry = _Entry(data)
+        if variant == 'bmp':
+            return Frame(entry.variants['bmp'], known[1], known[2])
+
+        data = self._encode(entry.variants['bmp'], variant)
+        with self._lock:
+            if self._frames.get(known[1]) is entry and variant not in entry.variants:
+                entry.variants[variant] = data
+                entry.size += len(data)
+                self._bytes += len(data)
+                self._evict()
+        return Frame(data, known[1], known[2])
+
+    @staticmethod
+    def _encode(bmp, variant):
+        if variant == 'gzip':
+            return gzip.compress(bmp, compresslevel=6, mtime=0)
+        with Image.open(io.BytesIO(bmp)) as img:
+            return (img if img.mode == '1' else img.convert('1')).tobytes()
+
+    def get_status(self):
+        """Hit rate, memory use and evictions"""
+        with self._lock:
+            lookups = self._stats['hits'] + self._stats['misses']
+            return {
+                'enabled': self.enabled,
+                'frames': len(self._frames),
+                'paths': len(self._paths),
+                'bytes': self._bytes,
+                'max_bytes': self.max_bytes,
+                **self._stats,
+                'hit_rate': round(self._stats['hits'] / lookups, 3) if lookups else None
+            }
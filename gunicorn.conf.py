@@ -0,0 +1,37 @@
+"""
+Gunicorn settings for PersonalCMS (gunicorn -c gunicorn.conf.py wsgi:app)
+Every value can be overridden with the PERSONALCMS_* environment variables below
+"""
+
+import os
+import multiprocessing
+
+bind = os.environ.get('PERSONALCMS_BIND', '0.0.0.0:5000')
+
+# SQLite takes one writer at a time, so more processes than this only queue on its
+# lock; threads cover the I/O-bound work (slow WiFi clients, firmware streams)
+workers = int(os.environ.get('PERSONALCMS_WORKERS', min(multiprocessing.cpu_count() * 2 + 1, 8)))
+worker_class = 'gthread'
+threads = int(os.environ.get('PERSONALCMS_THREADS', 8))
+
+# Firmware downloads to ESP32s on weak WiFi can take a while
+timeout = int(os.environ.get('PERSONALCMS_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to cap slow growth from image processing
+max_requests = int(os.environ.get('PERSONALCMS_MAX_REQUESTS', 5000))
+max_requests_jitter = 500
+
+# Each worker builds its own services; see post_fork for preload_app
+preload_app = os.environ.get('PERSONALCMS_PRELOAD', '0') == '1'
+
+accesslog = os.environ.get('PERSONALCMS_ACCESS_LOG')  # e.g. '-' for stdout
+errorlog = '-'
+loglevel = os.environ.get('PERSONALCMS_LOG_LEVEL', 'info')
+
+
+def post_fork(server, worker):
+    """With preload_app the master built the services; give the worker its own"""
+    from unified_cms import create_app
+    create_app()
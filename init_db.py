@@ -13,7 +13,8 @@ project_dir = Path(__file__).parent
 sys.path.insert(0, str(project_dir))
 
 try:
-    from unified_cms import app, db
+    from unified_cms import create_app, db
+    app = create_app()
     from models import Device, DeviceContent, DefaultContent
     
     def init_database():
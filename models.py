@@ -5,12 +5,15 @@ import logging
 import random
 import json
 import os
+import io
 import requests
 from datetime import datetime, timedelta
 from PIL import Image, ImageDraw, ImageFont
 from flask_sqlalchemy import SQLAlchemy
 from typing import Dict
 
+from atomic_files import atomic_write, publish_blob, BLOB_DIR, FSYNC_FILE
+
 # Initialize SQLAlchemy
 db = SQLAlchemy()
 
@@ -173,9 +176,146 @@ class DefaultContent(db.Model):
         }
 
 
+class ForcedUpdate(db.Model):
+    __tablename__ = 'forced_updates'
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(255), unique=True, nullable=False, index=True)
+    version = db.Column(db.String(50), nullable=False)
+    update_info = db.Column(db.Text, nullable=False)  # JSON string served to the device
+    status = db.Column(db.String(20), default='pending', nullable=False, index=True)  # pending, delivered, acknowledged
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    expires_at = db.Column(db.DateTime, nullable=False, index=True)
+    delivered_at = db.Column(db.DateTime)
+    acknowledged_at = db.Column(db.DateTime)
+    
+    def to_dict(self):
+        return {
+            'device_id': self.device_id,
+            'version': self.version,
+            'update_info': json.loads(self.update_info) if self.update_info else {},
+            'status': self.status,
+            'created_at': self.created_at.isoformat() if self.created_at else None,
+            'expires_at': self.expires_at.isoformat() if self.expires_at else None,
+            'delivered_at': self.delivered_at.isoformat() if self.delivered_at else None,
+            'acknowledged_at': self.acknowledged_at.isoformat() if self.acknowledged_at else None
+        }
+
+
+class FirmwareDownloadCount(db.Model):
+    __tablename__ = 'firmware_download_counts'
+    
+    firmware_key = db.Column(db.String(255), primary_key=True)
+    download_count = db.Column(db.Integer, default=0, nullable=False)
+    last_download = db.Column(db.DateTime)
+
+
+class StateGeneration(db.Model):
+    """Shared change counters so worker processes can cheaply detect stale caches"""
+    __tablename__ = 'state_generations'
+    
+    name = db.Column(db.String(100), primary_key=True)
+    generation = db.Column(db.Integer, default=0, nullable=False)
+
+
+class SensorReading(db.Model):
+    """Raw sensor history, append-only and compactly typed"""
+    __tablename__ = 'sensor_readings'
+    __table_args__ = (db.Index('ix_sensor_readings_device_ts', 'device_pk', 'ts'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    device_pk = db.Column(db.Integer, nullable=False)  # Device.id
+    ts = db.Column(db.Integer, nullable=False, index=True)  # Unix seconds (UTC)
+    temperature_centi = db.Column(db.SmallInteger)  # Degrees C x 100
+    humidity_centi = db.Column(db.SmallInteger)  # Percent x 100
+    flags = db.Column(db.SmallInteger, default=0, nullable=False)  # bit 0 motion, bit 1 sleep mode
+
+
+class SensorRollup(db.Model):
+    """Min/max/sum aggregates of sensor readings per device and time bucket"""
+    __tablename__ = 'sensor_rollups'
+    
+    device_pk = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.Integer, primary_key=True)  # Bucket width in seconds (60, 3600, 86400)
+    bucket = db.Column(db.Integer, primary_key=True, index=True)  # Bucket start, unix seconds
+    count = db.Column(db.Integer, nullable=False)
+    temperature_count = db.Column(db.Integer, default=0, nullable=False)
+    temperature_min = db.Column(db.Integer)
+    temperature_max = db.Column(db.Integer)
+    temperature_sum = db.Column(db.Integer)
+    humidity_count = db.Column(db.Integer, default=0, nullable=False)
+    humidity_min = db.Column(db.Integer)
+    humidity_max = db.Column(db.Integer)
+    humidity_sum = db.Column(db.Integer)
+    motion_count = db.Column(db.Integer, default=0, nullable=False)
+    sleep_count = db.Column(db.Integer, default=0, nullable=False)
+
+
+
+class FleetTelemetrySketch(db.Model):
+    """Partial quantile sketch of one heartbeat metric per firmware build, device type and interval"""
+    __tablename__ = 'fleet_telemetry_sketches'
+    __table_args__ = (db.Index('ix_fleet_telemetry_metric_bucket', 'metric', 'bucket'),)
+    
+    id = db.Column(db.Integer, primary_key=True)
+    metric = db.Column(db.String(30), nullable=False)  # free_heap, wifi_rssi, uptime
+    bucket = db.Column(db.Integer, nullable=False)  # Interval start, unix seconds
+    firmware_version = db.Column(db.String(50), nullable=False)
+    device_type = db.Column(db.String(100), nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    sketch = db.Column(db.Text, nullable=False)  # JSON, see fleet_telemetry.QuantileSketch
+
+
+class RolloutDeviceState(db.Model):
+    """Last heartbeat the rollout guard saw from a device, shared by every worker"""
+    __tablename__ = 'rollout_device_states'
+    __table_args__ = (db.Index('ix_rollout_device_states_version_heartbeat', 'firmware_version', 'last_heartbeat'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(255), unique=True, nullable=False)
+    firmware_version = db.Column(db.String(50), nullable=False)
+    uptime = db.Column(db.Float)  # Seconds, as reported
+    last_heartbeat = db.Column(db.Float, nullable=False)  # Unix seconds
+
+
+class RolloutHealthSample(db.Model):
+    """Partial heartbeat health counts of one firmware build and minute (one row per worker flush)"""
+    __tablename__ = 'rollout_health_samples'
+    __table_args__ = (db.Index('ix_rollout_health_version_minute', 'firmware_version', 'minute'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    firmware_version = db.Column(db.String(50), nullable=False)
+    minute = db.Column(db.Integer, nullable=False)  # Unix minutes
+    heartbeats = db.Column(db.Integer, nullable=False)
+    reboots = db.Column(db.Integer, nullable=False)
+    intervals = db.Column(db.Integer, nullable=False)
+    gaps = db.Column(db.Integer, nullable=False)
+    heap = db.Column(db.Text, nullable=False)  # JSON, see fleet_telemetry.QuantileSketch
+
+
+class ContentVersion(db.Model):
+    """Change counter of a device's content ('*' counts fleet-wide changes)"""
+    __tablename__ = 'content_versions'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(255), unique=True, nullable=False)
+    version = db.Column(db.Integer, nullable=False, default=0)
+    changed_at = db.Column(db.Float, nullable=False, index=True)  # Unix seconds, for change polling
+
+
+class DeviceIngestKey(db.Model):
+    """HMAC key a device signs UDP heartbeat/sensor datagrams with (reissued on registration)"""
+    __tablename__ = 'device_ingest_keys'
+
+    id = db.Column(db.Integer, primary_key=True)
+    device_id = db.Column(db.String(255), unique=True, nullable=False)
+    secret = db.Column(db.String(64), nullable=False)  # Hex, 32 bytes
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
 # Content Management System
 class PerDeviceCMS:
-    def __init__(self):
+    def __init__(self, single_flight=None):
+        self.single_flight = single_flight  # Shares concurrent fetches of the same API
         self.default_content_sources = {
             'jokes': {
                 'dad_jokes': self._get_dad_jokes,
@@ -253,6 +393,13 @@ class PerDeviceCMS:
         return device_content
     
     def _get_api_content(self, category: str, subcategory: str):
+        """Fetch content from API endpoints, joining a fetch of the same API already in progress"""
+        if self.single_flight is None:
+            return self._fetch_api_content(category, subcategory)
+        return self.single_flight.do(('api', category, subcategory), self._fetch_api_content,
+                                     category, subcategory, cross_process=False)
+    
+    def _fetch_api_content(self, category: str, subcategory: str):
         """Fetch content from API endpoints"""
         try:
             # Find API endpoint for this category/subcategory
@@ -264,45 +411,11 @@ class PerDeviceCMS:
             if not api_endpoint:
                 return None
             
-            # Prepare headers
-            headers = {}
-            if api_endpoint.headers:
-                try:
-                    headers = json.loads(api_endpoint.headers)
-                except:
-                    pass
-            
-            # Add API key if available
-            if api_endpoint.api_key:
-                if api_endpoint.api_key.startswith('Bearer '):
-                    headers['Authorization'] = api_endpoint.api_key
-                else:
-                    headers['Authorization'] = f'Bearer {api_endpoint.api_key}'
-            
             # Make API request
-            response = requests.get(api_endpoint.api_url, headers=headers, timeout=10)
+            response = requests.get(api_endpoint.api_url, headers=self.api_headers(api_endpoint), timeout=10)
             response.raise_for_status()
             
-            data = response.json()
-            
-            # Extract content using JSONPath if specified
-            if api_endpoint.response_path and JSONPATH_AVAILABLE:
-                jsonpath_expr = jsonpath_parse(api_endpoint.response_path)
-                matches = [match.value for match in jsonpath_expr.find(data)]
-                content = matches[:10]  # Limit to 10 items
-            else:
-                # Try to extract content from common response structures
-                if isinstance(data, list):
-                    content = data[:10]
-                elif isinstance(data, dict):
-                    if 'data' in data and isinstance(data['data'], list):
-                        content = data['data'][:10]
-                    elif 'items' in data and isinstance(data['items'], list):
-                        content = data['items'][:10]
-                    else:
-                        content = [data]
-                else:
-                    content = [str(data)]
+            content = self.extract_api_content(api_endpoint, response.json())
             
             # Update API statistics
             api_endpoint.success_count += 1
@@ -319,6 +432,44 @@ class PerDeviceCMS:
                 db.session.commit()
             return None
     
+    @staticmethod
+    def api_headers(api_endpoint):
+        """Request headers for a content API, including its key"""
+        headers = {}
+        if api_endpoint.headers:
+            try:
+                headers = json.loads(api_endpoint.headers)
+            except:
+                pass
+        
+        # Add API key if available
+        if api_endpoint.api_key:
+            if api_endpoint.api_key.startswith('Bearer '):
+                headers['Authorization'] = api_endpoint.api_key
+            else:
+                headers['Authorization'] = f'Bearer {api_endpoint.api_key}'
+        return headers
+    
+    @staticmethod
+    def extract_api_content(api_endpoint, data):
+        """Pick up to 10 content items out of a content API response"""
+        # Extract content using JSONPath if specified
+        if api_endpoint.response_path and JSONPATH_AVAILABLE:
+            jsonpath_expr = jsonpath_parse(api_endpoint.response_path)
+            matches = [match.value for match in jsonpath_expr.find(data)]
+            return matches[:10]  # Limit to 10 items
+        
+        # Try to extract content from common response structures
+        if isinstance(data, list):
+            return data[:10]
+        if isinstance(data, dict):
+            if 'data' in data and isinstance(data['data'], list):
+                return data['data'][:10]
+            if 'items' in data and isinstance(data['items'], list):
+                return data['items'][:10]
+            return [data]
+        return [str(data)]
+    
     def _get_default_content_items(self, category: str, subcategory: str):
         """Get default content items from database for given category/subcategory"""
         try:
@@ -337,31 +488,34 @@ class PerDeviceCMS:
                     is_active=True
                 ).order_by(DefaultContent.created_at.desc()).limit(10).all()
             
-            # Convert to format expected by content system
-            content_items = []
-            for item in items:
-                if category == 'jokes':
-                    content_items.append(item.content)
-                elif category == 'riddles':
-                    content_items.append({
-                        'question': item.question or item.content,
-                        'answer': item.answer or 'No answer provided'
-                    })
-                elif category == 'news':
-                    content_items.append({
-                        'title': item.title or 'No title',
-                        'content': item.content,
-                        'url': item.url
-                    })
-                else:
-                    content_items.append(item.content)
-            
-            return content_items
+            return self.format_default_items(category, items)
             
         except Exception as e:
             logger.error(f"Error fetching default content for {category}/{subcategory}: {str(e)}")
             return []
     
+    @staticmethod
+    def format_default_items(category, items):
+        """Convert DefaultContent rows to the format expected by the content system"""
+        content_items = []
+        for item in items:
+            if category == 'jokes':
+                content_items.append(item.content)
+            elif category == 'riddles':
+                content_items.append({
+                    'question': item.question or item.content,
+                    'answer': item.answer or 'No answer provided'
+                })
+            elif category == 'news':
+                content_items.append({
+                    'title': item.title or 'No title',
+                    'content': item.content,
+                    'url': item.url
+                })
+            else:
+                content_items.append(item.content)
+        return content_items
+    
     # Default content generators
     def _get_dad_jokes(self, count=5):
         jokes = [
@@ -438,7 +592,7 @@ class PerDeviceCMS:
 # Image Processing
 class ImageProcessor:
     @staticmethod
-    def convert_to_bmp(image_path: str, output_path: str, size: tuple = (800, 480)) -> bool:
+    def convert_to_bmp(image_path: str, output_path: str, size: tuple = (800, 480), fsync: str = FSYNC_FILE) -> bool:
         """Convert uploaded image to monochrome BMP format for ESP32 display with dithering"""
         try:
             with Image.open(image_path) as img:
@@ -451,8 +605,8 @@ class ImageProcessor:
                 img = img.convert('L')
                 # Convert to 1-bit monochrome with Floyd-Steinberg dithering
                 img = img.convert('1', dither=Image.Dither.FLOYDSTEINBERG)
-                # Save as BMP
-                img.save(output_path, 'BMP')
+                # Save as BMP (atomically, it may be being served)
+                atomic_write(output_path, ImageProcessor.encode_bmp(img), fsync)
                 return True
         except Exception as e:
             logger.error(f"Image conversion failed: {e}")
@@ -461,6 +615,16 @@ class ImageProcessor:
     @staticmethod
     def generate_dashboard(device: Device, content: Dict, size: tuple = (800, 480), app_config=None) -> str:
         """Generate monochrome dashboard image for device"""
+        return ImageProcessor.generate_dashboard_frame(device, content, size, app_config)[0]
+    
+    @staticmethod
+    def generate_dashboard_frame(device: Device, content: Dict, size: tuple = (800, 480), app_config=None) -> tuple:
+        """
+        Generate a device's dashboard and keep the encoded frame
+        
+        Returns:
+            tuple: (current dashboard path, BMP bytes, SHA-256 hex of the bytes)
+        """
         # Create monochrome image (1-bit black and white)
         img = Image.new('1', size, 1)  # 1 = white background in 1-bit mode
         draw = ImageDraw.Draw(img)
@@ -575,10 +739,20 @@ class ImageProcessor:
         current_path = os.path.join(dashboard_folder, f"{device.device_id}_current.bmp")
         fallback_path = os.path.join(dashboard_folder, f"{device.device_id}_fallback.bmp")
         
-        img.save(current_path, 'BMP')
-        img.save(fallback_path, 'BMP')  # Same image for both for now
+        # Same image for both for now: encoded once, hardlinked into place
+        fsync = app_config.get('FRAME_FSYNC', FSYNC_FILE) if app_config else FSYNC_FILE
+        data = ImageProcessor.encode_bmp(img)
+        digest = publish_blob(data, [current_path, fallback_path],
+                              os.path.join(dashboard_folder, BLOB_DIR), suffix='.bmp', fsync=fsync)
         
-        return current_path
+        return current_path, data, digest
+    
+    @staticmethod
+    def encode_bmp(img) -> bytes:
+        """Image encoded as a BMP file in memory"""
+        buffer = io.BytesIO()
+        img.save(buffer, 'BMP')
+        return buffer.getvalue()
 
     @staticmethod
     def generate_fallback(device: Device, size: tuple = (800, 480), app_config=None) -> str:
@@ -608,30 +782,34 @@ class ImageProcessor:
             os.makedirs(dashboard_folder, exist_ok=True)
             
         output_path = os.path.join(dashboard_folder, f"{device.device_id}_fallback.bmp")
-        img.save(output_path, 'BMP')
+        fsync = app_config.get('FRAME_FSYNC', FSYNC_FILE) if app_config else FSYNC_FILE
+        atomic_write(output_path, ImageProcessor.encode_bmp(img), fsync)
         return output_path
 
 
 # Utility functions
-def refresh_device_activity_statuses(timeout_seconds: int = None) -> int:
+def refresh_device_activity_statuses(timeout_seconds: int = None, now: datetime = None) -> int:
     """Update Device.is_active based on last_seen age.
 
     Returns the number of devices updated. A device is considered active if
-    last_seen is within the configured timeout window.
+    last_seen is within the configured timeout window. Only rows whose status
+    changes are touched, using the last_seen index.
     """
     try:
         window = timeout_seconds or 300  # Default 5 minutes
-        cutoff = datetime.utcnow() - timedelta(seconds=window)
-        updated = 0
-        devices = Device.query.all()
-        for d in devices:
-            was_active = bool(d.is_active)
-            is_now_active = bool(d.last_seen and d.last_seen > cutoff)
-            if was_active != is_now_active:
-                d.is_active = is_now_active
-                updated += 1
-        if updated:
-            db.session.commit()
+        cutoff = (now or datetime.utcnow()) - timedelta(seconds=window)
+        devices = Device.__table__
+        went_offline = devices.update().where(
+            devices.c.is_active.is_(True),
+            db.or_(devices.c.last_seen.is_(None), devices.c.last_seen <= cutoff)
+        ).values(is_active=False)
+        came_online = devices.update().where(
+            db.or_(devices.c.is_active.is_(False), devices.c.is_active.is_(None)),
+            devices.c.last_seen > cutoff
+        ).values(is_active=True)
+        updated = db.session.execute(went_offline).rowcount + db.session.execute(came_online).rowcount
+        db.session.commit()
         return updated
     except Exception:
+        db.session.rollback()
         return 0
\ No newline at end of file
@@ -0,0 +1,328 @@
+"""
+OTA Firmware Delivery Control
+Bandwidth shaping and download slot admission for firmware streams
+"""
+
+import os
+import math
+import asyncio
+import time
+import secrets
+import threading
+import ipaddress
+import logging
+from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """Byte-rate token bucket shared by every stream drawing from the same budget"""
+
+    def __init__(self, rate, burst=None):
+        self.rate = rate
+        self.burst = burst or rate
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def reserve(self, amount):
+        """
+        Take `amount` bytes from the bucket, going into debt if needed
+
+        Returns:
+            float: Seconds the caller should wait before sending the bytes
+        """
+        if not self.rate:
+            return 0.0
+
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= amount
+            if self.tokens >= 0:
+                return 0.0
+            return -self.tokens / self.rate
+
+
+class DownloadLease:
+    """An admitted firmware stream holding one download slot"""
+
+    def __init__(self, governor, client_ip, token_id=None):
+        self.governor = governor
+        self.client_ip = client_ip
+        self.token_id = token_id
+        self.started = time.monotonic()
+        self.expires_at = None
+        self.released = False
+
+    def release(self):
+        """Return the slot to the governor (safe to call more than once)"""
+        if not self.released:
+            self.released = True
+            self.governor._release(self)
+
+    def hold_for(self, seconds):
+        """
+        Keep the slot for an estimated transfer time, then free it automatically
+
+        Used when a proxy streams the bytes and Python never sees the end of the transfer.
+        """
+        if seconds <= 0:
+            self.release()
+        else:
+            self.expires_at = time.monotonic() + seconds
+
+
+class DownloadGovernor:
+    """
+    Admission control for firmware downloads
+
+    The OTA check reserves a slot and hands the device a signed slot token;
+    the download route redeems it. Downloads without a valid token are only
+    admitted when a slot is free and not reserved for someone else.
+    """
+
+    def __init__(self, secret_key, max_streams=8, global_bandwidth=0, subnet_bandwidth=0,
+                 token_ttl=120, chunk_size=16 * 1024, min_retry_after=5, max_retry_after=600):
+        self.max_streams = max_streams
+        self.global_bandwidth = global_bandwidth
+        self.subnet_bandwidth = subnet_bandwidth
+        self.token_ttl = token_ttl
+        self.chunk_size = chunk_size
+        self.min_retry_after = min_retry_after
+        self.max_retry_after = max_retry_after
+
+        self._serializer = URLSafeTimedSerializer(secret_key, salt='ota-download-slot')
+        self._lock = threading.Lock()
+        self._active = set()
+        self._reservations = {}  # token_id -> expiry (monotonic)
+        self._reserved_for = {}  # (device_id, firmware_key) -> token_id
+        self._rejections = []  # monotonic timestamps of recent 503s
+        self._avg_stream_seconds = None
+
+        self._global_bucket = TokenBucket(global_bandwidth)
+        self._subnet_buckets = {}
+
+    @classmethod
+    def from_config(cls, config):
+        """Build a governor from Flask app config"""
+        return cls(
+            secret_key=config['SECRET_KEY'],
+            max_streams=config.get('OTA_MAX_CONCURRENT_DOWNLOADS', 8),
+            global_bandwidth=config.get('OTA_GLOBAL_BANDWIDTH_BPS', 0),
+            subnet_bandwidth=config.get('OTA_SUBNET_BANDWIDTH_BPS', 0),
+            token_ttl=config.get('OTA_SLOT_TOKEN_TTL_SECONDS', 120),
+        )
+
+    def _prune(self, now):
+        """Drop expired reservations, offloaded leases and stale rejection records (lock held)"""
+        for token_id, expiry in list(self._reservations.items()):
+            if expiry <= now:
+                del self._reservations[token_id]
+        for key, token_id in list(self._reserved_for.items()):
+            if token_id not in self._reservations:
+                del self._reserved_for[key]
+        for lease in [l for l in self._active if l.expires_at and l.expires_at <= now]:
+            lease.released = True
+            self._active.discard(lease)
+        window = now - self.token_ttl
+        self._rejections = [t for t in self._rejections if t > window]
+
+    def _has_free_slot(self):
+        return len(self._active) + len(self._reservations) < self.max_streams
+
+    def issue_slot_token(self, device_id, firmware_key):
+        """
+        Reserve a download slot for a device that was just offered an update
+
+        A device re-checking while its reservation is still held gets the same
+        slot back (with a fresh token) rather than reserving another one.
+
+        Returns:
+            str or None: Signed slot token, or None when all slots are taken
+        """
+        now = time.monotonic()
+        key = (device_id, firmware_key)
+        with self._lock:
+            self._prune(now)
+            token_id = self._reserved_for.get(key)
+            if token_id is None:
+                if not self._has_free_slot():
+                    self._rejections.append(now)
+                    return None
+                token_id = self._reserved_for[key] = secrets.token_hex(8)
+            self._reservations[token_id] = now + self.token_ttl
+
+        return self._serializer.dumps({'d': device_id, 'k': firmware_key, 'n': token_id})
+
+    def _verify_token(self, token, firmware_key):
+        """Return the token id for a valid token, otherwise None"""
+        if not token:
+            return None
+        try:
+            payload = self._serializer.loads(token, max_age=self.token_ttl)
+        except SignatureExpired:
+            logger.info(f"Expired download slot token for {firmware_key}")
+            return None
+        except BadSignature:
+            logger.warning(f"Invalid download slot token for {firmware_key}")
+            return None
+        if payload.get('k') != firmware_key:
+            return None
+        return payload.get('n')
+
+    def admit(self, firmware_key, client_ip, token=None):
+        """
+        Try to start a firmware stream
+
+        Returns:
+            DownloadLease or None: Lease when admitted, None when over capacity
+        """
+        token_id = self._verify_token(token, firmware_key)
+        now = time.monotonic()
+
+        with self._lock:
+            self._prune(now)
+            if token_id and self._reservations.pop(token_id, None) is not None:
+                # Reserved slot: converts straight into an active stream
+                self._reserved_for = {key: reserved for key, reserved in self._reserved_for.items()
+                                      if reserved != token_id}
+                lease = DownloadLease(self, client_ip, token_id)
+            elif self._has_free_slot():
+                # Valid token from another worker, or a walk-in download
+                lease = DownloadLease(self, client_ip, token_id)
+            else:
+                self._rejections.append(now)
+                return None
+            self._active.add(lease)
+
+        return lease
+
+    def _release(self, lease):
+        duration = time.monotonic() - lease.started
+        with self._lock:
+            self._active.discard(lease)
+            if self._avg_stream_seconds is None:
+                self._avg_stream_seconds = duration
+            else:
+                self._avg_stream_seconds = 0.8 * self._avg_stream_seconds + 0.2 * duration
+
+    def retry_after(self, file_size=None):
+        """Seconds a refused client should wait, scaled by the current queue depth"""
+        with self._lock:
+            self._prune(time.monotonic())
+            queue_depth = len(self._active) + len(self._reservations) + len(self._rejections)
+            stream_seconds = self._avg_stream_seconds
+
+        if stream_seconds is None:
+            # No completed stream yet: estimate from the per-stream bandwidth share
+            per_stream = self.per_stream_rate()
+            stream_seconds = (file_size or 1024 * 1024) / per_stream if per_stream else 10
+
+        waves = math.ceil(max(queue_depth - self.max_streams + 1, 1) / max(self.max_streams, 1))
+        seconds = math.ceil(waves * stream_seconds)
+        return max(self.min_retry_after, min(self.max_retry_after, seconds))
+
+    def per_stream_rate(self):
+        """Bytes/second one stream gets when every slot is busy (0 = unlimited)"""
+        rates = [r for r in (self.global_bandwidth / max(self.max_streams, 1) if self.global_bandwidth else 0,
+                             self.subnet_bandwidth) if r]
+        return min(rates) if rates else 0
+
+    @staticmethod
+    def _subnet_key(client_ip):
+        try:
+            address = ipaddress.ip_address(client_ip)
+            prefix = 24 if address.version == 4 else 64
+            return ipaddress.ip_network(f"{client_ip}/{prefix}", strict=False)
+        except ValueError:
+            return client_ip
+
+    def _subnet_bucket(self, client_ip):
+        if not self.subnet_bandwidth:
+            return None
+        subnet = self._subnet_key(client_ip)
+
+        with self._lock:
+            bucket = self._subnet_buckets.get(subnet)
+            if bucket is None:
+                # Drop buckets for subnets with no active streams before adding new ones;
+                # a subnet still streaming keeps its bucket so its limit isn't reset
+                if len(self._subnet_buckets) > 4 * self.max_streams:
+                    in_use = {self._subnet_key(lease.client_ip) for lease in self._active}
+                    for idle in [key for key in self._subnet_buckets if key not in in_use]:
+                        del self._subnet_buckets[idle]
+                bucket = self._subnet_buckets[subnet] = TokenBucket(self.subnet_bandwidth)
+            return bucket
+
+    def stream_file(self, lease, filepath, start=0, length=None):
+        """
+        Generator yielding a byte range of a file at the shaped rate
+
+        The lease is released when the generator finishes or is closed.
+        """
+        subnet_bucket = self._subnet_bucket(lease.client_ip)
+        remaining = length if length is not None else os.path.getsize(filepath) - start
+        try:
+            with open(filepath, 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = f.read(min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+
+                    delay = self._global_bucket.reserve(len(chunk))
+                    if subnet_bucket:
+                        delay = max(delay, subnet_bucket.reserve(len(chunk)))
+                    if delay > 0:
+                        time.sleep(delay)
+
+                    yield chunk
+        finally:
+            lease.release()
+
+    async def astream_file(self, lease, filepath, start=0, length=None):
+        """
+        Async variant of stream_file for ASGI servers
+
+        Reads happen in a worker thread and rate shaping awaits instead of
+        sleeping, so a slow client holds no thread. The lease is released when
+        the generator finishes or is closed.
+        """
+        subnet_bucket = self._subnet_bucket(lease.client_ip)
+        remaining = length if length is not None else os.path.getsize(filepath) - start
+        try:
+            with open(filepath, 'rb') as f:
+                f.seek(start)
+                while remaining > 0:
+                    chunk = await asyncio.to_thread(f.read, min(self.chunk_size, remaining))
+                    if not chunk:
+                        break
+                    remaining -= len(chunk)
+
+                    delay = self._global_bucket.reserve(len(chunk))
+                    if subnet_bucket:
+                        delay = max(delay, subnet_bucket.reserve(len(chunk)))
+                    if delay > 0:
+                        await asyncio.sleep(delay)
+
+                    yield chunk
+        finally:
+            lease.release()
+
+    def get_status(self):
+        """Current admission state for diagnostics"""
+        with self._lock:
+            self._prune(time.monotonic())
+            return {
+                'max_streams': self.max_streams,
+                'active_streams': len(self._active),
+                'reserved_slots': len(self._reservations),
+                'recent_rejections': len(self._rejections),
+                'global_bandwidth_bps': self.global_bandwidth,
+                'subnet_bandwidth_bps': self.subnet_bandwidth,
+                'avg_stream_seconds': round(self._avg_stream_seconds, 2) if self._avg_stream_seconds else None
+            }
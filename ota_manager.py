@@ -6,15 +6,83 @@ Handles firmware upload, version management, and update distribution
 import os
 import json
 import hashlib
+import tempfile
+import threading
+from types import MappingProxyType
+from collections.abc import Mapping
 from datetime import datetime
 from werkzeug.utils import secure_filename
 from flask import current_app
 import logging
+from forced_updates import ForcedUpdateStore
+from ota_stats import DownloadCounterStore, OTAStatistics
 
 logger = logging.getLogger(__name__)
 
+# Read/write size for firmware uploads and hashing (binaries are ~1 MB)
+HASH_CHUNK_SIZE = 1024 * 1024
+
+
+class RegistrySnapshot:
+    """
+    Immutable view of the firmware registry at one generation
+    
+    Readers take `ota_manager.snapshot` once and use it for the whole request
+    without locking; writers never touch a published snapshot, they publish a
+    new one. Entry dicts are shared between snapshots and must not be mutated.
+    """
+    
+    __slots__ = ('generation', 'firmware_versions', 'device_assignments', 'settings', 'registry', 'decisions')
+    
+    def __init__(self, generation, firmware_versions, device_assignments=None, settings=None):
+        self.generation = generation
+        self.firmware_versions = MappingProxyType(dict(firmware_versions))
+        # Assignments are either {'latest': version} per type or a firmware key per device
+        self.device_assignments = MappingProxyType({
+            target: MappingProxyType(dict(assignment)) if isinstance(assignment, Mapping) else assignment
+            for target, assignment in (device_assignments or {}).items()
+        })
+        self.settings = MappingProxyType(dict(settings or {}))
+        # Registry-shaped view for callers that index firmware_registry directly
+        self.registry = MappingProxyType({
+            **self.settings,
+            'firmware_versions': self.firmware_versions,
+            'device_assignments': self.device_assignments
+        })
+        # Update decisions for this generation, keyed by (current_version, device_type)
+        self.decisions = {}
+    
+    @classmethod
+    def from_registry(cls, generation, registry):
+        settings = {k: v for k, v in registry.items() if k not in ('firmware_versions', 'device_assignments')}
+        return cls(generation, registry.get('firmware_versions', {}), registry.get('device_assignments', {}), settings)
+    
+    def evolve(self, firmware_versions=None, device_assignments=None, settings=None):
+        """New snapshot at the next generation with the given parts replaced"""
+        return RegistrySnapshot(
+            self.generation + 1,
+            self.firmware_versions if firmware_versions is None else firmware_versions,
+            self.device_assignments if device_assignments is None else device_assignments,
+            self.settings if settings is None else settings
+        )
+    
+    def to_json(self):
+        """Uploaded registry contents (compiled entries are rebuilt from their own registry on load)"""
+        return {
+            **self.settings,
+            'firmware_versions': {
+                key: dict(firmware) for key, firmware in self.firmware_versions.items()
+                if not firmware.get('is_compiled', False)
+            },
+            'device_assignments': {
+                target: dict(assignment) if isinstance(assignment, Mapping) else assignment
+                for target, assignment in self.device_assignments.items()
+            }
+        }
+
+
 class OTAManager:
-    def __init__(self, upload_folder='data/ota'):
+    def __init__(self, upload_folder='data/ota', forced_update_ttl=86400):
         self.upload_folder = upload_folder
         self.firmware_folder = os.path.join(upload_folder, 'firmware')
         self.metadata_file = os.path.join(upload_folder, 'firmware_registry.json')
@@ -27,11 +95,37 @@ class OTAManager:
         os.makedirs(self.upload_folder, exist_ok=True)
         os.makedirs(self.firmware_folder, exist_ok=True)
         
-        # Load or create firmware registry (merged from both sources)
-        self.firmware_registry = self._load_registry()
+        # Firmware registry (merged from both sources), replaced wholesale on every change
+        self._write_lock = threading.RLock()
+        self.snapshot = RegistrySnapshot.from_registry(0, self._load_registry())
         
-        # Store forced updates for devices (device_id -> firmware_info)
-        self.forced_updates = {}
+        # Forced updates for specific devices, shared by all workers through the database
+        self.forced_updates = ForcedUpdateStore(forced_update_ttl)
+        
+        # Memoised update decisions per snapshot
+        self._decision_cache_limit = 1024
+        
+        # Lazily computed (sha256, md5) keyed by (path, mtime, size)
+        self._hash_cache = {}
+        
+        # Download counters and running statistics (built on first use, then maintained incrementally)
+        self.download_counter = DownloadCounterStore()
+        self.statistics = OTAStatistics()
+        self._statistics_ready = False
+
+    @property
+    def firmware_registry(self):
+        """Read-only registry of the current snapshot"""
+        return self.snapshot.registry
+    
+    @property
+    def registry_generation(self):
+        return self.snapshot.generation
+    
+    def _publish(self, snapshot):
+        """Make a new snapshot visible to readers (write lock held)"""
+        # A single reference assignment: readers see either the old or the new registry
+        self.snapshot = snapshot
 
     def _load_registry(self):
         """Load firmware registry from JSON file, merging compiled and uploaded firmware"""
@@ -42,49 +136,127 @@ class OTAManager:
         }
         
         # Load uploaded firmware registry
-        if os.path.exists(self.metadata_file):
-            try:
-                with open(self.metadata_file, 'r') as f:
-                    uploaded_registry = json.load(f)
-                    registry.update(uploaded_registry)
-            except Exception as e:
-                logger.error(f"Failed to load uploaded firmware registry: {e}")
+        uploaded_registry = self._read_uploaded_registry()
+        if uploaded_registry:
+            registry.update(uploaded_registry)
         
         # Load and merge compiled firmware registry
-        if os.path.exists(self.compiled_metadata_file):
-            try:
-                with open(self.compiled_metadata_file, 'r') as f:
-                    compiled_registry = json.load(f)
-                    
-                # Merge compiled firmware into registry
-                for firmware_key, firmware_info in compiled_registry.items():
-                    # Convert compiled format to our registry format
-                    registry_key = f"compiled_{firmware_key}"
-                    registry['firmware_versions'][registry_key] = {
-                        'filename': firmware_info['filename'],
-                        'version': firmware_info['version'],
-                        'device_type': firmware_info['compatible_devices'][0] if firmware_info['compatible_devices'] else 'ESP32',
-                        'description': firmware_info['description'],
-                        'file_size': firmware_info['size'],
-                        'upload_date': firmware_info['build_date'],
-                        'file_hash': '',  # We'll calculate this when needed
-                        'download_count': 0,  # Initialize download count for compiled firmware
-                        'is_compiled': True,
-                        'source_path': os.path.join(self.compiled_firmware_folder, firmware_info['filename']),
-                        'filepath': os.path.join(self.compiled_firmware_folder, firmware_info['filename']),  # For compatibility
-                        'is_active': True  # Compiled firmware is always active
-                    }
-                logger.info(f"Loaded {len(compiled_registry)} compiled firmware versions")
-            except Exception as e:
-                logger.error(f"Failed to load compiled firmware registry: {e}")
+        compiled_entries = self._read_compiled_entries()
+        if compiled_entries:
+            registry['firmware_versions'].update(compiled_entries)
+            logger.info(f"Loaded {len(compiled_entries)} compiled firmware versions")
         
         return registry
     
-    def _save_registry(self):
+    def _read_uploaded_registry(self):
+        """Read the uploaded firmware registry file ({} if missing, None if unreadable)"""
+        if not os.path.exists(self.metadata_file):
+            return {}
+        try:
+            with open(self.metadata_file, 'r') as f:
+                return json.load(f)
+        except Exception as e:
+            logger.error(f"Failed to load uploaded firmware registry: {e}")
+            return None
+    
+    def _read_compiled_entries(self):
+        """Read compiled firmware converted to registry entries ({} if missing, None if unreadable)"""
+        if not os.path.exists(self.compiled_metadata_file):
+            return {}
+        try:
+            with open(self.compiled_metadata_file, 'r') as f:
+                compiled_registry = json.load(f)
+            
+            entries = {}
+            for firmware_key, firmware_info in compiled_registry.items():
+                # Convert compiled format to our registry format
+                registry_key = f"compiled_{firmware_key}"
+                entries[registry_key] = {
+                    'filename': firmware_info['filename'],
+                    'version': firmware_info['version'],
+                    'device_type': firmware_info['compatible_devices'][0] if firmware_info['compatible_devices'] else 'ESP32',
+                    'description': firmware_info['description'],
+                    'file_size': firmware_info['size'],
+                    'upload_date': firmware_info['build_date'],
+                    'file_hash': '',  # We'll calculate this when needed
+                    'download_count': 0,  # Initialize download count for compiled firmware
+                    'is_compiled': True,
+                    'source_path': os.path.join(self.compiled_firmware_folder, firmware_info['filename']),
+                    'filepath': os.path.join(self.compiled_firmware_folder, firmware_info['filename']),  # For compatibility
+                    'is_active': True  # Compiled firmware is always active
+                }
+            return entries
+        except Exception as e:
+            logger.error(f"Failed to load compiled firmware registry: {e}")
+            return None
+    
+    @staticmethod
+    def _same_entry(old, new):
+        """Compare registry entries, ignoring fields filled in lazily at runtime"""
+        lazy_fields = ('file_hash', 'download_count')
+        return ({k: v for k, v in old.items() if k not in lazy_fields} ==
+                {k: v for k, v in new.items() if k not in lazy_fields})
+    
+    def reload_registry(self):
+        """
+        Merge changes from both registry files into a new registry and swap it in
+        
+        Unchanged entries keep their existing objects; readers holding the
+        previous snapshot are unaffected by the swap.
+        
+        Returns:
+            bool: True if anything changed
+        """
+        with self._write_lock:
+            uploaded_registry = self._read_uploaded_registry()
+            compiled_entries = self._read_compiled_entries()
+            if uploaded_registry is None or compiled_entries is None:
+                # Half-written file; try again on the next change
+                return False
+            
+            current = self.snapshot
+            incoming = {
+                key: firmware for key, firmware in uploaded_registry.get('firmware_versions', {}).items()
+                if not firmware.get('is_compiled', False)
+            }
+            incoming.update(compiled_entries)
+            
+            merged = {}
+            changed = []
+            for key, firmware in incoming.items():
+                existing = current.firmware_versions.get(key)
+                if existing is not None and self._same_entry(existing, firmware):
+                    merged[key] = existing
+                else:
+                    merged[key] = firmware
+                    changed.append(key)
+            removed = [key for key in current.firmware_versions if key not in merged]
+            
+            incoming_snapshot = RegistrySnapshot.from_registry(current.generation, uploaded_registry)
+            settings_changed = (
+                dict(incoming_snapshot.settings) != dict(current.settings) or
+                incoming_snapshot.to_json()['device_assignments'] != current.to_json()['device_assignments']
+            )
+            
+            if not changed and not removed and not settings_changed:
+                return False
+            
+            self._publish(current.evolve(
+                firmware_versions=merged,
+                device_assignments=incoming_snapshot.device_assignments,
+                settings=incoming_snapshot.settings
+            ))
+            self._statistics_ready = False
+        logger.info(f"Firmware registry reloaded: {len(changed)} changed, {len(removed)} removed "
+                    f"(generation {self.registry_generation})")
+        return True
+    
+    def _save_registry(self, snapshot=None):
         """Save firmware registry to JSON file"""
         try:
+            registry = (snapshot or self.snapshot).to_json()
             with open(self.metadata_file, 'w') as f:
-                json.dump(self.firmware_registry, f, indent=2)
+                json.dump(registry, f, indent=2)
             return True
         except Exception as e:
             logger.error(f"Failed to save firmware registry: {e}")
@@ -92,16 +264,93 @@ class OTAManager:
     
     def _calculate_file_hash(self, filepath):
         """Calculate SHA256 hash of firmware file"""
+        hashes = self._calculate_file_hashes(filepath)
+        return hashes[0] if hashes else None
+    
+    def _calculate_file_hashes(self, filepath):
+        """Calculate (SHA256, MD5) of a firmware file in one pass"""
         hash_sha256 = hashlib.sha256()
+        hash_md5 = hashlib.md5()
         try:
             with open(filepath, "rb") as f:
-                for chunk in iter(lambda: f.read(4096), b""):
+                for chunk in iter(lambda: f.read(HASH_CHUNK_SIZE), b""):
                     hash_sha256.update(chunk)
-            return hash_sha256.hexdigest()
+                    hash_md5.update(chunk)
+            return hash_sha256.hexdigest(), hash_md5.hexdigest()
         except Exception as e:
             logger.error(f"Failed to calculate hash for {filepath}: {e}")
             return None
     
+    def _stream_to_temp_file(self, file):
+        """
+        Write an uploaded file to a temp file in the firmware folder, hashing on the fly
+        
+        Returns:
+            tuple: (temp_path, sha256, md5, file_size)
+        """
+        hash_sha256 = hashlib.sha256()
+        hash_md5 = hashlib.md5()
+        file_size = 0
+        
+        fd, temp_path = tempfile.mkstemp(suffix='.part', dir=self.firmware_folder)
+        try:
+            with os.fdopen(fd, 'wb') as out:
+                for chunk in iter(lambda: file.stream.read(HASH_CHUNK_SIZE), b""):
+                    hash_sha256.update(chunk)
+                    hash_md5.update(chunk)
+                    out.write(chunk)
+                    file_size += len(chunk)
+        except Exception:
+            os.remove(temp_path)
+            raise
+        
+        return temp_path, hash_sha256.hexdigest(), hash_md5.hexdigest(), file_size
+    
+    def _find_firmware_by_hash(self, file_hash):
+        """Find an uploaded firmware entry whose file has the given SHA256"""
+        for firmware in self.snapshot.firmware_versions.values():
+            if (not firmware.get('is_compiled', False) and
+                    firmware.get('file_hash') == file_hash and
+                    os.path.exists(firmware.get('filepath', ''))):
+                return firmware
+        return None
+    
+    def _is_file_shared(self, filepath, excluding_key):
+        """Check whether another registry entry points at the same firmware file"""
+        return any(
+            key != excluding_key and firmware.get('filepath') == filepath
+            for key, firmware in self.snapshot.firmware_versions.items()
+        )
+    
+    def get_firmware_hashes(self, firmware_key):
+        """
+        Get (SHA256, MD5) for a firmware entry
+        
+        Compiled firmware is hashed lazily on first use and cached by
+        (path, mtime, size), so a rebuilt binary is picked up automatically.
+        """
+        firmware_info = self.snapshot.firmware_versions.get(firmware_key)
+        if not firmware_info:
+            return None
+        
+        if firmware_info.get('file_hash') and firmware_info.get('file_md5'):
+            return firmware_info['file_hash'], firmware_info['file_md5']
+        
+        filepath = self._entry_path(firmware_info)
+        try:
+            stat = os.stat(filepath)
+        except (OSError, TypeError):
+            return None
+        
+        cache_key = (filepath, stat.st_mtime, stat.st_size)
+        hashes = self._hash_cache.get(cache_key)
+        if hashes is None:
+            hashes = self._calculate_file_hashes(filepath)
+            if not hashes:
+                return None
+            self._hash_cache[cache_key] = hashes
+        return hashes
+    
     def upload_firmware(self, file, device_type, description="", auto_assign=False):
         """
         Upload a new firmware file with automatic versioning
@@ -132,65 +381,98 @@ class OTAManager:
             safe_filename = f"{device_type}_{version}.bin"
             firmware_path = os.path.join(self.firmware_folder, safe_filename)
             
-            # Save file
-            file.save(firmware_path)
-            
-            # Calculate file hash and size
-            file_hash = self._calculate_file_hash(firmware_path)
-            file_size = os.path.getsize(firmware_path)
-            
-            if not file_hash:
-                os.remove(firmware_path)
-                return {'success': False, 'error': 'Failed to calculate file hash'}
-            
-            # Create firmware metadata
-            firmware_info = {
-                'version': version,
-                'device_type': device_type,
-                'filename': safe_filename,
-                'filepath': firmware_path,
-                'description': description,
-                'upload_date': datetime.now().isoformat(),
-                'file_size': file_size,
-                'file_hash': file_hash,
-                'download_count': 0,
-                'is_active': True
-            }
-            
-            # Add to registry
-            firmware_key = f"{device_type}_{version}"
-            self.firmware_registry['firmware_versions'][firmware_key] = firmware_info
-            
-            # Auto-assign to devices if requested
-            if auto_assign:
-                self._auto_assign_firmware(device_type, version)
+            # Single pass: stream to a temp file while hashing (outside the write lock)
+            temp_path, file_hash, file_md5, file_size = self._stream_to_temp_file(file)
             
-            # Save registry
-            if self._save_registry():
-                logger.info(f"Firmware uploaded successfully: {device_type} v{version}")
-                return {
-                    'success': True,
-                    'firmware_key': firmware_key,
-                    'firmware_info': firmware_info
-                }
-            else:
-                # Clean up file if registry save failed
-                os.remove(firmware_path)
-                return {'success': False, 'error': 'Failed to save firmware registry'}
+            with self._write_lock:
+                try:
+                    return self._register_upload(temp_path, firmware_path, safe_filename, version,
+                                                 device_type, description, auto_assign,
+                                                 file_hash, file_md5, file_size)
+                except Exception:
+                    if os.path.exists(temp_path):
+                        os.remove(temp_path)
+                    raise
                 
         except Exception as e:
             logger.error(f"Firmware upload failed: {e}")
             return {'success': False, 'error': str(e)}
     
-    def _auto_assign_firmware(self, device_type, version):
-        """Auto-assign firmware to all devices of specified type"""
+    def _register_upload(self, temp_path, firmware_path, safe_filename, version, device_type,
+                         description, auto_assign, file_hash, file_md5, file_size):
+        """Move an uploaded temp file into place and publish its registry entry (write lock held)"""
+        firmware_key = f"{device_type}_{version}"
+        
+        # Identical binaries share one file on disk
+        duplicate = self._find_firmware_by_hash(file_hash)
+        if duplicate:
+            os.remove(temp_path)
+            firmware_path = duplicate['filepath']
+            safe_filename = duplicate['filename']
+            logger.info(f"Firmware content matches existing {duplicate['filename']}, reusing file")
+        else:
+            if os.path.exists(firmware_path) and self._is_file_shared(firmware_path, firmware_key):
+                # Another entry reuses the file at this path (an upload in the same second);
+                # overwriting it would change the bytes behind that entry's hashes
+                safe_filename = f"{device_type}_{version}_{file_hash[:12]}.bin"
+                firmware_path = os.path.join(self.firmware_folder, safe_filename)
+            os.replace(temp_path, firmware_path)
+        
+        # Create firmware metadata
+        firmware_info = {
+            'version': version,
+            'device_type': device_type,
+            'filename': safe_filename,
+            'filepath': firmware_path,
+            'description': description,
+            'upload_date': datetime.now().isoformat(),
+            'file_size': file_size,
+            'file_hash': file_hash,
+            'file_md5': file_md5,
+            'download_count': 0,
+            'is_active': True
+        }
+        
+        # Build the next registry (auto-assigning to devices if requested)
+        previous = self.snapshot
+        replaced_existing = firmware_key in previous.firmware_versions
+        firmware_versions = dict(previous.firmware_versions)
+        firmware_versions[firmware_key] = firmware_info
+        device_assignments = None
+        if auto_assign:
+            device_assignments = self._auto_assign_firmware(previous, device_type, version)
+        snapshot = previous.evolve(firmware_versions=firmware_versions, device_assignments=device_assignments)
+        
+        # Save registry, then publish
+        if self._save_registry(snapshot):
+            self._publish(snapshot)
+            if replaced_existing:
+                self._statistics_ready = False
+            elif self._statistics_ready:
+                self.statistics.on_upload(firmware_key, firmware_info)
+            logger.info(f"Firmware uploaded successfully: {device_type} v{version}")
+            return {
+                'success': True,
+                'firmware_key': firmware_key,
+                'firmware_info': firmware_info
+            }
+        else:
+            # Clean up file if registry save failed
+            if not duplicate:
+                os.remove(firmware_path)
+            return {'success': False, 'error': 'Failed to save firmware registry'}
+    
+    def _auto_assign_firmware(self, snapshot, device_type, version):
+        """Auto-assign firmware to all devices of specified type, returning the new assignments"""
         # This would integrate with the device registry to assign firmware
         # For now, we'll just set a default assignment
-        if device_type not in self.firmware_registry['device_assignments']:
-            self.firmware_registry['device_assignments'][device_type] = {}
-        
-        self.firmware_registry['device_assignments'][device_type]['latest'] = version
+        device_assignments = dict(snapshot.device_assignments)
+        existing = device_assignments.get(device_type)
+        assignment = dict(existing) if isinstance(existing, Mapping) else {}
+        assignment['latest'] = version
+        device_assignments[device_type] = assignment
         logger.info(f"Auto-assigned {device_type} v{version} to all devices of this type")
+        return device_assignments
     
     def check_update_for_device(self, device_id, current_version, device_type="ESP32_PersonalCMS"):
         """
@@ -206,45 +488,24 @@ class OTAManager:
             dict: Update information
         """
         try:
-            # First check for forced updates for this specific device
-            if device_id in self.forced_updates:
-                forced_update = self.forced_updates[device_id]
+            # First check for forced updates for this specific device (served once)
+            forced_update = self.forced_updates.claim(device_id)
+            if forced_update:
                 logger.info(f"Found forced update for {device_id}: {forced_update['target_firmware']} v{forced_update['version']}")
-                
-                # Remove the forced update after serving it once
-                del self.forced_updates[device_id]
-                
                 return forced_update
 
-            # Always get the latest firmware from ANY type (automatic cross-firmware updates)
-            latest_firmware = self._get_any_latest_firmware()
-            
-            if not latest_firmware:
-                return {
-                    'update_available': False,
-                    'message': 'No firmware available'
-                }
+            # Everything else depends only on the registry snapshot and the reported version/type
+            snapshot = self.snapshot
+            cache_key = (current_version, device_type)
+            decision = snapshot.decisions.get(cache_key)
+            if decision is None:
+                decision = self._build_update_decision(snapshot, current_version, device_type)
+                if len(snapshot.decisions) >= self._decision_cache_limit:
+                    snapshot.decisions.clear()
+                snapshot.decisions[cache_key] = decision
             
-            # Compare versions - if different, offer update regardless of firmware type
-            if latest_firmware['version'] != current_version:
-                update_type = 'cross_firmware' if latest_firmware['device_type'] != device_type else 'same_type'
-                
-                return {
-                    'update_available': True,
-                    'version': latest_firmware['version'],
-                    'description': f"Auto update to {latest_firmware['device_type']}: {latest_firmware['description']}",
-                    'firmware_url': f"/api/ota/download/{latest_firmware['device_type']}_{latest_firmware['version']}",
-                    'file_size': latest_firmware['file_size'],
-                    'release_date': latest_firmware['upload_date'],
-                    'update_type': update_type,
-                    'target_firmware': latest_firmware['device_type']
-                }
-
-            return {
-                'update_available': False,
-                'message': f'Device is running latest firmware ({current_version})',
-                'current_version': current_version
-            }
+            # Callers add per-request fields, so hand out a copy
+            return dict(decision)
             
         except Exception as e:
             logger.error(f"Update check failed for {device_id}: {e}")
@@ -253,14 +514,48 @@ class OTAManager:
                 'error': str(e)
             }
     
+    def _build_update_decision(self, snapshot, current_version, device_type):
+        """Compute the (cacheable) update answer for a reported version and type"""
+        # Always get the latest firmware from ANY type (automatic cross-firmware updates)
+        latest_firmware = self._get_any_latest_firmware(snapshot)
+        
+        if not latest_firmware:
+            return {
+                'update_available': False,
+                'message': 'No firmware available'
+            }
+        
+        # Compare versions - if different, offer update regardless of firmware type
+        if latest_firmware['version'] != current_version:
+            update_type = 'cross_firmware' if latest_firmware['device_type'] != device_type else 'same_type'
+            
+            return {
+                'update_available': True,
+                'version': latest_firmware['version'],
+                'description': f"Auto update to {latest_firmware['device_type']}: {latest_firmware['description']}",
+                'firmware_url': f"/api/ota/download/{latest_firmware['device_type']}_{latest_firmware['version']}",
+                'firmware_key': f"{latest_firmware['device_type']}_{latest_firmware['version']}",
+                'file_size': latest_firmware['file_size'],
+                'release_date': latest_firmware['upload_date'],
+                'update_type': update_type,
+                'target_firmware': latest_firmware['device_type']
+            }
+
+        return {
+            'update_available': False,
+            'message': f'Device is running latest firmware ({current_version})',
+            'current_version': current_version
+        }
+    
     def _get_latest_firmware(self, device_type):
         """Get latest firmware for device type"""
         latest_firmware = None
         latest_date = None
+        halted = self.halted_builds
         
-        for key, firmware in self.firmware_registry['firmware_versions'].items():
+        for key, firmware in self.snapshot.firmware_versions.items():
             if (firmware['device_type'] == device_type and 
-                firmware['is_active']):
+                firmware['is_active'] and key not in halted):
                 
                 upload_date = datetime.fromisoformat(firmware['upload_date'])
                 if latest_date is None or upload_date > latest_date:
@@ -269,13 +564,23 @@ class OTAManager:
         
         return latest_firmware
 
-    def _get_any_latest_firmware(self):
+    def _get_any_latest_firmware(self, snapshot=None):
         """Get latest firmware from any device type - allows cross-firmware updates"""
-        latest_firmware = None
-        latest_date = None
+        releases = self.get_release_order(snapshot)
+        return releases[0][1] if releases else None
+    
+    def get_release_order(self, snapshot=None):
+        """
+        Active, non-halted firmware newest first
         
-        for key, firmware in self.firmware_registry['firmware_versions'].items():
-            if firmware['is_active']:
+        Returns:
+            list: (firmware_key, firmware) tuples; the first is what devices are offered
+        """
+        snapshot = snapshot or self.snapshot
+        halted = snapshot.settings.get('halted_builds') or {}
+        dated = []
+        for key, firmware in snapshot.firmware_versions.items():
+            if firmware['is_active'] and key not in halted:
                 try:
                     # Handle timezone issues by normalizing the date string
                     upload_date_str = firmware['upload_date']
@@ -283,14 +588,68 @@ class OTAManager:
                         upload_date_str = upload_date_str[:-1]
                     
                     upload_date = datetime.fromisoformat(upload_date_str.replace('Z', ''))
-                    if latest_date is None or upload_date > latest_date:
-                        latest_date = upload_date
-                        latest_firmware = firmware
+                    dated.append((upload_date, key, firmware))
                 except Exception as e:
                     logger.warning(f"Failed to parse date for firmware {key}: {e}")
                     continue
         
-        return latest_firmware
+        # Stable on equal dates: the first registry entry wins, as before
+        dated.sort(key=lambda item: item[0], reverse=True)
+        return [(key, firmware) for _, key, firmware in dated]
+    
+    @property
+    def halted_builds(self):
+        """Firmware keys withheld from update checks, with the reason for each"""
+        return self.snapshot.settings.get('halted_builds') or {}
+    
+    def halt_firmware(self, firmware_key, reason, details=None):
+        """
+        Stop offering a firmware build; devices are offered the newest build left
+        
+        Returns:
+            bool: True if the build was newly halted
+        """
+        with self._write_lock:
+            previous = self.snapshot
+            halted = dict(previous.settings.get('halted_builds') or {})
+            if firmware_key not in previous.firmware_versions or firmware_key in halted:
+                return False
+            halted[firmware_key] = {
+                'reason': reason,
+                'details': details or {},
+                'halted_at': datetime.utcnow().isoformat()
+            }
+            if not self._publish_settings(previous, halted_builds=halted):
+                return False
+        logger.warning(f"Firmware rollout halted for {firmware_key}: {reason}")
+        return True
+    
+    def resume_firmware(self, firmware_key):
+        """
+        Offer a halted firmware build again
+        
+        Returns:
+            bool: True if the build was halted
+        """
+        with self._write_lock:
+            previous = self.snapshot
+            halted = dict(previous.settings.get('halted_builds') or {})
+            if halted.pop(firmware_key, None) is None:
+                return False
+            if not self._publish_settings(previous, halted_builds=halted):
+                return False
+        logger.info(f"Firmware rollout resumed for {firmware_key}")
+        return True
+    
+    def _publish_settings(self, previous, **changes):
+        """Save and publish a snapshot with top-level settings replaced (write lock held)"""
+        settings = dict(previous.settings)
+        settings.update(changes)
+        snapshot = previous.evolve(settings=settings)
+        if not self._save_registry(snapshot):
+            return False
+        self._publish(snapshot)
+        return True
 
     def _get_device_specific_firmware(self, device_id):
         """
@@ -304,7 +663,7 @@ class OTAManager:
     def get_available_firmware_types(self):
         """Get all available firmware types for cross-firmware updates"""
         types = set()
-        for firmware in self.firmware_registry['firmware_versions'].values():
+        for firmware in self.snapshot.firmware_versions.values():
             if firmware['is_active']:
                 types.add(firmware['device_type'])
         return sorted(list(types))
@@ -316,7 +675,7 @@ class OTAManager:
     def set_forced_update(self, device_id, firmware_info):
         """Set a forced update for a specific device"""
         try:
-            self.forced_updates[device_id] = firmware_info
+            self.forced_updates.set(device_id, firmware_info)
             logger.info(f"Set forced update for {device_id}: {firmware_info['target_firmware']} v{firmware_info['version']}")
             return True
         except Exception as e:
@@ -325,42 +684,80 @@ class OTAManager:
 
     def clear_forced_update(self, device_id):
         """Clear any forced update for a device"""
-        if device_id in self.forced_updates:
-            del self.forced_updates[device_id]
-            logger.info(f"Cleared forced update for {device_id}")
-            return True
+        try:
+            if self.forced_updates.clear(device_id):
+                logger.info(f"Cleared forced update for {device_id}")
+                return True
+        except Exception as e:
+            logger.error(f"Failed to clear forced update for {device_id}: {e}")
+        return False
+
+    def acknowledge_forced_update(self, device_id, version):
+        """Mark a delivered forced update as installed when the device reports the new version"""
+        try:
+            if self.forced_updates.acknowledge(device_id, version):
+                logger.info(f"Forced update acknowledged by {device_id}: v{version}")
+                return True
+        except Exception as e:
+            logger.error(f"Failed to acknowledge forced update for {device_id}: {e}")
         return False
 
     def get_forced_updates(self):
-        """Get all current forced updates"""
-        return self.forced_updates.copy()
+        """Get all current (undelivered) forced updates"""
+        return self.forced_updates.get_pending()
+    
+    def get_firmware_path(self, firmware_key):
+        """Get firmware file path without counting a download"""
+        firmware_info = self.snapshot.firmware_versions.get(firmware_key)
+        if not firmware_info:
+            return None
+        return self._entry_path(firmware_info)
+    
+    @staticmethod
+    def _entry_path(firmware_info):
+        # Compiled firmware lives in its source location
+        if firmware_info.get('is_compiled', False):
+            return firmware_info.get('source_path')
+        return firmware_info['filepath']
+    
+    def record_download(self, firmware_key):
+        """Count a download in the counter store and the running statistics"""
+        if firmware_key not in self.snapshot.firmware_versions:
+            return
+        try:
+            delta = self.download_counter.increment(firmware_key)
+        except Exception as e:
+            logger.error(f"Failed to count download of {firmware_key}: {e}")
+            return
+        if self._statistics_ready and delta:
+            self.statistics.on_downloads(firmware_key, delta)
     
     def get_firmware_file(self, firmware_key):
         """Get firmware file path for download"""
-        if firmware_key in self.firmware_registry['firmware_versions']:
-            firmware_info = self.firmware_registry['firmware_versions'][firmware_key]
-            
-            # Check if this is compiled firmware
-            if firmware_info.get('is_compiled', False):
-                # Return the source path for compiled firmware
-                return firmware_info.get('source_path')
-            else:
-                # Increment download count for uploaded firmware
-                firmware_info['download_count'] = firmware_info.get('download_count', 0) + 1
-                self._save_registry()
-                return firmware_info['filepath']
-        
-        return None
+        firmware_path = self.get_firmware_path(firmware_key)
+        if firmware_path:
+            self.record_download(firmware_key)
+        return firmware_path
     
     def list_firmware_versions(self, device_type=None):
         """List all firmware versions, optionally filtered by device type"""
         firmwares = []
         
-        for key, firmware in self.firmware_registry['firmware_versions'].items():
+        try:
+            self._ensure_statistics()
+            counts = self.download_counter
+        except Exception as e:
+            logger.warning(f"Download counters unavailable, using registry counts: {e}")
+            counts = None
+        
+        halted = self.halted_builds
+        for key, firmware in self.snapshot.firmware_versions.items():
             if device_type is None or firmware['device_type'] == device_type:
                 firmwares.append({
                     'key': key,
-                    **firmware
+                    **firmware,
+                    'halted': halted.get(key),
+                    'download_count': counts.get(key, firmware.get('download_count', 0)) if counts else firmware.get('download_count', 0)
                 })
         
         # Sort by upload date (newest first)
@@ -370,30 +767,48 @@ class OTAManager:
     def delete_firmware(self, firmware_key):
         """Delete a firmware version"""
         try:
-            if firmware_key not in self.firmware_registry['firmware_versions']:
-                return {'success': False, 'error': 'Firmware not found'}
-            
-            firmware_info = self.firmware_registry['firmware_versions'][firmware_key]
-            
-            # Delete file (handle both uploaded and compiled firmware)
-            if firmware_info.get('is_compiled', False):
-                # Don't delete compiled firmware files - they're managed separately
-                logger.info(f"Skipping file deletion for compiled firmware: {firmware_key}")
-            else:
-                # Delete uploaded firmware file
-                filepath = firmware_info.get('filepath')
-                if filepath and os.path.exists(filepath):
-                    os.remove(filepath)
+            with self._write_lock:
+                previous = self.snapshot
+                if firmware_key not in previous.firmware_versions:
+                    return {'success': False, 'error': 'Firmware not found'}
+                
+                firmware_info = previous.firmware_versions[firmware_key]
+                
+                # Remove from registry
+                firmware_versions = dict(previous.firmware_versions)
+                del firmware_versions[firmware_key]
+                settings = None
+                if firmware_key in (previous.settings.get('halted_builds') or {}):
+                    settings = dict(previous.settings)
+                    settings['halted_builds'] = {
+                        key: info for key, info in settings['halted_builds'].items() if key != firmware_key
+                    }
+                snapshot = previous.evolve(firmware_versions=firmware_versions, settings=settings)
+                if not self._save_registry(snapshot):
+                    return {'success': False, 'error': 'Failed to save registry'}
+                self._publish(snapshot)
+                
+                # Delete file (handle both uploaded and compiled firmware)
+                if firmware_info.get('is_compiled', False):
+                    # Don't delete compiled firmware files - they're managed separately
+                    logger.info(f"Skipping file deletion for compiled firmware: {firmware_key}")
+                else:
+                    # Delete uploaded firmware file unless a deduplicated entry still uses it
+                    filepath = firmware_info.get('filepath')
+                    if filepath and os.path.exists(filepath) and not self._is_file_shared(filepath, firmware_key):
+                        os.remove(filepath)
+                
+                if self._statistics_ready:
+                    downloads = self.download_counter.get(firmware_key, firmware_info.get('download_count', 0))
+                    self.statistics.on_delete(firmware_key, firmware_info, downloads, snapshot.firmware_versions)
             
-            # Remove from registry
-            del self.firmware_registry['firmware_versions'][firmware_key]
+            try:
+                self.download_counter.forget(firmware_key)
+            except Exception as e:
+                logger.warning(f"Failed to drop download counter for {firmware_key}: {e}")
             
-            # Save registry
-            if self._save_registry():
-                logger.info(f"Firmware deleted: {firmware_key}")
-                return {'success': True}
-            else:
-                return {'success': False, 'error': 'Failed to save registry'}
+            logger.info(f"Firmware deleted: {firmware_key}")
+            return {'success': True}
                 
         except Exception as e:
             logger.error(f"Failed to delete firmware {firmware_key}: {e}")
@@ -401,65 +816,37 @@ class OTAManager:
     
     def get_device_assignments(self):
         """Get current device-firmware assignments"""
-        return self.firmware_registry.get('device_assignments', {})
+        return self.snapshot.to_json()['device_assignments']
     
     def assign_firmware_to_device(self, device_id, firmware_key):
         """Assign specific firmware to a device"""
         # This would be implemented based on your device management needs
         pass
     
-    def get_update_statistics(self):
-        """Get OTA update statistics"""
-        stats = {
-            'total_firmware_versions': len(self.firmware_registry['firmware_versions']),
-            'total_downloads': sum(fw.get('download_count', 0) for fw in self.firmware_registry['firmware_versions'].values()),
-            'device_types': {},
-            'recent_uploads': []
-        }
-        
-        # Group by device type
-        for firmware in self.firmware_registry['firmware_versions'].values():
-            device_type = firmware['device_type']
-            if device_type not in stats['device_types']:
-                stats['device_types'][device_type] = {
-                    'count': 0,
-                    'latest_version': None,
-                    'total_downloads': 0
-                }
-            
-            stats['device_types'][device_type]['count'] += 1
-            stats['device_types'][device_type]['total_downloads'] += firmware.get('download_count', 0)
-            
-            # Update latest version
-            current_latest = stats['device_types'][device_type]['latest_version']
-            if current_latest is None:
-                stats['device_types'][device_type]['latest_version'] = firmware
-            else:
-                try:
-                    # Parse dates safely, handling timezone issues
-                    firmware_date_str = firmware['upload_date']
-                    current_date_str = current_latest['upload_date']
-                    
-                    # Remove timezone info if present to compare dates only
-                    if firmware_date_str.endswith('Z'):
-                        firmware_date_str = firmware_date_str[:-1]
-                    if current_date_str.endswith('Z'):
-                        current_date_str = current_date_str[:-1]
-                    
-                    firmware_date = datetime.fromisoformat(firmware_date_str.replace('Z', ''))
-                    current_date = datetime.fromisoformat(current_date_str.replace('Z', ''))
-                    
-                    if firmware_date > current_date:
-                        stats['device_types'][device_type]['latest_version'] = firmware
-                except Exception as e:
-                    logger.warning(f"Date comparison failed for {device_type}: {e}")
-                    # Default to version string comparison if date parsing fails
-                    if firmware['version'] > current_latest['version']:
-                        stats['device_types'][device_type]['latest_version'] = firmware
-        
-        # Recent uploads (last 10)
-        all_firmware = list(self.firmware_registry['firmware_versions'].values())
-        all_firmware.sort(key=lambda x: x['upload_date'], reverse=True)
-        stats['recent_uploads'] = all_firmware[:10]
+    def _ensure_statistics(self):
+        """Build the running statistics once, then fold in other workers' downloads"""
+        if not self._statistics_ready:
+            with self._write_lock:
+                self._rebuild_statistics()
+            return
         
-        return stats
\ No newline at end of file
+        for firmware_key, delta in self.download_counter.sync().items():
+            self.statistics.on_downloads(firmware_key, delta)
+    
+    def _rebuild_statistics(self):
+        """Build the running statistics from the current snapshot (write lock held)"""
+        if not self._statistics_ready:
+            firmware_versions = self.snapshot.firmware_versions
+            self.download_counter.seed({
+                key: firmware.get('download_count', 0) for key, firmware in firmware_versions.items()
+            })
+            self.download_counter.sync(force=True)
+            self.statistics.rebuild(firmware_versions, {
+                key: self.download_counter.get(key) for key in firmware_versions
+            })
+            self._statistics_ready = True
+    
+    def get_update_statistics(self):
+        """Get OTA update statistics (snapshot of running aggregates, no registry scan)"""
+        self._ensure_statistics()
+        return self.statistics.snapshot()
@@ -0,0 +1,212 @@
+"""
+OTA Statistics
+Download counters and running firmware aggregates, kept up to date on upload,
+delete and download instead of being recomputed from the registry per request
+"""
+
+import time
+import threading
+import logging
+from collections import deque
+from datetime import datetime
+from sqlalchemy import update
+from sqlalchemy.exc import IntegrityError
+
+from models import db, FirmwareDownloadCount
+
+logger = logging.getLogger(__name__)
+
+RECENT_UPLOADS_LIMIT = 10
+
+
+def parse_upload_date(date_str):
+    """Parse a registry upload_date, tolerating a trailing 'Z'"""
+    try:
+        return datetime.fromisoformat(date_str.replace('Z', ''))
+    except (AttributeError, ValueError):
+        return datetime.min
+
+
+class DownloadCounterStore:
+    """
+    Firmware download counts in the database
+
+    Increments are single atomic UPDATEs, so every worker can count. Each worker
+    keeps a local copy and re-reads the (small) table at most every
+    `resync_interval` seconds to pick up other workers' downloads.
+    """
+
+    def __init__(self, resync_interval=30):
+        self.resync_interval = resync_interval
+        self._counts = {}
+        self._synced_at = None
+        self._lock = threading.Lock()
+
+    def seed(self, legacy_counts):
+        """Import counts kept in the registry JSON before the counter table existed"""
+        existing = {key for (key,) in db.session.query(FirmwareDownloadCount.firmware_key).all()}
+        added = False
+        for firmware_key, count in legacy_counts.items():
+            if count and firmware_key not in existing:
+                db.session.add(FirmwareDownloadCount(firmware_key=firmware_key, download_count=count))
+                added = True
+        if added:
+            db.session.commit()
+
+    def sync(self, force=False):
+        """
+        Re-read counters written by any worker
+
+        Returns:
+            dict: firmware_key -> change since the previous sync
+        """
+        now = time.monotonic()
+        if not force and self._synced_at is not None and now - self._synced_at < self.resync_interval:
+            return {}
+
+        rows = db.session.query(FirmwareDownloadCount.firmware_key, FirmwareDownloadCount.download_count).all()
+        with self._lock:
+            deltas = {}
+            for firmware_key, count in rows:
+                delta = count - self._counts.get(firmware_key, 0)
+                if delta:
+                    deltas[firmware_key] = delta
+                self._counts[firmware_key] = count
+            self._synced_at = now
+        return deltas
+
+    def increment(self, firmware_key):
+        """
+        Count one download
+
+        The local copy is set from the stored count rather than bumped, so a sync
+        that already saw this download doesn't count it twice.
+
+        Returns:
+            int: Change in this worker's count (1, more if other workers' downloads
+                were picked up with it, 0 if a sync already counted this one)
+        """
+        now = datetime.utcnow()
+        for attempt in range(2):
+            try:
+                updated = db.session.execute(
+                    update(FirmwareDownloadCount)
+                    .where(FirmwareDownloadCount.firmware_key == firmware_key)
+                    .values(download_count=FirmwareDownloadCount.download_count + 1, last_download=now)
+                ).rowcount
+                if not updated:
+                    db.session.add(FirmwareDownloadCount(firmware_key=firmware_key, download_count=1, last_download=now))
+                count = db.session.query(FirmwareDownloadCount.download_count).filter_by(firmware_key=firmware_key).scalar()
+                db.session.commit()
+                break
+            except IntegrityError:
+                # Another worker inserted the first row at the same time; update it instead
+                db.session.rollback()
+                if attempt:
+                    raise
+            except Exception:
+                db.session.rollback()
+                raise
+
+        with self._lock:
+            delta = count - self._counts.get(firmware_key, 0)
+            self._counts[firmware_key] = count
+        return delta
+
+    def get(self, firmware_key, default=0):
+        return self._counts.get(firmware_key, default)
+
+    def forget(self, firmware_key):
+        """Drop the counter of a deleted firmware"""
+        FirmwareDownloadCount.query.filter_by(firmware_key=firmware_key).delete()
+        db.session.commit()
+        with self._lock:
+            self._counts.pop(firmware_key, None)
+
+
+class OTAStatistics:
+    """Running aggregates behind /api/ota/stats"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.total_versions = 0
+        self.total_downloads = 0
+        self.device_types = {}  # device_type -> {'count', 'total_downloads', 'latest_version'}
+        self.recent_uploads = deque(maxlen=RECENT_UPLOADS_LIMIT)
+        self._key_types = {}  # firmware_key -> device_type, to attribute downloads
+
+    def rebuild(self, firmware_versions, download_counts):
+        """Build every aggregate from scratch (startup and registry reloads)"""
+        with self._lock:
+            self.total_versions = 0
+            self.total_downloads = 0
+            self.device_types = {}
+            self._key_types = {}
+            for firmware_key, firmware in firmware_versions.items():
+                self._add(firmware_key, firmware, download_counts.get(firmware_key, 0))
+
+            newest = sorted(firmware_versions.values(), key=lambda fw: fw['upload_date'], reverse=True)
+            self.recent_uploads = deque(newest[:RECENT_UPLOADS_LIMIT], maxlen=RECENT_UPLOADS_LIMIT)
+
+    def _add(self, firmware_key, firmware, downloads):
+        device_type = firmware['device_type']
+        entry = self.device_types.setdefault(device_type, {
+            'count': 0,
+            'latest_version': None,
+            'total_downloads': 0
+        })
+        entry['count'] += 1
+        entry['total_downloads'] += downloads
+        current_latest = entry['latest_version']
+        if current_latest is None or parse_upload_date(firmware['upload_date']) > parse_upload_date(current_latest['upload_date']):
+            entry['latest_version'] = firmware
+
+        self._key_types[firmware_key] = device_type
+        self.total_versions += 1
+        self.total_downloads += downloads
+
+    def on_upload(self, firmware_key, firmware):
+        with self._lock:
+            self._add(firmware_key, firmware, 0)
+            # Uploads are timestamped now, so they are always the newest
+            self.recent_uploads.appendleft(firmware)
+
+    def on_delete(self, firmware_key, firmware, downloads, firmware_versions):
+        """Remove a firmware; only its device type and the recent list are recomputed"""
+        device_type = firmware['device_type']
+        with self._lock:
+            self._key_types.pop(firmware_key, None)
+            self.total_versions -= 1
+            self.total_downloads -= downloads
+
+            entry = self.device_types.get(device_type)
+            if entry:
+                entry['count'] -= 1
+                entry['total_downloads'] -= downloads
+                if entry['count'] <= 0:
+                    del self.device_types[device_type]
+                elif entry['latest_version'] is firmware:
+                    same_type = [fw for fw in firmware_versions.values() if fw['device_type'] == device_type]
+                    entry['latest_version'] = max(same_type, key=lambda fw: parse_upload_date(fw['upload_date']))
+
+            if any(fw is firmware for fw in self.recent_uploads):
+                newest = sorted(firmware_versions.values(), key=lambda fw: fw['upload_date'], reverse=True)
+                self.recent_uploads = deque(newest[:RECENT_UPLOADS_LIMIT], maxlen=RECENT_UPLOADS_LIMIT)
+
+    def on_downloads(self, firmware_key, count=1):
+        with self._lock:
+            device_type = self._key_types.get(firmware_key)
+            if device_type is None:
+                return
+            self.total_downloads += count
+            self.device_types[device_type]['total_downloads'] += count
+
+    def snapshot(self):
+        """Statistics in the shape returned by /api/ota/stats"""
+        with self._lock:
+            return {
+                'total_firmware_versions': self.total_versions,
+                'total_downloads': self.total_downloads,
+                'device_types': {device_type: dict(entry) for device_type, entry in self.device_types.items()},
+                'recent_uploads': list(self.recent_uploads)
+            }
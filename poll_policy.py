@@ -0,0 +1,140 @@
+"""
+Device Poll Scheduling
+Computes the next_poll_seconds hint returned to devices, so the fleet polls when a
+change is actually due instead of on a fixed timer, and spreads polls with a stable
+per-device offset so the fleet does not move in lockstep after a restart
+"""
+
+import math
+import time
+import zlib
+import threading
+import logging
+from datetime import datetime
+
+logger = logging.getLogger(__name__)
+
+
+class PollPolicy:
+    """
+    Next-poll scheduling for device responses
+
+    A device is asked back at the earliest known change (content refresh, rollout
+    retry) or after the base interval, stretched while it sleeps, during quiet hours
+    and while this process serves more device requests than its target rate.
+    """
+
+    def __init__(self, base_interval=60, min_interval=5, max_interval=900, jitter=0.2,
+                 sleep_factor=4.0, quiet_hours=None, target_rps=100, spread=30, load_window=10):
+        """
+        Args:
+            base_interval: Poll interval when no change is scheduled sooner
+            min_interval / max_interval: Bounds of every hint
+            jitter: Fraction the interval is varied by per device (0.2 = +/-20%)
+            sleep_factor: Interval multiplier for devices in sleep mode
+            quiet_hours: (start_hour, end_hour) in server local time, or None
+            target_rps: Device requests per second this process aims for (0 = ignore load)
+            spread: Seconds over which polls due at the same moment are spread
+            load_window: Seconds of request history used for the load estimate
+        """
+        self.base_interval = base_interval
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.jitter = jitter
+        self.sleep_factor = sleep_factor
+        self.quiet_hours = tuple(quiet_hours) if quiet_hours else None
+        self.target_rps = target_rps
+        self.spread = spread
+        self.load_window = load_window
+        self._requests = {}  # unix second -> device requests served
+        self._sleeping = set()
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            base_interval=config.get('POLL_BASE_INTERVAL_SECONDS', 60),
+            min_interval=config.get('POLL_MIN_INTERVAL_SECONDS', 5),
+            max_interval=config.get('POLL_MAX_INTERVAL_SECONDS', 900),
+            jitter=config.get('POLL_JITTER', 0.2),
+            sleep_factor=config.get('POLL_SLEEP_FACTOR', 4.0),
+            quiet_hours=config.get('POLL_QUIET_HOURS'),
+            target_rps=config.get('POLL_TARGET_RPS', 100)
+        )
+
+    @staticmethod
+    def device_offset(device_id):
+        """Stable position of a device in [0, 1), used to spread the fleet"""
+        return zlib.crc32(str(device_id).encode('utf-8')) / 2 ** 32
+
+    def record_request(self, now=None):
+        """Count one device request towards the load estimate"""
+        second = int(now if now is not None else time.time())
+        with self._lock:
+            self._requests[second] = self._requests.get(second, 0) + 1
+            if len(self._requests) > 2 * self.load_window:
+                for old in [s for s in self._requests if s <= second - self.load_window]:
+                    del self._requests[old]
+
+    def request_rate(self, now=None):
+        """Device requests per second over the load window"""
+        second = int(now if now is not None else time.time())
+        with self._lock:
+            recent = sum(count for s, count in self._requests.items() if s > second - self.load_window)
+        return recent / self.load_window
+
+    def load_factor(self, now=None):
+        """How far over its target rate this process is (1.0 when at or under)"""
+        if not self.target_rps:
+            return 1.0
+        return max(1.0, self.request_rate(now) / self.target_rps)
+
+    def seconds_to_quiet_end(self, now=None):
+        """Seconds until quiet hours end, or None outside quiet hours"""
+        if not self.quiet_hours:
+            return None
+        start, end = self.quiet_hours
+        local = datetime.fromtimestamp(now if now is not None else time.time())
+        hour = local.hour
+        inside = start <= hour < end if start <= end else (hour >= start or hour < end)
+        if not inside:
+            return None
+        elapsed = hour * 3600 + local.minute * 60 + local.second
+        return (end * 3600 - elapsed) % 86400
+
+    def next_poll_seconds(self, device_id, due_in=None, sleep_mode=None, now=None):
+        """
+        Seconds until the device should poll again
+
+        Also counts the request towards the load estimate, so call it once per response.
+
+        Args:
+            device_id: Device the response is for
+            due_in: Seconds until the next known change for this device, if any
+            sleep_mode: The device's sleep mode when known (remembered for later calls)
+        """
+        now = now if now is not None else time.time()
+        self.record_request(now)
+        with self._lock:
+            if sleep_mode is not None:
+                if sleep_mode:
+                    self._sleeping.add(device_id)
+                else:
+                    self._sleeping.discard(device_id)
+            sleeping = device_id in self._sleeping
+
+        offset = self.device_offset(device_id)
+        interval = self.base_interval * (1 + self.jitter * (2 * offset - 1))
+        if sleeping:
+            interval *= self.sleep_factor
+
+        quiet_left = self.seconds_to_quiet_end(now)
+        if quiet_left is not None:
+            # Sleep through quiet hours; wake-ups are spread after they end
+            interval = max(interval, min(self.max_interval, quiet_left + offset * self.spread))
+        elif due_in is not None and due_in >= 0 and due_in + self.spread < interval:
+            # A known change comes first; devices come back spread over the following seconds
+            interval = due_in + offset * self.spread
+
+        interval *= self.load_factor(now)
+        return int(min(self.max_interval, max(self.min_interval, math.ceil(interval))))
@@ -0,0 +1,284 @@
+"""
+Device Presence Tracking
+Coalesces last_seen updates in memory and writes them to the Device table in batches.
+Device rows loaded through the ORM see the pending values, so reads stay fresh
+while the database lags by at most one flush interval. Devices going offline are
+found through a deadline heap, so the work scales with status changes, not fleet size.
+The cache of registered devices is dropped when another worker removes a device,
+which it announces through a shared generation counter.
+"""
+
+import heapq
+import threading
+import logging
+from datetime import datetime, timedelta
+from sqlalchemy import bindparam, event, or_, update
+from sqlalchemy.orm.attributes import set_committed_value
+
+from models import db, Device, StateGeneration, refresh_device_activity_statuses
+
+logger = logging.getLogger(__name__)
+
+
+class PresenceTracker:
+    """Write-behind buffer for Device.last_seen / is_active"""
+
+    GENERATION_NAME = 'devices'
+
+    def __init__(self, flush_interval=5.0, offline_timeout=300):
+        self.flush_interval = flush_interval
+        self.offline_timeout = timedelta(seconds=offline_timeout)
+        self._pending = {}  # device_id -> last_seen (latest wins)
+        self._inflight = {}  # Values being written by the current flush
+        self._deadlines = {}  # device_id -> when it goes offline unless seen again
+        self._heap = []  # (deadline, device_id), one entry per tracked device
+        self._known_devices = set()
+        self._known_generation = None  # Device generation the cache was built under
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def touch(self, device_id, when=None):
+        """Record that a device was seen; persisted on the next flush"""
+        when = when or datetime.utcnow()
+        with self._lock:
+            self._pending[device_id] = when
+            self._schedule(device_id, when + self.offline_timeout)
+
+    def _schedule(self, device_id, deadline):
+        # Moving a deadline later only updates the dict; expire() re-queues the stale heap entry
+        current = self._deadlines.get(device_id)
+        if current is None:
+            heapq.heappush(self._heap, (deadline, device_id))
+        elif deadline <= current:
+            return
+        self._deadlines[device_id] = deadline
+
+    def last_seen(self, device_id):
+        """Unflushed last_seen for a device, or None if nothing is pending"""
+        with self._lock:
+            return self._pending.get(device_id) or self._inflight.get(device_id)
+
+    def apply(self, device):
+        """
+        Overlay the pending last_seen onto a loaded Device
+
+        Uses committed values so the row is not marked dirty and the
+        overlay is never written back by an unrelated commit.
+        """
+        pending = self.last_seen(device.device_id)
+        if pending and (device.last_seen is None or pending > device.last_seen):
+            set_committed_value(device, 'last_seen', pending)
+            set_committed_value(device, 'is_active', True)
+
+    def overlay_reads(self):
+        """Apply pending presence to every Device the ORM loads or refreshes"""
+        if event.contains(Device, 'load', self._on_load):
+            return
+        event.listen(Device, 'load', self._on_load)
+        event.listen(Device, 'refresh', self._on_refresh)
+
+    def remove_overlay(self):
+        if event.contains(Device, 'load', self._on_load):
+            event.remove(Device, 'load', self._on_load)
+            event.remove(Device, 'refresh', self._on_refresh)
+
+    def _on_load(self, device, context):
+        self.apply(device)
+
+    def _on_refresh(self, device, context, attrs):
+        if attrs is None or 'last_seen' in attrs:
+            self.apply(device)
+
+    def device_exists(self, device_id):
+        """Check a device is registered, caching positive lookups"""
+        if self.is_known(device_id):
+            return True
+        generation = self.known_generation
+        exists = db.session.query(Device.id).filter_by(device_id=device_id).first() is not None
+        if exists:
+            self.remember(device_id, generation)
+        return exists
+
+    def is_known(self, device_id):
+        """True if the device was already found registered (no database lookup)"""
+        return device_id in self._known_devices
+
+    @property
+    def known_generation(self):
+        """Read before a lookup and pass to remember()"""
+        return self._known_generation
+
+    def remember(self, device_id, generation):
+        """
+        Cache a device found registered by another lookup
+
+        Args:
+            generation: known_generation read before the lookup; the device is not
+                cached if a removal elsewhere dropped the cache meanwhile
+        """
+        if generation == self._known_generation:
+            self._known_devices.add(device_id)
+
+    def bump_generation(self):
+        """Announce a device removal to every worker; call inside the deleting transaction"""
+        updated = db.session.execute(
+            update(StateGeneration)
+            .where(StateGeneration.name == self.GENERATION_NAME)
+            .values(generation=StateGeneration.generation + 1)
+        ).rowcount
+        if not updated:
+            db.session.add(StateGeneration(name=self.GENERATION_NAME, generation=1))
+
+    def sync_known_devices(self):
+        """
+        Drop the registered-device cache if a device was removed by any worker
+
+        Returns:
+            bool: True if the cache was dropped
+        """
+        row = db.session.get(StateGeneration, self.GENERATION_NAME)
+        generation = row.generation if row else 0
+        if generation == self._known_generation:
+            return False
+        self._known_devices = set()
+        self._known_generation = generation
+        return True
+
+    def forget(self, device_id):
+        """Drop cached state for a removed device"""
+        with self._lock:
+            self._pending.pop(device_id, None)
+            self._deadlines.pop(device_id, None)
+        self._known_devices.discard(device_id)
+
+    def flush(self):
+        """
+        Write all pending last_seen values in one bulk UPDATE
+
+        Returns:
+            int: Number of devices written
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            self._inflight = pending
+
+        devices = Device.__table__
+        stmt = devices.update().where(devices.c.device_id == bindparam('b_device_id')).values(
+            last_seen=bindparam('b_last_seen'),
+            is_active=True
+        )
+        try:
+            db.session.execute(stmt, [
+                {'b_device_id': device_id, 'b_last_seen': last_seen}
+                for device_id, last_seen in pending.items()
+            ])
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Presence flush failed for {len(pending)} devices: {e}")
+            # Put the values back unless a newer touch arrived meanwhile
+            with self._lock:
+                for device_id, last_seen in pending.items():
+                    self._pending.setdefault(device_id, last_seen)
+                self._inflight = {}
+            return 0
+        with self._lock:
+            self._inflight = {}
+        return len(pending)
+
+    def seed(self, now=None):
+        """
+        Cold start: settle is_active for the whole table, then track the active devices
+
+        Returns:
+            int: Number of devices being tracked
+        """
+        now = now or datetime.utcnow()
+        refresh_device_activity_statuses(int(self.offline_timeout.total_seconds()), now=now)
+        rows = db.session.execute(
+            db.select(Device.device_id, Device.last_seen).where(Device.is_active.is_(True))
+        ).all()
+        with self._lock:
+            for device_id, last_seen in rows:
+                self._schedule(device_id, last_seen + self.offline_timeout)
+        return len(rows)
+
+    def expire(self, now=None):
+        """
+        Mark devices whose deadline passed as inactive in one set-based UPDATE
+
+        Returns:
+            int: Number of devices switched to inactive
+        """
+        now = now or datetime.utcnow()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, device_id = heapq.heappop(self._heap)
+                current = self._deadlines.get(device_id)
+                if current is None:
+                    continue  # Forgotten
+                if current > deadline:
+                    heapq.heappush(self._heap, (current, device_id))  # Seen again since
+                    continue
+                del self._deadlines[device_id]
+                expired.append(device_id)
+        if not expired:
+            return 0
+
+        devices = Device.__table__
+        # The last_seen guard keeps devices seen by another worker online
+        stmt = devices.update().where(
+            devices.c.device_id.in_(expired),
+            devices.c.is_active.is_(True),
+            or_(devices.c.last_seen.is_(None), devices.c.last_seen <= now - self.offline_timeout)
+        ).values(is_active=False)
+        try:
+            changed = db.session.execute(stmt).rowcount
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Presence expiry failed for {len(expired)} devices: {e}")
+            with self._lock:
+                for device_id in expired:
+                    self._schedule(device_id, now)
+            return 0
+        if changed:
+            logger.info(f"{changed} device(s) went offline")
+        return changed
+
+    def start(self, app):
+        """Start the background flush and expiry thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            with app.app_context():
+                try:
+                    self.seed()
+                except Exception as e:
+                    db.session.rollback()
+                    logger.error(f"Presence seeding failed: {e}")
+            while not self._stop.wait(self.flush_interval):
+                with app.app_context():
+                    self.flush()
+                    self.expire()
+                    try:
+                        self.sync_known_devices()
+                    except Exception as e:
+                        db.session.rollback()
+                        logger.error(f"Presence device cache check failed: {e}")
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='presence-flush', daemon=True)
+        self._thread.start()
+
+    def stop(self, app=None):
+        """Stop the flush thread, writing anything still pending"""
+        self._stop.set()
+        if app is not None:
+            with app.app_context():
+                self.flush()
@@ -0,0 +1,107 @@
+"""
+Firmware Registry Watcher
+Reloads the OTA firmware registry when the uploaded or compiled registry file changes,
+so newly published builds are offered without a server restart
+"""
+
+import os
+import threading
+import logging
+
+try:
+    import inotify_simple
+    INOTIFY_AVAILABLE = True
+except ImportError:
+    INOTIFY_AVAILABLE = False
+
+logger = logging.getLogger(__name__)
+
+
+class RegistryWatcher:
+    """
+    Background thread watching both firmware registry files
+
+    Uses inotify on Linux when `inotify_simple` is installed and falls back to
+    polling each file's mtime and size every `interval` seconds otherwise.
+    """
+
+    def __init__(self, ota_manager, interval=2.0):
+        self.ota_manager = ota_manager
+        self.interval = interval
+        self._signatures = {}
+        self._stop_event = threading.Event()
+        self._thread = None
+
+    @property
+    def paths(self):
+        return [self.ota_manager.metadata_file, self.ota_manager.compiled_metadata_file]
+
+    @staticmethod
+    def _signature(path):
+        try:
+            stat = os.stat(path)
+            return (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            return None
+
+    def check(self):
+        """
+        Reload the registry if either file changed since the last check
+
+        Returns:
+            bool: True if the registry was reloaded with changes
+        """
+        signatures = {path: self._signature(path) for path in self.paths}
+        if signatures == self._signatures:
+            return False
+        self._signatures = signatures
+        try:
+            return self.ota_manager.reload_registry()
+        except Exception as e:
+            logger.error(f"Firmware registry reload failed: {e}")
+            return False
+
+    def start(self):
+        """Start watching in a daemon thread"""
+        if self._thread and self._thread.is_alive():
+            return
+        self._signatures = {path: self._signature(path) for path in self.paths}
+        self._stop_event.clear()
+        target = self._run_inotify if INOTIFY_AVAILABLE else self._run_polling
+        self._thread = threading.Thread(target=target, name='registry-watcher', daemon=True)
+        self._thread.start()
+        logger.info(f"Firmware registry watcher started ({'inotify' if INOTIFY_AVAILABLE else 'polling'})")
+
+    def stop(self):
+        self._stop_event.set()
+        if self._thread:
+            self._thread.join(timeout=self.interval + 1)
+            self._thread = None
+
+    def _run_polling(self):
+        while not self._stop_event.wait(self.interval):
+            self.check()
+
+    def _run_inotify(self):
+        flags = inotify_simple.flags
+        mask = flags.CLOSE_WRITE | flags.MOVED_TO | flags.CREATE | flags.DELETE
+        try:
+            inotify = inotify_simple.INotify()
+            # Watch the directories: editors and atomic writers replace the file itself
+            for directory in {os.path.dirname(os.path.abspath(path)) for path in self.paths}:
+                if os.path.isdir(directory):
+                    inotify.add_watch(directory, mask)
+        except OSError as e:
+            logger.warning(f"inotify unavailable ({e}), polling the firmware registry instead")
+            self._run_polling()
+            return
+
+        names = {os.path.basename(path) for path in self.paths}
+        with inotify:
+            while not self._stop_event.is_set():
+                events = inotify.read(timeout=int(self.interval * 1000))
+                if any(event.name in names for event in events):
+                    self.check()
+                elif not events:
+                    # Also catches directories created after startup
+                    self.check()
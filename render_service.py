@@ -0,0 +1,287 @@
+"""
+Render Worker Pool
+Runs dashboard rendering and image conversion (CPU-bound PIL work) in worker
+processes, so a slow render doesn't hold the GIL in a request thread while
+heartbeats wait behind it. Jobs queue in priority lanes (device polls ahead of
+admin previews) and at most one job per worker is handed to the pool at a time,
+so a later device job can still overtake queued admin jobs. A full queue is
+rejected up front rather than letting requests pile up. A job that outlives its
+timeout inside a worker gets the pool recycled, so a hung render can't hold a
+worker forever.
+"""
+
+import time
+import heapq
+import logging
+import threading
+import multiprocessing
+from dataclasses import dataclass, fields
+from datetime import datetime
+from typing import Optional
+from concurrent.futures import Future, ProcessPoolExecutor, TimeoutError as FutureTimeout
+from concurrent.futures.process import BrokenProcessPool
+
+from models import ImageProcessor
+from atomic_files import FSYNC_FILE
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_DEVICE = 0
+PRIORITY_ADMIN = 1
+LANES = {PRIORITY_DEVICE: 'device', PRIORITY_ADMIN: 'admin'}
+
+
+class RenderBusy(Exception):
+    """The render pool could not produce a result in time"""
+    retry_after = 5
+
+
+class RenderQueueFull(RenderBusy):
+    pass
+
+
+class RenderTimeout(RenderBusy):
+    pass
+
+
+@dataclass
+class DeviceSnapshot:
+    """The Device fields a dashboard shows, as a plain picklable object"""
+    device_id: str
+    device_name: str
+    nickname: Optional[str] = None
+    occupation: Optional[str] = None
+    temperature: Optional[float] = None
+    humidity: Optional[float] = None
+    motion_detected: Optional[bool] = None
+    sleep_mode: Optional[bool] = None
+    sensor_last_update: Optional[datetime] = None
+    custom_content_enabled: Optional[bool] = None
+
+    @classmethod
+    def from_device(cls, device):
+        return cls(**{field.name: getattr(device, field.name) for field in fields(cls)})
+
+
+def render_dashboard_job(snapshot, content, dashboard_folder, fsync=FSYNC_FILE):
+    """Worker-side dashboard render; returns (current dashboard path, BMP bytes, SHA-256)"""
+    return ImageProcessor.generate_dashboard_frame(snapshot, content,
+                                                   app_config={'DASHBOARD_FOLDER': dashboard_folder, 'FRAME_FSYNC': fsync})
+
+
+def convert_bmp_job(image_path, output_path, size=(800, 480), fsync=FSYNC_FILE):
+    """Worker-side conversion of an upload to a monochrome BMP"""
+    return ImageProcessor.convert_to_bmp(image_path, output_path, size, fsync)
+
+
+def _mp_context():
+    # Workers must not inherit the server's threads and locks, so never plain fork
+    methods = multiprocessing.get_all_start_methods()
+    return multiprocessing.get_context('forkserver' if 'forkserver' in methods else 'spawn')
+
+
+class _Job:
+    __slots__ = ('fn', 'args', 'priority', 'future', 'enqueued', 'started', 'pool', 'done')
+
+    def __init__(self, fn, args, priority):
+        self.fn = fn
+        self.args = args
+        self.priority = priority
+        self.future = Future()
+        self.enqueued = time.monotonic()
+        self.started = None
+        self.pool = None  # The executor running it
+        self.done = False
+
+
+class RenderService:
+    """Priority queue in front of a process pool for rendering jobs"""
+
+    def __init__(self, workers=2, max_queue=32, timeout=20.0):
+        self.workers = workers
+        self.max_queue = max_queue
+        self.timeout = timeout
+        self._queue = []  # (priority, seq, job)
+        self._seq = 0
+        self._running = 0
+        self._active = set()  # Jobs handed to the pool and not finished yet
+        self._pool = None
+        self._cond = threading.Condition()
+        self._stop = False
+        self._thread = None
+        self._stats = {'completed': 0, 'failed': 0, 'timeouts': 0, 'pool_restarts': 0}
+        self._rejected = {lane: 0 for lane in LANES.values()}
+        self._render_seconds = 0.0
+        self._wait_seconds = 0.0
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(
+            workers=config.get('RENDER_WORKERS', 2),
+            max_queue=config.get('RENDER_MAX_QUEUE', 32),
+            timeout=config.get('RENDER_TIMEOUT_SECONDS', 20)
+        )
+
+    def start(self):
+        """Start dispatching; worker processes are spawned on the first job"""
+        if not self.workers or self._thread is not None:
+            return
+        self._stop = False
+        self._thread = threading.Thread(target=self._dispatch, name='render-dispatch', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Fail queued jobs and shut the worker processes down"""
+        with self._cond:
+            self._stop = True
+            queued, self._queue = self._queue, []
+            self._cond.notify_all()
+        for _, _, job in queued:
+            if job.future.set_running_or_notify_cancel():
+                job.future.set_exception(RenderBusy('Render service stopped'))
+        if self._thread:
+            self._thread.join(timeout=5)
+            self._thread = None
+        if self._pool is not None:
+            self._pool.shutdown(wait=False, cancel_futures=True)
+            self._pool = None
+
+    def submit(self, fn, *args, priority=PRIORITY_DEVICE):
+        """
+        Queue a job for the worker pool
+
+        Admin jobs may only fill half the queue, so previews never crowd out devices.
+
+        Returns:
+            concurrent.futures.Future: Completed with the job's result
+
+        Raises:
+            RenderQueueFull: The lane is at capacity
+        """
+        return self._submit(fn, args, priority).future
+
+    def _submit(self, fn, args, priority):
+        job = _Job(fn, args, priority)
+        if self._thread is None:
+            # No pool (RENDER_WORKERS = 0 or not started): run in the calling thread
+            job.future.set_running_or_notify_cancel()
+            try:
+                job.future.set_result(fn(*args))
+            except Exception as e:
+                job.future.set_exception(e)
+            return job
+
+        limit = self.max_queue if priority == PRIORITY_DEVICE else self.max_queue // 2
+        with self._cond:
+            if len(self._queue) >= limit:
+                self._rejected[LANES.get(priority, 'admin')] += 1
+                raise RenderQueueFull(f"Render queue full ({len(self._queue)} jobs waiting)")
+            self._seq += 1
+            heapq.heappush(self._queue, (priority, self._seq, job))
+            self._cond.notify_all()
+        return job
+
+    def run(self, fn, *args, priority=PRIORITY_DEVICE, timeout=None):
+        """
+        Submit a job and wait for its result
+
+        Raises:
+            RenderQueueFull: The lane is at capacity
+            RenderTimeout: No result within the timeout; a job still queued is dropped,
+                and a job already running gets its worker pool replaced
+        """
+        timeout = timeout or self.timeout
+        job = self._submit(fn, args, priority)
+        try:
+            return job.future.result(timeout)
+        except FutureTimeout:
+            with self._cond:
+                self._stats['timeouts'] += 1
+            if not job.future.cancel() and not job.done and job.pool is not None:
+                # Running in a worker: a hung job would hold that worker and its slot forever
+                logger.error(f"Render job ran past {timeout}s, restarting the worker pool")
+                self._recycle_pool(job.pool, RenderBusy('Render worker pool restarted after a hung job'))
+            raise RenderTimeout(f"Render did not finish within {timeout}s")
+
+    def _dispatch(self):
+        while True:
+            with self._cond:
+                while not self._stop and (not self._queue or self._running >= self.workers):
+                    self._cond.wait()
+                if self._stop:
+                    return
+                _, _, job = heapq.heappop(self._queue)
+                if not job.future.set_running_or_notify_cancel():
+                    continue  # The caller timed out while it was queued
+                self._running += 1
+                self._active.add(job)
+                job.started = time.monotonic()
+                self._wait_seconds += job.started - job.enqueued
+            try:
+                job.pool = self._get_pool()
+                pool_future = job.pool.submit(job.fn, *job.args)
+            except (BrokenProcessPool, RuntimeError) as e:
+                self._finish(job, error=e)
+                continue
+            pool_future.add_done_callback(lambda done, job=job: self._finish(job, done))
+
+    def _get_pool(self):
+        if self._pool is None:
+            self._pool = ProcessPoolExecutor(self.workers, mp_context=_mp_context())
+            logger.info(f"Started {self.workers} render worker processes")
+        return self._pool
+
+    def _recycle_pool(self, pool, error):
+        """Shut down a pool with a hung or dead worker, failing the jobs still running in it"""
+        with self._cond:
+            if pool is None or pool is not self._pool:
+                return  # Already replaced
+            self._pool = None
+            self._stats['pool_restarts'] += 1
+            stranded = [job for job in self._active if job.pool is pool]
+        processes = list((getattr(pool, '_processes', None) or {}).values())
+        pool.shutdown(wait=False, cancel_futures=True)
+        for process in processes:
+            process.terminate()  # A hung PIL call never returns on its own
+        for job in stranded:
+            self._finish(job, error=error)
+
+    def _finish(self, job, done=None, error=None):
+        if done is not None:
+            error = RenderBusy('Render worker pool restarted') if done.cancelled() else done.exception()
+        if isinstance(error, BrokenProcessPool) and not job.done:
+            # A worker died (e.g. a crash inside PIL); replace the pool for later jobs
+            logger.error(f"Render worker pool broke, restarting it: {error}")
+            self._recycle_pool(job.pool, error)
+        with self._cond:
+            if job.done:
+                return  # Already failed when its pool was recycled
+            job.done = True
+            self._active.discard(job)
+            self._running -= 1
+            self._stats['failed' if error else 'completed'] += 1
+            self._render_seconds += time.monotonic() - job.started
+            self._cond.notify_all()
+        if error is not None:
+            job.future.set_exception(error)
+        else:
+            job.future.set_result(done.result())
+
+    def get_status(self):
+        """Queue depth per lane and job counters"""
+        with self._cond:
+            queued = {lane: 0 for lane in LANES.values()}
+            for priority, _, _ in self._queue:
+                queued[LANES.get(priority, 'admin')] += 1
+            finished = self._stats['completed'] + self._stats['failed']
+            return {
+                'mode': 'process' if self._thread is not None else 'inline',
+                'workers': self.workers,
+                'max_queue': self.max_queue,
+                'queued': queued,
+                'running': self._running,
+                'rejected': dict(self._rejected),
+                **self._stats,
+                'avg_render_seconds': round(self._render_seconds / finished, 3) if finished else None,
+                'avg_queue_seconds': round(self._wait_seconds / finished, 3) if finished else None
+            }
@@ -0,0 +1,333 @@
+"""
+OTA Rollout Guard
+Compares the health of devices on the newest firmware build with the build before it
+(free heap floor, reboots inferred from uptime resets, heartbeat gaps) and halts the
+rollout when a threshold is breached, so devices are offered the previous build again
+
+Each worker only sees its share of a device's heartbeats, so heartbeats are buffered
+and every flush compares them with the device's last heartbeat stored in the database
+(from whichever worker saw it) and appends per-minute health counts. Evaluations merge
+the counts of all workers.
+"""
+
+import time
+import threading
+import logging
+from sqlalchemy import bindparam, delete, func, select
+from sqlalchemy.exc import IntegrityError
+
+from models import db, RolloutDeviceState, RolloutHealthSample
+from fleet_telemetry import QuantileSketch, is_metric
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_THRESHOLDS = {
+    'min_devices': 5,  # Devices reporting the new build before it is judged
+    'heap_floor_quantile': 0.05,  # The "floor" is this quantile of free heap
+    'heap_floor_drop': 0.25,  # Floor may be at most this fraction below the previous build
+    'min_heap_floor': 16 * 1024,  # Absolute floor in bytes, also used without a baseline
+    'reboot_rate': 0.5,  # Reboots per device in the window...
+    'reboot_ratio': 2.0,  # ...and this many times the previous build's rate
+    'gap_rate': 0.2,  # Share of heartbeat intervals longer than gap_seconds...
+    'gap_ratio': 2.0,  # ...and this many times the previous build's share
+    'gap_seconds': 180
+}
+
+QUERY_CHUNK = 500  # Device IDs per IN (...) lookup
+
+
+class _HealthBucket:
+    """Heartbeat health of one firmware version during one minute"""
+
+    __slots__ = ('heartbeats', 'reboots', 'intervals', 'gaps', 'heap')
+
+    def __init__(self):
+        self.heartbeats = 0
+        self.reboots = 0
+        self.intervals = 0
+        self.gaps = 0
+        self.heap = QuantileSketch()
+
+
+class RolloutGuard:
+    """
+    Watches heartbeats per firmware version and halts unhealthy rollouts
+
+    Only the build currently offered by update checks is judged, against the build
+    that would be offered if it were halted. Halting goes through the OTA manager's
+    registry, so every worker stops offering the build.
+
+    The flush interval should stay below the device heartbeat interval, so two
+    workers rarely hold heartbeats of the same device at once.
+    """
+
+    def __init__(self, ota_manager, window=1800, check_interval=30.0, thresholds=None, flush_interval=10.0):
+        self.ota_manager = ota_manager
+        self.window = window
+        self.check_interval = check_interval
+        self.flush_interval = flush_interval
+        self.thresholds = {**DEFAULT_THRESHOLDS, **(thresholds or {})}
+        self._pending = []  # (ts, device_id, version, free_heap, uptime) not yet written
+        self._last_check = 0
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def observe(self, device_id, version, free_heap=None, uptime=None, ts=None):
+        """Record one heartbeat (written by the next flush)"""
+        if not version:
+            return
+        ts = ts if ts is not None else time.time()
+        free_heap = free_heap if is_metric(free_heap) else None
+        uptime = uptime if is_metric(uptime) else None
+        with self._lock:
+            self._pending.append((ts, device_id, version, free_heap, uptime))
+
+    def forget(self, device_id):
+        """Drop a removed device's last heartbeat (caller commits)"""
+        with self._lock:
+            self._pending = [heartbeat for heartbeat in self._pending if heartbeat[1] != device_id]
+        db.session.execute(delete(RolloutDeviceState).where(RolloutDeviceState.device_id == device_id))
+
+    def _load_states(self, device_ids):
+        t = RolloutDeviceState
+        device_ids = sorted(device_ids)
+        states = {}
+        for i in range(0, len(device_ids), QUERY_CHUNK):
+            rows = db.session.execute(
+                select(t.device_id, t.firmware_version, t.uptime, t.last_heartbeat)
+                .where(t.device_id.in_(device_ids[i:i + QUERY_CHUNK]))
+            ).all()
+            states.update({row[0]: tuple(row[1:]) for row in rows})
+        return states
+
+    def _measure(self, pending, states):
+        """
+        Health counts of buffered heartbeats, compared with each device's previous one
+
+        Returns:
+            tuple: ({(version, minute): _HealthBucket}, {device_id: (version, uptime, ts)} to store)
+        """
+        buckets = {}
+        latest = {}
+        for ts, device_id, version, free_heap, uptime in sorted(pending, key=lambda heartbeat: heartbeat[0]):
+            key = (version, int(ts) // 60)
+            bucket = buckets.get(key)
+            if bucket is None:
+                bucket = buckets[key] = _HealthBucket()
+            bucket.heartbeats += 1
+            if free_heap is not None:
+                bucket.heap.add(free_heap)
+
+            previous = latest.get(device_id) or states.get(device_id)
+            if previous and previous[2] >= ts:
+                continue  # Another worker already stored a later heartbeat
+            # A version change is the OTA reboot itself, not a health signal
+            if previous and previous[0] == version:
+                _, last_uptime, last_ts = previous
+                bucket.intervals += 1
+                if ts - last_ts > self.thresholds['gap_seconds']:
+                    bucket.gaps += 1
+                if uptime is not None and last_uptime is not None and uptime < last_uptime:
+                    bucket.reboots += 1
+            latest[device_id] = (version, uptime, ts)
+        return buckets, latest
+
+    def _write(self, buckets, latest):
+        t = RolloutDeviceState.__table__
+        existing = self._load_states(latest)
+        updates = [{'_device_id': device_id, '_version': version, '_uptime': uptime, '_ts': ts}
+                   for device_id, (version, uptime, ts) in latest.items() if device_id in existing]
+        if updates:
+            db.session.execute(
+                t.update()
+                .where(t.c.device_id == bindparam('_device_id'), t.c.last_heartbeat < bindparam('_ts'))
+                .values(firmware_version=bindparam('_version'), uptime=bindparam('_uptime'),
+                        last_heartbeat=bindparam('_ts')),
+                updates
+            )
+        db.session.add_all([
+            RolloutDeviceState(device_id=device_id, firmware_version=version, uptime=uptime, last_heartbeat=ts)
+            for device_id, (version, uptime, ts) in latest.items() if device_id not in existing
+        ])
+        db.session.add_all([
+            RolloutHealthSample(firmware_version=version, minute=minute, heartbeats=bucket.heartbeats,
+                                reboots=bucket.reboots, intervals=bucket.intervals, gaps=bucket.gaps,
+                                heap=bucket.heap.to_json())
+            for (version, minute), bucket in buckets.items()
+        ])
+        db.session.flush()
+
+    def flush(self):
+        """
+        Write the buffered heartbeats' health counts and each device's latest heartbeat
+
+        Returns:
+            int: Number of heartbeats written
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, []
+
+        try:
+            buckets, latest = self._measure(pending, self._load_states({heartbeat[1] for heartbeat in pending}))
+            try:
+                self._write(buckets, latest)
+                db.session.commit()
+            except IntegrityError:
+                # Another worker stored a device's first heartbeat at the same time
+                db.session.rollback()
+                self._write(buckets, latest)
+                db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Rollout guard flush failed: {e}")
+            with self._lock:
+                self._pending = pending + self._pending
+            return 0
+        return len(pending)
+
+    def version_health(self, version, now=None):
+        """Health of one firmware version over the window, from every worker's counts"""
+        now = now if now is not None else time.time()
+        first_minute = int(now - self.window) // 60
+        s = RolloutHealthSample
+        rows = db.session.execute(
+            select(s.heartbeats, s.reboots, s.intervals, s.gaps, s.heap)
+            .where(s.firmware_version == version, s.minute >= first_minute)
+        ).all()
+        totals = _HealthBucket()
+        for heartbeats, reboots, intervals, gaps, heap in rows:
+            totals.heartbeats += heartbeats
+            totals.reboots += reboots
+            totals.intervals += intervals
+            totals.gaps += gaps
+            totals.heap.merge(QuantileSketch.from_json(heap))
+        d = RolloutDeviceState
+        devices = db.session.scalar(
+            select(func.count()).select_from(d)
+            .where(d.firmware_version == version, d.last_heartbeat >= now - self.window)
+        )
+        return {
+            'version': version,
+            'devices': devices,
+            'heartbeats': totals.heartbeats,
+            'reboots': totals.reboots,
+            'reboots_per_device': round(totals.reboots / devices, 3) if devices else 0.0,
+            'gap_rate': round(totals.gaps / totals.intervals, 3) if totals.intervals else 0.0,
+            'heap_floor': totals.heap.quantile(self.thresholds['heap_floor_quantile']),
+            'heap_median': totals.heap.quantile(0.5)
+        }
+
+    def apply_retention(self, now=None):
+        """Delete health counts older than the window and devices silent for two windows"""
+        now = now if now is not None else time.time()
+        db.session.execute(delete(RolloutHealthSample).where(RolloutHealthSample.minute < int(now - self.window) // 60))
+        db.session.execute(delete(RolloutDeviceState).where(RolloutDeviceState.last_heartbeat < now - 2 * self.window))
+        db.session.commit()
+
+    def breaches(self, candidate, baseline):
+        """Threshold breaches of the candidate build's health compared to the baseline"""
+        t = self.thresholds
+        found = []
+        floor = candidate['heap_floor']
+        if floor is not None:
+            if floor < t['min_heap_floor']:
+                found.append(f"heap floor {floor:.0f} B below {t['min_heap_floor']} B")
+            elif baseline and baseline['heap_floor'] and floor < baseline['heap_floor'] * (1 - t['heap_floor_drop']):
+                found.append(f"heap floor {floor:.0f} B vs {baseline['heap_floor']:.0f} B on {baseline['version']}")
+
+        base_reboots = baseline['reboots_per_device'] if baseline else 0.0
+        rate = candidate['reboots_per_device']
+        if rate >= t['reboot_rate'] and rate > base_reboots * t['reboot_ratio']:
+            found.append(f"{rate} reboots per device vs {base_reboots}")
+
+        base_gaps = baseline['gap_rate'] if baseline else 0.0
+        gaps = candidate['gap_rate']
+        if gaps >= t['gap_rate'] and gaps > base_gaps * t['gap_ratio']:
+            found.append(f"{gaps:.0%} heartbeat gaps vs {base_gaps:.0%}")
+        return found
+
+    def evaluate(self, now=None):
+        """
+        Judge the build currently offered against the one before it
+
+        Returns:
+            dict: candidate and baseline health plus any breaches (None if nothing is offered)
+        """
+        now = now if now is not None else time.time()
+        releases = self.ota_manager.get_release_order()
+        if not releases:
+            return None
+        candidate_key, candidate_fw = releases[0]
+        candidate = self.version_health(candidate_fw['version'], now)
+        baseline = None
+        if len(releases) > 1 and releases[1][1]['version'] != candidate_fw['version']:
+            baseline = self.version_health(releases[1][1]['version'], now)
+            baseline['firmware_key'] = releases[1][0]
+            if baseline['devices'] < self.thresholds['min_devices']:
+                baseline = None  # Too few devices to compare against; absolute limits only
+        candidate['firmware_key'] = candidate_key
+
+        judged = candidate['devices'] >= self.thresholds['min_devices']
+        return {
+            'candidate': candidate,
+            'baseline': baseline,
+            'judged': judged,
+            'breaches': self.breaches(candidate, baseline) if judged else []
+        }
+
+    def check(self, now=None):
+        """
+        Evaluate and halt the candidate build if it breached a threshold
+
+        Returns:
+            dict: The evaluation, with 'halted' set when the build was halted
+        """
+        report = self.evaluate(now)
+        if not report or not report['breaches']:
+            return report
+        candidate = report['candidate']
+        reason = '; '.join(report['breaches'])
+        report['halted'] = self.ota_manager.halt_firmware(candidate['firmware_key'], reason, {
+            'candidate': candidate,
+            'baseline': report['baseline']
+        })
+        return report
+
+    def run_once(self, now=None):
+        """Flush, then apply retention and check the rollout every `check_interval` seconds (0 = no checks)"""
+        now = now if now is not None else time.time()
+        self.flush()
+        if now - self._last_check < (self.check_interval or 60):
+            return
+        self._last_check = now
+        try:
+            self.apply_retention(now)
+            if self.check_interval:
+                self.check(now)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Rollout guard check failed: {e}")
+
+    def start(self, app):
+        """Start the background flush and check thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            while not self._stop.wait(self.flush_interval):
+                with app.app_context():
+                    self.run_once()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='rollout-guard', daemon=True)
+        self._thread.start()
+
+    def stop(self, app=None):
+        """Stop the thread, writing any buffered heartbeats"""
+        self._stop.set()
+        if app is not None:
+            with app.app_context():
+                self.flush()
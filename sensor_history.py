@@ -0,0 +1,449 @@
+"""
+Sensor History
+Time-series store for device sensor readings: a batching writer for raw readings,
+background min/max/avg rollups (1 minute, 1 hour, 1 day) with retention, and range
+queries that read from the coarsest tier that still gives enough points
+"""
+
+import time
+import threading
+import logging
+from datetime import datetime, timezone
+from sqlalchemy import select, insert, delete, func, case
+
+from models import db, SensorReading, SensorRollup
+
+logger = logging.getLogger(__name__)
+
+MINUTE = 60
+HOUR = 3600
+DAY = 86400
+
+# Rollup tiers, finest first; each tier is built from the one before it
+ROLLUP_RESOLUTIONS = (MINUTE, HOUR, DAY)
+
+# Seconds of history kept per tier (0 = raw readings, None = keep forever)
+DEFAULT_RETENTION = {
+    0: 7 * DAY,
+    MINUTE: 30 * DAY,
+    HOUR: 365 * DAY,
+    DAY: None
+}
+
+FLAG_MOTION = 1
+FLAG_SLEEP = 2
+
+# Largest batch accepted from a device, and how far ahead of the server clock a reading may be
+MAX_BATCH_READINGS = 500
+MAX_CLOCK_SKEW = 300
+
+# Readings are stored as hundredths in a SMALLINT
+_SCALED_MIN, _SCALED_MAX = -32768, 32767
+
+
+def to_unix(value):
+    """Convert a datetime (naive = UTC), ISO string or number to unix seconds"""
+    if value is None:
+        return None
+    if isinstance(value, (int, float)):
+        return int(value)
+    if isinstance(value, str):
+        value = value.strip()
+        if value.lstrip('-').isdigit():
+            return int(value)
+        value = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    if value.tzinfo is None:
+        value = value.replace(tzinfo=timezone.utc)
+    return int(value.timestamp())
+
+
+def _scale(value):
+    """Float reading -> hundredths, or None if missing or out of range"""
+    if value is None or isinstance(value, bool):
+        return None
+    try:
+        scaled = int(round(float(value) * 100))
+    except (TypeError, ValueError):
+        return None
+    if not _SCALED_MIN <= scaled <= _SCALED_MAX:
+        return None
+    return scaled
+
+
+def _unscale(value):
+    return value / 100.0 if value is not None else None
+
+
+class SensorHistory:
+    """
+    Batching writer and rollup engine for sensor readings
+
+    Requests only append to an in-memory buffer. A background thread inserts
+    the buffer in one transaction every `flush_interval` seconds (sooner once
+    `max_batch` readings are waiting) and refreshes the rollup buckets those
+    readings touched every `rollup_interval` seconds, so late or buffered
+    readings land in the right buckets.
+    """
+
+    def __init__(self, flush_interval=2.0, rollup_interval=60.0, max_batch=1000,
+                 retention=None, raw_max_span=3 * HOUR):
+        self.flush_interval = flush_interval
+        self.rollup_interval = rollup_interval
+        self.max_batch = max_batch
+        self.retention = {**DEFAULT_RETENTION, **(retention or {})}
+        self.raw_max_span = raw_max_span
+
+        self._buffer = []
+        self._dirty = {}  # device_pk -> [min_ts, max_ts] written since the last rollup
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._last_rollup = time.monotonic()
+
+    def make_row(self, device_pk, temperature=None, humidity=None, motion=None, sleep=None, ts=None):
+        """Build a compact reading row (validated, scaled)"""
+        flags = (FLAG_MOTION if motion else 0) | (FLAG_SLEEP if sleep else 0)
+        return {
+            'device_pk': device_pk,
+            'ts': to_unix(ts) if ts is not None else int(time.time()),
+            'temperature_centi': _scale(temperature),
+            'humidity_centi': _scale(humidity),
+            'flags': flags
+        }
+
+    def rows_from_batch(self, device_pk, readings, uptime=None, now=None):
+        """
+        Validate a batch of buffered readings from one device
+
+        Each reading carries one of `ts` (unix seconds or ISO), `age` (seconds
+        before the request) or `uptime` (device uptime when taken, relative to the
+        batch's `uptime`), plus any of temperature, humidity, motion_detected and
+        sleep_mode.
+
+        Returns:
+            tuple: (rows, rejected) where rejected lists {'index', 'error'}
+        """
+        now = int(now if now is not None else time.time())
+        oldest = now - self.retention[0] if self.retention.get(0) else None
+        rows = []
+        rejected = []
+        for index, reading in enumerate(readings):
+            if not isinstance(reading, dict):
+                rejected.append({'index': index, 'error': 'not an object'})
+                continue
+            try:
+                if reading.get('ts') is not None:
+                    ts = to_unix(reading['ts'])
+                elif reading.get('age') is not None:
+                    ts = now - int(reading['age'])
+                elif reading.get('uptime') is not None and uptime is not None:
+                    ts = now - (int(uptime) - int(reading['uptime']))
+                else:
+                    ts = now
+            except (TypeError, ValueError):
+                rejected.append({'index': index, 'error': 'invalid timestamp'})
+                continue
+            if ts > now + MAX_CLOCK_SKEW or (oldest is not None and ts < oldest):
+                rejected.append({'index': index, 'error': 'timestamp out of range'})
+                continue
+
+            row = self.make_row(device_pk, reading.get('temperature'), reading.get('humidity'),
+                                reading.get('motion_detected'), reading.get('sleep_mode'), ts)
+            if (row['temperature_centi'] is None and row['humidity_centi'] is None and
+                    'motion_detected' not in reading and 'sleep_mode' not in reading):
+                rejected.append({'index': index, 'error': 'no sensor values'})
+                continue
+            rows.append(row)
+        return rows, rejected
+
+    @staticmethod
+    def latest_values(rows):
+        """Device column values for the newest reading(s) in a batch"""
+        ordered = sorted(rows, key=lambda row: row['ts'])
+        newest = ordered[-1]
+        values = {
+            'motion_detected': bool(newest['flags'] & FLAG_MOTION),
+            'sleep_mode': bool(newest['flags'] & FLAG_SLEEP),
+            'sensor_last_update': datetime.fromtimestamp(newest['ts'], timezone.utc).replace(tzinfo=None)
+        }
+        for column, field in (('temperature', 'temperature_centi'), ('humidity', 'humidity_centi')):
+            latest = next((row[field] for row in reversed(ordered) if row[field] is not None), None)
+            if latest is not None:
+                values[column] = _unscale(latest)
+        return values
+
+    def record(self, device_pk, temperature=None, humidity=None, motion=None, sleep=None, ts=None):
+        """Queue one reading; persisted on the next flush"""
+        self.record_rows([self.make_row(device_pk, temperature, humidity, motion, sleep, ts)])
+
+    def record_rows(self, rows):
+        """Queue pre-built reading rows"""
+        with self._lock:
+            self._buffer.extend(rows)
+            full = len(self._buffer) >= self.max_batch
+        if full:
+            self._wake.set()
+
+    def insert_now(self, rows):
+        """Insert rows in the caller's transaction (the caller commits)"""
+        if not rows:
+            return 0
+        db.session.execute(insert(SensorReading), rows)
+        self._mark_dirty(rows)
+        return len(rows)
+
+    def _mark_dirty(self, rows):
+        with self._lock:
+            for row in rows:
+                span = self._dirty.get(row['device_pk'])
+                if span is None:
+                    self._dirty[row['device_pk']] = [row['ts'], row['ts']]
+                else:
+                    span[0] = min(span[0], row['ts'])
+                    span[1] = max(span[1], row['ts'])
+
+    def flush(self):
+        """
+        Insert all buffered readings in one transaction
+
+        Returns:
+            int: Number of readings written
+        """
+        with self._lock:
+            if not self._buffer:
+                return 0
+            rows, self._buffer = self._buffer, []
+
+        try:
+            db.session.execute(insert(SensorReading), rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Sensor history flush failed for {len(rows)} readings: {e}")
+            with self._lock:
+                self._buffer[:0] = rows
+            return 0
+
+        self._mark_dirty(rows)
+        return len(rows)
+
+    def rollup(self):
+        """
+        Recompute every rollup bucket touched by readings flushed since the last pass
+
+        Returns:
+            int: Number of devices rolled up
+        """
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+        if not dirty:
+            return 0
+
+        devices = list(dirty)
+        lo = min(span[0] for span in dirty.values())
+        hi = max(span[1] for span in dirty.values())
+        try:
+            source = None
+            for resolution in ROLLUP_RESOLUTIONS:
+                self._rollup_tier(resolution, source, devices, lo - lo % resolution, hi - hi % resolution)
+                source = resolution
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Sensor rollup failed for {len(devices)} devices: {e}")
+            with self._lock:
+                for device_pk, (start, end) in dirty.items():
+                    span = self._dirty.setdefault(device_pk, [start, end])
+                    span[0] = min(span[0], start)
+                    span[1] = max(span[1], end)
+            return 0
+        return len(devices)
+
+    def _rollup_tier(self, resolution, source, devices, first_bucket, last_bucket):
+        """Rebuild buckets [first_bucket, last_bucket] of one tier for the given devices"""
+        if source is None:
+            r = SensorReading.__table__.c
+            bucket = (r.ts - r.ts % resolution).label('bucket')
+            query = select(
+                r.device_pk,
+                bucket,
+                func.count().label('count'),
+                func.count(r.temperature_centi),
+                func.min(r.temperature_centi),
+                func.max(r.temperature_centi),
+                func.sum(r.temperature_centi),
+                func.count(r.humidity_centi),
+                func.min(r.humidity_centi),
+                func.max(r.humidity_centi),
+                func.sum(r.humidity_centi),
+                func.sum(case((r.flags.op('&')(FLAG_MOTION) != 0, 1), else_=0)),
+                func.sum(case((r.flags.op('&')(FLAG_SLEEP) != 0, 1), else_=0))
+            ).where(
+                r.device_pk.in_(devices),
+                r.ts >= first_bucket,
+                r.ts < last_bucket + resolution
+            )
+        else:
+            r = SensorRollup.__table__.c
+            bucket = (r.bucket - r.bucket % resolution).label('bucket')
+            query = select(
+                r.device_pk,
+                bucket,
+                func.sum(r.count),
+                func.sum(r.temperature_count),
+                func.min(r.temperature_min),
+                func.max(r.temperature_max),
+                func.sum(r.temperature_sum),
+                func.sum(r.humidity_count),
+                func.min(r.humidity_min),
+                func.max(r.humidity_max),
+                func.sum(r.humidity_sum),
+                func.sum(r.motion_count),
+                func.sum(r.sleep_count)
+            ).where(
+                r.resolution == source,
+                r.device_pk.in_(devices),
+                r.bucket >= first_bucket,
+                r.bucket < last_bucket + resolution
+            )
+        groups = db.session.execute(query.group_by(r.device_pk, bucket)).all()
+
+        db.session.execute(delete(SensorRollup).where(
+            SensorRollup.resolution == resolution,
+            SensorRollup.device_pk.in_(devices),
+            SensorRollup.bucket >= first_bucket,
+            SensorRollup.bucket <= last_bucket
+        ))
+        if groups:
+            db.session.execute(insert(SensorRollup), [{
+                'device_pk': g[0], 'resolution': resolution, 'bucket': g[1], 'count': g[2],
+                'temperature_count': g[3] or 0, 'temperature_min': g[4], 'temperature_max': g[5], 'temperature_sum': g[6],
+                'humidity_count': g[7] or 0, 'humidity_min': g[8], 'humidity_max': g[9], 'humidity_sum': g[10],
+                'motion_count': g[11] or 0, 'sleep_count': g[12] or 0
+            } for g in groups])
+
+    def apply_retention(self, now=None):
+        """Delete raw readings and rollups older than their tier's retention"""
+        now = int(now if now is not None else time.time())
+        try:
+            for resolution, keep in self.retention.items():
+                if keep is None:
+                    continue
+                if resolution == 0:
+                    db.session.execute(delete(SensorReading).where(SensorReading.ts < now - keep))
+                else:
+                    db.session.execute(delete(SensorRollup).where(
+                        SensorRollup.resolution == resolution,
+                        SensorRollup.bucket < now - keep
+                    ))
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Sensor history retention failed: {e}")
+
+    def forget_device(self, device_pk):
+        """Drop all history of a removed device (caller commits)"""
+        with self._lock:
+            self._buffer = [row for row in self._buffer if row['device_pk'] != device_pk]
+            self._dirty.pop(device_pk, None)
+        db.session.execute(delete(SensorReading).where(SensorReading.device_pk == device_pk))
+        db.session.execute(delete(SensorRollup).where(SensorRollup.device_pk == device_pk))
+
+    def pick_resolution(self, start, end, max_points=500, now=None):
+        """Finest tier that covers [start, end] in at most max_points points (0 = raw)"""
+        now = int(now if now is not None else time.time())
+        span = max(end - start, 1)
+        raw_keep = self.retention.get(0)
+        if span <= self.raw_max_span and (raw_keep is None or start >= now - raw_keep):
+            return 0
+        for resolution in ROLLUP_RESOLUTIONS:
+            keep = self.retention.get(resolution)
+            if span / resolution <= max_points and (keep is None or start >= now - keep):
+                return resolution
+        return ROLLUP_RESOLUTIONS[-1]
+
+    def query(self, device_pk, start, end, max_points=500, resolution=None):
+        """
+        Sensor history for a device between two unix timestamps
+
+        Returns:
+            dict: {'resolution': seconds (0 = raw), 'points': [...]} with raw readings
+                  or per-bucket min/max/avg
+        """
+        if resolution is None:
+            resolution = self.pick_resolution(start, end, max_points)
+
+        if resolution == 0:
+            rows = db.session.execute(
+                select(SensorReading.ts, SensorReading.temperature_centi,
+                       SensorReading.humidity_centi, SensorReading.flags)
+                .where(SensorReading.device_pk == device_pk,
+                       SensorReading.ts >= start, SensorReading.ts <= end)
+                .order_by(SensorReading.ts)
+            ).all()
+            points = [{
+                'ts': ts,
+                'temperature': _unscale(temperature),
+                'humidity': _unscale(humidity),
+                'motion_detected': bool(flags & FLAG_MOTION),
+                'sleep_mode': bool(flags & FLAG_SLEEP)
+            } for ts, temperature, humidity, flags in rows]
+            return {'resolution': 0, 'points': points}
+
+        rows = SensorRollup.query.filter(
+            SensorRollup.device_pk == device_pk,
+            SensorRollup.resolution == resolution,
+            SensorRollup.bucket >= start - start % resolution,
+            SensorRollup.bucket <= end
+        ).order_by(SensorRollup.bucket).all()
+        points = [{
+            'ts': row.bucket,
+            'count': row.count,
+            'temperature': {
+                'min': _unscale(row.temperature_min),
+                'max': _unscale(row.temperature_max),
+                'avg': round(row.temperature_sum / row.temperature_count / 100.0, 2) if row.temperature_count else None
+            },
+            'humidity': {
+                'min': _unscale(row.humidity_min),
+                'max': _unscale(row.humidity_max),
+                'avg': round(row.humidity_sum / row.humidity_count / 100.0, 2) if row.humidity_count else None
+            },
+            'motion_ratio': round(row.motion_count / row.count, 3) if row.count else 0,
+            'sleep_ratio': round(row.sleep_count / row.count, 3) if row.count else 0
+        } for row in rows]
+        return {'resolution': resolution, 'points': points}
+
+    def run_once(self):
+        """One background cycle: flush, then rollups and retention when due"""
+        self.flush()
+        if time.monotonic() - self._last_rollup >= self.rollup_interval:
+            self._last_rollup = time.monotonic()
+            self.rollup()
+            self.apply_retention()
+
+    def start(self, app):
+        """Start the background writer thread"""
+        if self._thread and self._thread.is_alive():
+            return
+
+        def run():
+            while not self._stop.is_set():
+                self._wake.wait(self.flush_interval)
+                self._wake.clear()
+                with app.app_context():
+                    self.run_once()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='sensor-history', daemon=True)
+        self._thread.start()
+
+    def stop(self, app=None):
+        """Stop the writer thread, persisting and rolling up anything still pending"""
+        self._stop.set()
+        self._wake.set()
+        if app is not None:
+            with app.app_context():
+                self.flush()
+                self.rollup()
@@ -0,0 +1,476 @@
+#!/usr/bin/env python3
+"""
+ESP32 Fleet Simulator
+Drives N virtual ESP32 devices against PersonalCMS using the real firmware protocol
+(register, heartbeat, sensor data, images sequence, OTA check, firmware download with
+interrupt/resume) and reports per-endpoint latency, throughput and error rates.
+
+Examples:
+    python simulate_ota_fleet.py --devices 2000 --duration 120
+    python simulate_ota_fleet.py --serve --devices 200 --cycles 3 --report run_a.json
+    python simulate_ota_fleet.py --devices 2000 --duration 120 --compare run_a.json
+"""
+
+import argparse
+import asyncio
+import json
+import math
+import random
+import sys
+import threading
+import time
+from datetime import datetime
+from urllib.parse import urlsplit
+
+# Latency histogram bucket upper bounds in milliseconds (last bucket is open-ended)
+LATENCY_BUCKETS_MS = [1, 2, 5, 10, 20, 50, 100, 200, 500, 1000, 2000, 5000, 10000, 30000]
+
+READ_CHUNK_SIZE = 16 * 1024
+
+
+class HttpResponse:
+    def __init__(self, status, headers, body=b'', body_length=0):
+        self.status = status
+        self.headers = headers
+        self.body = body
+        self.body_length = body_length
+
+    def json(self):
+        try:
+            return json.loads(self.body.decode('utf-8')) if self.body else {}
+        except ValueError:
+            return {}
+
+
+class HttpClient:
+    """
+    Minimal asyncio HTTP/1.1 client
+
+    Opens one connection per request and closes it afterwards, like the
+    ESP32 HTTPClient does between begin() and end().
+    """
+
+    def __init__(self, base_url, timeout=30.0):
+        parts = urlsplit(base_url)
+        self.host = parts.hostname or 'localhost'
+        self.port = parts.port or 80
+        self.base_path = parts.path.rstrip('/')
+        self.timeout = timeout
+
+    async def request(self, method, path, headers=None, json_body=None, keep_body=True, abort_after=None):
+        """
+        Send a request and read the response
+
+        Args:
+            keep_body: Keep the body in memory (False for firmware downloads)
+            abort_after: Drop the connection after this many body bytes (simulated interruption)
+        """
+        body = b''
+        request_headers = {
+            'Host': f'{self.host}:{self.port}',
+            'User-Agent': 'ESP32HTTPClient',
+            'Connection': 'close'
+        }
+        if json_body is not None:
+            body = json.dumps(json_body).encode('utf-8')
+            request_headers['Content-Type'] = 'application/json'
+        request_headers['Content-Length'] = str(len(body))
+        request_headers.update(headers or {})
+
+        if not path.startswith('/'):
+            path = '/' + path
+        lines = [f'{method} {self.base_path}{path} HTTP/1.1']
+        lines += [f'{name}: {value}' for name, value in request_headers.items()]
+        payload = ('\r\n'.join(lines) + '\r\n\r\n').encode('latin-1') + body
+
+        return await asyncio.wait_for(self._exchange(payload, method, keep_body, abort_after), self.timeout)
+
+    async def _exchange(self, payload, method, keep_body, abort_after):
+        reader, writer = await asyncio.open_connection(self.host, self.port)
+        try:
+            writer.write(payload)
+            await writer.drain()
+
+            status_line = await reader.readline()
+            if not status_line:
+                raise ConnectionError('Connection closed before response')
+            status = int(status_line.split()[1])
+
+            headers = {}
+            while True:
+                line = await reader.readline()
+                if line in (b'\r\n', b'\n', b''):
+                    break
+                name, _, value = line.decode('latin-1').partition(':')
+                headers[name.strip().lower()] = value.strip()
+
+            if method == 'HEAD' or status in (204, 304):
+                return HttpResponse(status, headers)
+
+            expected = int(headers['content-length']) if 'content-length' in headers else None
+            chunks = []
+            received = 0
+            while expected is None or received < expected:
+                want = READ_CHUNK_SIZE if expected is None else min(READ_CHUNK_SIZE, expected - received)
+                chunk = await reader.read(want)
+                if not chunk:
+                    break
+                received += len(chunk)
+                if keep_body:
+                    chunks.append(chunk)
+                if abort_after is not None and received >= abort_after:
+                    break
+            return HttpResponse(status, headers, b''.join(chunks), received)
+        finally:
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except (ConnectionError, OSError):
+                pass
+
+
+class EndpointStats:
+    """Latency histogram and outcome counters for one endpoint"""
+
+    def __init__(self):
+        self.count = 0
+        self.errors = 0
+        self.statuses = {}
+        self.bytes = 0
+        self.buckets = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.latencies = []
+
+    def record(self, latency_ms, status=None, nbytes=0, error=False):
+        self.count += 1
+        self.bytes += nbytes
+        key = str(status) if status is not None else 'exception'
+        self.statuses[key] = self.statuses.get(key, 0) + 1
+        if error:
+            self.errors += 1
+        self.latencies.append(latency_ms)
+        for i, bound in enumerate(LATENCY_BUCKETS_MS):
+            if latency_ms <= bound:
+                self.buckets[i] += 1
+                break
+        else:
+            self.buckets[-1] += 1
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return None
+        ordered = sorted(self.latencies)
+        index = min(len(ordered) - 1, max(0, math.ceil(fraction * len(ordered)) - 1))
+        return round(ordered[index], 2)
+
+    def to_dict(self, elapsed):
+        return {
+            'requests': self.count,
+            'errors': self.errors,
+            'error_rate': round(self.errors / self.count, 4) if self.count else 0,
+            'throughput_rps': round(self.count / elapsed, 2) if elapsed else 0,
+            'bytes': self.bytes,
+            'statuses': self.statuses,
+            'latency_ms': {
+                'mean': round(sum(self.latencies) / len(self.latencies), 2) if self.latencies else None,
+                'p50': self.percentile(0.50),
+                'p90': self.percentile(0.90),
+                'p99': self.percentile(0.99),
+                'max': round(max(self.latencies), 2) if self.latencies else None
+            },
+            'histogram': {
+                (f'<={bound}ms' if i < len(LATENCY_BUCKETS_MS) else f'>{LATENCY_BUCKETS_MS[-1]}ms'): count
+                for i, (bound, count) in enumerate(zip(LATENCY_BUCKETS_MS + [None], self.buckets))
+            }
+        }
+
+
+class FleetSimulator:
+    """Runs the virtual fleet and collects per-endpoint statistics"""
+
+    def __init__(self, args):
+        self.args = args
+        self.client = HttpClient(args.base_url, timeout=args.timeout)
+        self.stats = {}
+        self.limit = asyncio.Semaphore(args.concurrency)
+        self.updates_completed = 0
+        self.devices_finished = 0
+        self.deadline = None
+
+    def _stats(self, endpoint):
+        if endpoint not in self.stats:
+            self.stats[endpoint] = EndpointStats()
+        return self.stats[endpoint]
+
+    async def call(self, endpoint, method, path, ok=(200,), **kwargs):
+        """Issue one timed request, recording it under `endpoint`"""
+        async with self.limit:
+            started = time.perf_counter()
+            try:
+                response = await self.client.request(method, path, **kwargs)
+            except Exception:
+                self._stats(endpoint).record((time.perf_counter() - started) * 1000, error=True)
+                return None
+            latency_ms = (time.perf_counter() - started) * 1000
+        self._stats(endpoint).record(latency_ms, response.status, response.body_length,
+                                     error=response.status not in ok)
+        return response
+
+    def _running(self):
+        return self.deadline is None or time.monotonic() < self.deadline
+
+    async def run_device(self, index):
+        args = self.args
+        device_id = f"{args.device_prefix}_{index:05d}"
+        version = args.firmware_version
+        rng = random.Random(args.seed * 100003 + index)
+
+        # Spread start-up over the ramp period like a fleet powering on
+        await asyncio.sleep(rng.uniform(0, args.ramp))
+
+        await self.call('register', 'POST', '/api/devices/register', json_body={
+            'device_id': device_id,
+            'device_name': f'Simulated ESP32 {index}',
+            'occupation': 'Load Test',
+            'device_type': 'ESP32_DevKit_V1',
+            'wifi_ssid': 'SimNet',
+            'firmware_version': version,
+            'capabilities': 'dashboard,images,ota,bmp_download'
+        })
+
+        cycle = 0
+        while self._running() and (args.cycles is None or cycle < args.cycles):
+            cycle += 1
+            await self.call('heartbeat', 'POST', f'/api/devices/{device_id}/heartbeat', json_body={
+                'device_id': device_id,
+                'device_name': f'Simulated ESP32 {index}',
+                'device_type': 'ESP32_OTA_Base',
+                'version': version,
+                'uptime': cycle * args.interval,
+                'free_heap': rng.randint(150000, 250000),
+                'wifi_rssi': rng.randint(-85, -40)
+            })
+
+            await self.call('sensor-data', 'POST', f'/api/devices/{device_id}/sensor-data', json_body={
+                'device_id': device_id,
+                'temperature': round(rng.uniform(18, 28), 1),
+                'humidity': round(rng.uniform(30, 60), 1),
+                'motion_detected': rng.random() < 0.2,
+                'sleep_mode': False,
+                'timestamp': cycle * args.interval
+            })
+
+            if not args.skip_content:
+                sequence = await self.call('images-sequence', 'GET', f'/api/devices/{device_id}/images-sequence')
+                if sequence and sequence.status == 200:
+                    dashboard_url = sequence.json().get('dashboard_url')
+                    if dashboard_url:
+                        await self.call('dashboard', 'GET', dashboard_url, ok=(200, 404), keep_body=False)
+
+            check = await self.call('ota-check', 'GET', f'/api/ota/check/{device_id}', headers={
+                'X-Device-Version': version,
+                'X-Device-Type': 'ESP32_OTA_Base'
+            })
+            if check and check.status == 200 and not args.skip_download:
+                info = check.json()
+                if info.get('update_available') and info.get('firmware_url'):
+                    if await self.download(info, rng):
+                        version = info.get('version', version)
+                        self.updates_completed += 1
+                        # Devices report the new version straight after rebooting
+                        await self.call('heartbeat', 'POST', f'/api/devices/{device_id}/heartbeat',
+                                        json_body={'device_id': device_id, 'version': version, 'uptime': 5})
+
+            await asyncio.sleep(args.interval * rng.uniform(0.9, 1.1))
+
+        self.devices_finished += 1
+
+    async def download(self, info, rng):
+        """Download firmware, optionally interrupting and resuming with a Range request"""
+        args = self.args
+        url = info['firmware_url']
+        if info.get('retry_after') and '?slot=' not in url and '&slot=' not in url:
+            await asyncio.sleep(min(info['retry_after'], args.max_retry_wait))
+
+        path = urlsplit(url).path + (f"?{urlsplit(url).query}" if urlsplit(url).query else '')
+        file_size = info.get('file_size') or 0
+        received = 0
+
+        for attempt in range(args.download_attempts):
+            abort_after = None
+            if received == 0 and file_size and rng.random() < args.interrupt_rate:
+                abort_after = int(file_size * rng.uniform(0.1, 0.9))
+
+            endpoint = 'download' if received == 0 else 'download-resume'
+            headers = {'Range': f'bytes={received}-'} if received else None
+            response = await self.call(endpoint, 'GET', path, ok=(200, 206, 503), headers=headers,
+                                       keep_body=False, abort_after=abort_after)
+            if response is None:
+                return False
+            if response.status == 503:
+                wait = float(response.headers.get('retry-after', args.min_retry_wait))
+                await asyncio.sleep(min(wait, args.max_retry_wait))
+                continue
+            if response.status not in (200, 206):
+                return False
+
+            received += response.body_length
+            if abort_after is None and (not file_size or received >= file_size):
+                return True
+        return False
+
+    async def run(self):
+        args = self.args
+        if args.duration:
+            self.deadline = time.monotonic() + args.duration
+        started = time.monotonic()
+
+        tasks = [asyncio.create_task(self.run_device(i)) for i in range(args.devices)]
+        progress = asyncio.create_task(self._progress(started))
+        try:
+            await asyncio.gather(*tasks)
+        finally:
+            progress.cancel()
+        return time.monotonic() - started
+
+    async def _progress(self, started):
+        while True:
+            await asyncio.sleep(10)
+            total = sum(s.count for s in self.stats.values())
+            errors = sum(s.errors for s in self.stats.values())
+            elapsed = time.monotonic() - started
+            print(f"⏱️  {elapsed:6.0f}s  requests={total}  errors={errors}  "
+                  f"updates={self.updates_completed}  done={self.devices_finished}/{self.args.devices}")
+
+    def report(self, elapsed):
+        total = sum(s.count for s in self.stats.values())
+        errors = sum(s.errors for s in self.stats.values())
+        return {
+            'generated_at': datetime.utcnow().isoformat(),
+            'config': {
+                'base_url': self.args.base_url,
+                'devices': self.args.devices,
+                'concurrency': self.args.concurrency,
+                'interval': self.args.interval,
+                'duration': self.args.duration,
+                'cycles': self.args.cycles,
+                'interrupt_rate': self.args.interrupt_rate,
+                'seed': self.args.seed
+            },
+            'elapsed_seconds': round(elapsed, 2),
+            'totals': {
+                'requests': total,
+                'errors': errors,
+                'error_rate': round(errors / total, 4) if total else 0,
+                'throughput_rps': round(total / elapsed, 2) if elapsed else 0,
+                'updates_completed': self.updates_completed
+            },
+            'endpoints': {name: stats.to_dict(elapsed) for name, stats in sorted(self.stats.items())}
+        }
+
+
+def print_report(report, baseline=None):
+    """Print a per-endpoint summary, with deltas against a baseline report if given"""
+    def delta(current, previous):
+        if previous in (None, 0) or current is None:
+            return ''
+        return f" ({(current - previous) / previous * 100:+.0f}%)"
+
+    base_endpoints = (baseline or {}).get('endpoints', {})
+    totals = report['totals']
+    print("\n📊 Fleet Simulation Report")
+    print("=" * 78)
+    print(f"Devices: {report['config']['devices']}  Elapsed: {report['elapsed_seconds']}s  "
+          f"Requests: {totals['requests']}  Throughput: {totals['throughput_rps']} req/s"
+          f"{delta(totals['throughput_rps'], (baseline or {}).get('totals', {}).get('throughput_rps'))}")
+    print(f"Errors: {totals['errors']} ({totals['error_rate'] * 100:.2f}%)  "
+          f"Updates completed: {totals['updates_completed']}")
+    print("-" * 78)
+    print(f"{'endpoint':<16}{'reqs':>8}{'err%':>7}{'rps':>9}{'p50 ms':>10}{'p90 ms':>10}{'p99 ms':>10}")
+    for name, endpoint in report['endpoints'].items():
+        latency = endpoint['latency_ms']
+        previous = base_endpoints.get(name, {}).get('latency_ms', {})
+        print(f"{name:<16}{endpoint['requests']:>8}{endpoint['error_rate'] * 100:>6.1f}%"
+              f"{endpoint['throughput_rps']:>9}{latency['p50'] or 0:>10}{latency['p90'] or 0:>10}"
+              f"{latency['p99'] or 0:>10}{delta(latency['p99'], previous.get('p99'))}")
+    print("=" * 78)
+
+
+def serve_in_background(port):
+    """Start the PersonalCMS app on a local threaded server for self-contained runs"""
+    from werkzeug.serving import make_server
+    import logging
+    logging.getLogger('werkzeug').setLevel(logging.WARNING)
+
+    from unified_cms import create_app
+    server = make_server('127.0.0.1', port, create_app(), threaded=True)
+    thread = threading.Thread(target=server.serve_forever, name='fleet-sim-server', daemon=True)
+    thread.start()
+    return server
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description='Simulate a fleet of ESP32 devices against PersonalCMS')
+    parser.add_argument('--base-url', default='http://localhost:5000')
+    parser.add_argument('--serve', action='store_true', help='Start the app in-process on --port first')
+    parser.add_argument('--port', type=int, default=5055)
+    parser.add_argument('--devices', type=int, default=100)
+    parser.add_argument('--concurrency', type=int, default=200, help='Maximum requests in flight')
+    parser.add_argument('--interval', type=float, default=30.0, help='Seconds between device cycles')
+    parser.add_argument('--ramp', type=float, default=10.0, help='Seconds over which devices start')
+    parser.add_argument('--duration', type=float, default=None, help='Stop after this many seconds')
+    parser.add_argument('--cycles', type=int, default=None, help='Stop each device after N cycles')
+    parser.add_argument('--interrupt-rate', type=float, default=0.1, help='Fraction of downloads interrupted')
+    parser.add_argument('--download-attempts', type=int, default=5)
+    parser.add_argument('--min-retry-wait', type=float, default=5.0)
+    parser.add_argument('--max-retry-wait', type=float, default=30.0)
+    parser.add_argument('--firmware-version', default='1.0.0')
+    parser.add_argument('--device-prefix', default='SIM_ESP32')
+    parser.add_argument('--skip-content', action='store_true', help='Skip images-sequence and dashboard fetch')
+    parser.add_argument('--skip-download', action='store_true', help='Check for updates but never download')
+    parser.add_argument('--timeout', type=float, default=60.0)
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--report', help='Write the JSON report to this file')
+    parser.add_argument('--compare', help='Baseline JSON report to compare against')
+    args = parser.parse_args(argv)
+
+    if args.duration is None and args.cycles is None:
+        args.cycles = 1
+    return args
+
+
+def main(argv=None):
+    args = parse_args(argv)
+
+    server = None
+    if args.serve:
+        server = serve_in_background(args.port)
+        args.base_url = f'http://127.0.0.1:{args.port}'
+
+    print(f"🚀 Simulating {args.devices} devices against {args.base_url}")
+    simulator = FleetSimulator(args)
+    try:
+        elapsed = asyncio.run(simulator.run())
+    except KeyboardInterrupt:
+        print("⚠️ Interrupted, reporting partial results")
+        elapsed = 0
+    finally:
+        if server:
+            server.shutdown()
+
+    report = simulator.report(elapsed)
+    baseline = None
+    if args.compare:
+        with open(args.compare) as f:
+            baseline = json.load(f)
+    print_report(report, baseline)
+
+    if args.report:
+        with open(args.report, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f"💾 Report written to {args.report}")
+
+    return 0 if report['totals']['requests'] else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
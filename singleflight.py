@@ -0,0 +1,159 @@
+"""
+Single-Flight Work Coalescing
+Concurrent requests for the same piece of work (a device's dashboard, an upload's
+BMP, a content API) share one computation instead of each running it. Callers in
+this process wait for the in-flight call and get its result; other worker
+processes are serialized through a lock file per key, so they never write the same
+output file at once.
+"""
+
+import os
+import asyncio
+import hashlib
+import logging
+import threading
+import contextlib
+
+try:
+    import fcntl
+    FILE_LOCKS_AVAILABLE = True
+except ImportError:
+    FILE_LOCKS_AVAILABLE = False  # Windows: in-process coalescing only
+
+logger = logging.getLogger(__name__)
+
+
+class _Call:
+    """One in-flight computation and the callers waiting on it"""
+    __slots__ = ('done', 'result', 'error')
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+
+class SingleFlight:
+    """
+    Runs each keyed piece of work at most once at a time
+
+    Keys are tuples whose first element names the kind of work (e.g.
+    ('dashboard', device_id)); counters are kept per kind.
+    """
+
+    def __init__(self, lock_dir=None):
+        self.lock_dir = lock_dir if FILE_LOCKS_AVAILABLE else None
+        if lock_dir and not FILE_LOCKS_AVAILABLE:
+            logger.info("File locks unavailable on this platform; work is coalesced within each process only")
+        if self.lock_dir:
+            os.makedirs(self.lock_dir, exist_ok=True)
+        self._calls = {}  # key -> _Call
+        self._tasks = {}  # (loop id, key) -> asyncio.Task
+        self._stats = {}  # kind -> counters
+        self._lock = threading.Lock()
+
+    @classmethod
+    def from_config(cls, config):
+        return cls(config.get('SINGLE_FLIGHT_LOCK_DIR'))
+
+    def _count(self, key, field, amount=1):
+        kind = key[0] if isinstance(key, tuple) else str(key)
+        stats = self._stats.setdefault(kind, {
+            'calls': 0, 'executions': 0, 'coalesced': 0, 'errors': 0, 'lock_waits': 0
+        })
+        stats[field] += amount
+
+    def do(self, key, fn, *args, cross_process=True, **kwargs):
+        """
+        Run fn(*args, **kwargs), or wait for the identical call already running
+
+        Args:
+            key: Identity of the work
+            fn: The computation; its result (or exception) is shared with waiters
+            cross_process: Also hold the key's lock file while running, so other
+                processes doing the same work run one after another
+
+        Returns:
+            The result of fn
+        """
+        with self._lock:
+            self._count(key, 'calls')
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+            else:
+                self._count(key, 'coalesced')
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        try:
+            with self._file_lock(key, cross_process):
+                call.result = fn(*args, **kwargs)
+            return call.result
+        except BaseException as e:
+            call.error = e
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+                self._count(key, 'executions')
+                if call.error is not None:
+                    self._count(key, 'errors')
+            call.done.set()
+
+    async def do_async(self, key, fn, *args, **kwargs):
+        """
+        Await fn(*args, **kwargs), or the identical call already running on this event loop
+
+        A waiter being cancelled does not cancel the shared call.
+        """
+        task_key = (id(asyncio.get_running_loop()), key)
+        with self._lock:
+            self._count(key, 'calls')
+            task = self._tasks.get(task_key)
+            if task is None:
+                task = self._tasks[task_key] = asyncio.ensure_future(fn(*args, **kwargs))
+                task.add_done_callback(lambda done: self._finish_task(task_key, key, done))
+            else:
+                self._count(key, 'coalesced')
+        return await asyncio.shield(task)
+
+    def _finish_task(self, task_key, key, task):
+        with self._lock:
+            self._tasks.pop(task_key, None)
+            self._count(key, 'executions')
+            if task.cancelled() or task.exception() is not None:
+                self._count(key, 'errors')
+
+    @contextlib.contextmanager
+    def _file_lock(self, key, cross_process):
+        if not (cross_process and self.lock_dir):
+            yield
+            return
+        digest = hashlib.sha1(repr(key).encode('utf-8')).hexdigest()[:24]
+        with open(os.path.join(self.lock_dir, f"{digest}.lock"), 'a') as lock_file:
+            try:
+                fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                # Another process is doing this work; wait for it to finish
+                with self._lock:
+                    self._count(key, 'lock_waits')
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_status(self):
+        """Coalescing counters per kind of work"""
+        with self._lock:
+            return {
+                'cross_process': bool(self.lock_dir),
+                'in_flight': len(self._calls) + len(self._tasks),
+                'operations': {kind: dict(stats) for kind, stats in self._stats.items()}
+            }
@@ -0,0 +1,122 @@
+"""
+Static File Offload
+Hands large binary transfers (firmware, dashboard frames, BMPs) to the front proxy
+or the WSGI server's sendfile support instead of streaming them through Python
+"""
+
+import os
+import mimetypes
+import logging
+from flask import Response, send_file
+from werkzeug.security import safe_join
+
+logger = logging.getLogger(__name__)
+
+# none       - Flask streams the file (development server)
+# sendfile   - send_file through wsgi.file_wrapper (gunicorn/uwsgi use os.sendfile)
+# x-accel    - nginx serves the bytes from an internal location (X-Accel-Redirect)
+# x-sendfile - Apache mod_xsendfile / lighttpd serve the bytes (X-Sendfile)
+OFFLOAD_MODES = ('none', 'sendfile', 'x-accel', 'x-sendfile')
+# Only x-accel passes the download governor's rate on (X-Accel-Limit-Rate); sendfile and
+# x-sendfile move the bytes unshaped, so while OTA_GLOBAL_BANDWIDTH_BPS or
+# OTA_SUBNET_BANDWIDTH_BPS is set firmware stays on the shaped Python stream in those modes
+SHAPING_MODES = ('none', 'x-accel')
+
+
+def get_offload_mode(config):
+    """Configured offload mode, falling back to 'none' for unknown values"""
+    mode = (config.get('STATIC_OFFLOAD_MODE') or 'none').lower()
+    if mode not in OFFLOAD_MODES:
+        logger.warning(f"Unknown STATIC_OFFLOAD_MODE '{mode}', serving files directly")
+        return 'none'
+    return mode
+
+
+def firmware_offload_mode(config):
+    """Offload mode for firmware downloads: 'none' when the configured mode would drop bandwidth shaping"""
+    mode = get_offload_mode(config)
+    if mode in SHAPING_MODES:
+        return mode
+    if config.get('OTA_GLOBAL_BANDWIDTH_BPS') or config.get('OTA_SUBNET_BANDWIDTH_BPS'):
+        return 'none'
+    return mode
+
+
+def is_proxy_offload(response):
+    """True when the front proxy (not Python) will send the response's bytes"""
+    return 'X-Accel-Redirect' in response.headers or 'X-Sendfile' in response.headers
+
+
+def _internal_uri(filepath, config):
+    """Map a local file to the proxy's internal location, or None if unmapped"""
+    real_path = os.path.abspath(filepath)
+    for local_root, uri_prefix in config.get('STATIC_OFFLOAD_LOCATIONS', {}).items():
+        root = os.path.abspath(local_root)
+        if real_path.startswith(root + os.sep):
+            relative = os.path.relpath(real_path, root).replace(os.sep, '/')
+            return uri_prefix.rstrip('/') + '/' + relative
+    return None
+
+
+def proxy_headers(filepath, config, download_name=None, limit_rate=None):
+    """
+    Headers that hand a file to the front proxy
+
+    Returns:
+        dict: X-Accel-Redirect / X-Sendfile headers, or None when Python must send the bytes
+    """
+    mode = get_offload_mode(config)
+    if mode == 'x-accel':
+        internal_uri = _internal_uri(filepath, config)
+        if not internal_uri:
+            logger.warning(f"No offload location for {filepath}, serving directly")
+            return None
+        headers = {'X-Accel-Redirect': internal_uri}
+        if limit_rate:
+            headers['X-Accel-Limit-Rate'] = str(int(limit_rate))
+    elif mode == 'x-sendfile':
+        headers = {'X-Sendfile': os.path.abspath(filepath)}
+    else:
+        return None
+    if download_name:
+        headers['Content-Disposition'] = f'attachment; filename={download_name}'
+    return headers
+
+
+def send_offloaded(filepath, config, download_name=None, mimetype=None, limit_rate=None):
+    """
+    Send a file, letting the proxy or WSGI server move the bytes when configured
+
+    Args:
+        filepath: Local path of the file to send
+        config: Flask app config
+        download_name: Attachment filename (None for inline)
+        mimetype: Content type (guessed from the filename if omitted)
+        limit_rate: Per-response bytes/second hint for nginx (X-Accel-Limit-Rate)
+
+    Returns:
+        Response
+    """
+    mimetype = mimetype or mimetypes.guess_type(download_name or filepath)[0] or 'application/octet-stream'
+
+    headers = proxy_headers(filepath, config, download_name, limit_rate)
+    if headers:
+        response = Response(status=200, mimetype=mimetype)
+        response.headers.update(headers)
+        return response
+
+    # 'sendfile' and 'none': send_file uses wsgi.file_wrapper when the server provides it
+    return send_file(
+        filepath,
+        mimetype=mimetype,
+        as_attachment=download_name is not None,
+        download_name=download_name
+    )
+
+
+def send_offloaded_from_directory(directory, filename, config, **kwargs):
+    """send_from_directory equivalent that honours the offload mode"""
+    filepath = safe_join(directory, filename)
+    if filepath is None or not os.path.isfile(filepath):
+        return None
+    return send_offloaded(filepath, config, **kwargs)
@@ -0,0 +1,72 @@
+#!/usr/bin/env python3
+"""
+Atomic Frame Files Test
+Offline tests for atomic frame writes and hardlinked content-addressed blobs
+"""
+
+import os
+import sys
+import time
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import Device, ImageProcessor
+from atomic_files import atomic_write, publish_blob, collect_blobs, BLOB_DIR, FSYNC_NONE, FSYNC_FULL
+
+
+def test_atomic_write_keeps_readers_whole():
+    """Readers see the old or the new file; failed writes leave no trace"""
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'upload.bmp')
+        atomic_write(path, b'old frame')
+        with open(path, 'rb') as reader:
+            atomic_write(path, b'new frame', fsync=FSYNC_FULL)
+            assert reader.read() == b'old frame'  # An open download keeps its frame
+        with open(path, 'rb') as reader:
+            assert reader.read() == b'new frame'
+
+        try:
+            atomic_write(path, 'not bytes', fsync=FSYNC_NONE)
+            assert False, 'expected TypeError'
+        except TypeError:
+            pass
+        assert os.listdir(folder) == ['upload.bmp']
+        with open(path, 'rb') as reader:
+            assert reader.read() == b'new frame'
+    print("✅ Atomic frame writes working")
+
+
+def test_blobs_shared_and_collected():
+    """Current and fallback share one blob; unchanged frames aren't rewritten; old blobs are collected"""
+    with tempfile.TemporaryDirectory() as folder:
+        blob_dir = os.path.join(folder, BLOB_DIR)
+        current = os.path.join(folder, 'esp-1_current.bmp')
+        fallback = os.path.join(folder, 'esp-1_fallback.bmp')
+
+        digest = publish_blob(b'frame one', [current, fallback], blob_dir, suffix='.bmp')
+        assert os.path.samefile(current, fallback)
+        assert os.stat(current).st_nlink == 3  # Blob + current + fallback
+        inode = os.stat(current).st_ino
+        assert publish_blob(b'frame one', [current, fallback], blob_dir, suffix='.bmp') == digest
+        assert os.stat(current).st_ino == inode
+
+        publish_blob(b'frame two', [current, fallback], blob_dir, suffix='.bmp')
+        with open(fallback, 'rb') as reader:
+            assert reader.read() == b'frame two'
+        assert sorted(os.listdir(folder)) == [BLOB_DIR, 'esp-1_current.bmp', 'esp-1_fallback.bmp']
+        assert collect_blobs(blob_dir, interval=0) == 0  # Too recent to be sure it's unused
+        assert collect_blobs(blob_dir, interval=0, now=time.time() + 120) == 1
+        assert len(os.listdir(blob_dir)) == 1
+        assert not os.path.exists(os.path.join(blob_dir, digest + '.bmp'))
+
+        # Dashboards are encoded once for both copies
+        device = Device(device_id='esp-2', device_name='Hall', occupation='Test')
+        path = ImageProcessor.generate_dashboard(device, {}, app_config={'DASHBOARD_FOLDER': folder})
+        assert os.path.samefile(path, os.path.join(folder, 'esp-2_fallback.bmp'))
+    print("✅ Shared frame blobs working")
+
+
+if __name__ == "__main__":
+    test_atomic_write_keeps_readers_whole()
+    test_blobs_shared_and_collected()
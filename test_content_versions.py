@@ -0,0 +1,96 @@
+#!/usr/bin/env python3
+"""
+Content Version Test
+Offline tests for per-device content versions and long-poll wake-ups
+"""
+
+import os
+import sys
+import time
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, ContentVersion
+from testing_utils import make_app
+from content_versions import ContentVersionBoard, ALL_DEVICES
+
+
+def test_bump_and_versions():
+    """Device and fleet-wide bumps advance only the versions they should"""
+    board = ContentVersionBoard(refresh_interval=900)
+    now = 1_700_000_000
+    with make_app().app_context():
+        base = board.current_version('esp-1')
+        assert base == board.refresh_epoch() and board.current_version('esp-2') == base
+
+        board.bump('esp-1', 'preferences')
+        board.bump(['esp-1', 'esp-1'])
+        assert board.current_version('esp-1') == base + 2
+        assert board.current_version('esp-2') == base
+
+        board.bump(ALL_DEVICES, 'content source')
+        assert board.current_version('esp-1') == base + 3
+        assert board.current_version('esp-2') == base + 1
+        assert ContentVersion.query.count() == 2
+
+        # Rotating content counts as a change once per refresh period
+        assert board.version('esp-2', now=now + 900) == board.version('esp-2', now=now) + 1
+        assert board.wait_timeout(55, now=now - now % 900 + 880) == 20
+
+        board.forget('esp-1')
+        db.session.commit()
+        assert ContentVersion.query.count() == 1
+    print("✅ Content version bumps working")
+
+
+def test_long_poll_wakes_on_change():
+    """A waiter returns at once when behind, on a bump, or at its timeout"""
+    app = make_app()
+    board = ContentVersionBoard(refresh_interval=0)
+    with app.app_context():
+        assert board.wait('esp-1', since=-1, timeout=5) == 0  # Already different
+
+        start = time.time()
+        assert board.wait('esp-1', since=0, timeout=0.2) == 0
+        assert 0.15 < time.time() - start < 2
+
+    def bump_later():
+        time.sleep(0.2)
+        with app.app_context():
+            board.bump('esp-1', 'image assignment')
+
+    bumper = threading.Thread(target=bump_later)
+    bumper.start()
+    with app.app_context():
+        start = time.time()
+        assert board.wait('esp-1', since=0, timeout=10) == 1
+        assert time.time() - start < 5
+    bumper.join()
+    print("✅ Content long-poll working")
+
+
+def test_other_worker_bumps_are_polled():
+    """Bumps committed by another process wake waiters on the next poll"""
+    app = make_app()
+    board = ContentVersionBoard(refresh_interval=0)
+    other_worker = ContentVersionBoard(refresh_interval=0)
+    woken = []
+    with app.app_context():
+        board.current_version('esp-1')
+        assert board.poll() == 0  # Nothing waiting, nothing read
+
+        unwatch = board.watch('esp-1', lambda: woken.append('esp-1'))
+        other_worker.bump(ALL_DEVICES, 'content source')
+        assert board.version('esp-1') == 0
+        assert board.poll() == 1
+        assert woken == ['esp-1'] and board.version('esp-1') == 1
+        unwatch()
+        assert not board._waiters
+    print("✅ Cross-worker content changes working")
+
+
+if __name__ == "__main__":
+    test_bump_and_versions()
+    test_long_poll_wakes_on_change()
+    test_other_worker_bumps_are_polled()
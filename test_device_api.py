@@ -0,0 +1,95 @@
+#!/usr/bin/env python3
+"""
+Device API Handler Test
+Offline tests for the request handling shared by the Flask and ASGI device endpoints
+"""
+
+import os
+import sys
+from types import SimpleNamespace
+from werkzeug.http import parse_range_header
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import device_api
+from models import Device
+from ota_delivery import DownloadGovernor
+
+
+def test_registration_and_heartbeat():
+    """Registration fields, updates and heartbeat data land on the same columns"""
+    data = {'device_id': 'esp-1', 'device_name': 'Kitchen', 'occupation': 'Chef', 'device_type': 'ESP32',
+            'preferences': {'jokes': ['dad_jokes']}}
+    assert device_api.registration_fields({**data, 'occupation': ''}) is None
+
+    fields = device_api.registration_fields(data)
+    device = device_api.apply_registration(None, 'esp-1', fields)
+    assert device.device_id == 'esp-1' and device.preferences == '{"jokes": ["dad_jokes"]}'
+    assert device_api.apply_registration(device, 'esp-1', {**fields, 'nickname': 'Fridge'}) is None
+    assert device.nickname == 'Fridge'
+
+    payload, compact = device_api.registration_response('esp-1', 30)
+    assert 'ingest_key' not in payload and compact == {'success': True, 'next_poll_seconds': 30}
+    payload, compact = device_api.registration_response('esp-1', 30, 'k3y', 5684)
+    assert compact['ingest_key'] == payload['ingest_key'] == 'k3y' and compact['ingest_port'] == 5684
+
+    device = device_api.heartbeat_device('esp-2', {})
+    device_api.apply_heartbeat(device, {'version': '1.2.0', 'uptime': 60, 'free_heap': 120000})
+    assert (device.device_type, device.firmware_version, device.uptime_seconds) == ('ESP32_OTA', '1.2.0', 60)
+    assert device.wifi_rssi is None and device.is_connected
+    print("✅ Registration and heartbeat handling working")
+
+
+def test_sensor_data_and_content_responses():
+    """Only the reported sensor fields change and both response shapes carry the poll hint"""
+    device = Device(device_id='esp-1', device_name='Kitchen', occupation='Chef', temperature=20.0)
+    assert device_api.apply_sensor_data(device, {'humidity': 45.0}) == ['humidity']
+    assert device.temperature == 20.0 and device.humidity == 45.0 and device.sensor_last_update
+    assert device_api.apply_sensor_data(Device(device_id='esp-2'), {'battery': 3}) == []
+
+    images = [SimpleNamespace(id=1, filename='cat.png', file_size=10, uploaded_at=None,
+                              device_assignments='["esp-1"]')]
+    assert device_api.is_assigned(images[0], 'esp-1') and not device_api.is_assigned(images[0], 'esp-11')
+    payload, compact = device_api.images_sequence_response('esp-1', images, {'jokes': {}}, 7, 45)
+    assert payload['content_categories'] == ['jokes'] and payload['assigned_images'][0]['url'] == '/uploads/cat.png'
+    assert compact == {'success': True, 'dashboard_url': '/dashboards/esp-1_current.bmp', 'content_version': 7,
+                       'next_poll_seconds': 45, 'assigned_images': [{'filename': 'cat.png', 'bmp_url': '/uploads/cat.png/bmp'}]}
+    content = device_api.content_response('esp-1', images, {}, 7, 45)
+    assert content['images'][0]['upload_date'] is None and content['status'] == 'success'
+
+    payload, compact = device_api.content_version_response('esp-1', 8, 7, 0)
+    assert payload['changed'] and compact == {'version': 8, 'changed': True, 'next_poll_seconds': 0}
+    assert not device_api.content_version_response('esp-1', 8, None, 0)[1]['changed']
+    print("✅ Sensor data and content responses working")
+
+
+def test_offer_firmware():
+    """Offers get an absolute URL with a slot token, or a retry hint when no slot is free"""
+    governor = DownloadGovernor('test-secret', max_streams=1)
+    offer = device_api.offer_firmware({'firmware_url': '/api/ota/download/fw_2', 'firmware_key': 'fw_2'},
+                                      'esp-1', 'http://cms.local/', governor)
+    assert offer['firmware_url'].startswith('http://cms.local/api/ota/download/fw_2?slot=')
+    assert 'retry_after' not in offer
+
+    refused = device_api.offer_firmware({'firmware_url': 'http://cdn/fw_2.bin?v=2', 'file_size': 1024},
+                                        'esp-2', 'http://cms.local/', governor)
+    assert refused['firmware_url'] == 'http://cdn/fw_2.bin?v=2' and refused['retry_after'] >= 1
+    print("✅ Firmware offers working")
+
+
+def test_firmware_range():
+    """Downloads from the first byte count, later ranges resume, unsatisfiable ranges are refused"""
+    assert device_api.firmware_range(None, 1000) == (None, True)
+    assert device_api.firmware_range(parse_range_header('bytes=0-'), 1000) == ((0, 1000), True)
+    assert device_api.firmware_range(parse_range_header('bytes=500-'), 1000) == ((500, 1000), False)
+    assert device_api.firmware_range(parse_range_header('bytes=-100'), 1000) == ((900, 1000), False)
+    assert device_api.firmware_range(parse_range_header('bytes=0-9,20-29'), 1000) == (None, True)
+    assert device_api.firmware_range(parse_range_header('bytes=1000-'), 1000) is None
+    print("✅ Firmware download ranges working")
+
+
+if __name__ == "__main__":
+    test_registration_and_heartbeat()
+    test_sensor_data_and_content_responses()
+    test_offer_firmware()
+    test_firmware_range()
@@ -0,0 +1,117 @@
+#!/usr/bin/env python3
+"""
+Device Codec Test
+Offline tests for the MessagePack encoder/decoder and JSON/MessagePack negotiation
+"""
+
+import os
+import sys
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from flask import Flask
+import device_codec
+from device_codec import packb, unpackb, read_payload, device_response, DecodeError, MSGPACK_MIMETYPE
+
+
+def test_msgpack_round_trip():
+    """Every type the device protocol uses survives a round trip"""
+    sample = {
+        'device_id': 'ESP32_DevKit_V1_001',
+        'uptime': 86400,
+        'free_heap': 123456,
+        'wifi_rssi': -67,
+        'temperature': 21.5,
+        'motion_detected': True,
+        'sleep_mode': False,
+        'nickname': None,
+        'readings': [{'age': i, 'humidity': 40 + i / 10} for i in range(20)],
+        'blob': b'\x00\x01',
+        'long_text': 'x' * 300,
+        'big': 2 ** 40,
+        'negative': -2 ** 20
+    }
+    encoded = packb(sample)
+    assert unpackb(encoded) == sample
+    # Canonical encodings as produced by ArduinoJson
+    assert packb({'a': 1}) == b'\x81\xa1a\x01'
+    assert packb([-1, 255, True]) == b'\x93\xff\xcc\xff\xc3'
+    assert unpackb(b'\xca\x41\xac\x00\x00') == 21.5  # float32 from the device
+    assert len(encoded) < len(__import__('json').dumps({k: v for k, v in sample.items() if k != 'blob'}))
+
+    for bad in (b'\x81\xa1a', b'\xc1', b'\x01\x02'):
+        try:
+            unpackb(bad)
+            assert False, f"{bad!r} should not decode"
+        except DecodeError:
+            pass
+    print("✅ MessagePack codec working")
+
+
+def test_content_negotiation():
+    """MessagePack only when asked for; JSON stays the default"""
+    app = Flask(__name__)
+    payload = {'status': 'success', 'device': {'device_id': 'A'}}
+
+    with app.test_request_context('/', method='POST', data=packb({'temperature': 20.5}),
+                                  headers={'Content-Type': MSGPACK_MIMETYPE, 'Accept': MSGPACK_MIMETYPE}):
+        assert read_payload() == {'temperature': 20.5}
+        response = device_response(payload, compact={'status': 'success'}, status=201)
+        assert response.mimetype == MSGPACK_MIMETYPE and response.status_code == 201
+        assert unpackb(response.get_data()) == {'status': 'success'}
+        assert 'Accept' in response.headers['Vary']
+
+    for accept in (None, '*/*', 'application/json', 'application/json, application/msgpack'):
+        headers = {'Accept': accept} if accept else {}
+        with app.test_request_context('/', method='POST', json={'temperature': 20.5}, headers=headers):
+            assert read_payload() == {'temperature': 20.5}
+            response = device_response(payload, compact={'status': 'success'})
+            assert response.is_json and response.get_json() == payload
+    print("✅ Device content negotiation working")
+
+
+def test_pure_python_fallback_matches():
+    """The built-in codec is used when the msgpack package is missing"""
+    available = device_codec.MSGPACK_AVAILABLE
+    device_codec.MSGPACK_AVAILABLE = False
+    try:
+        assert unpackb(packb({'values': [1.25, -3, 'ok', None]})) == {'values': [1.25, -3, 'ok', None]}
+    finally:
+        device_codec.MSGPACK_AVAILABLE = available
+    print("✅ MessagePack fallback working")
+
+
+def test_hostile_payloads_are_decode_errors():
+    """Deep nesting and non-map bodies are rejected as bad payloads, not server errors"""
+    available = device_codec.MSGPACK_AVAILABLE
+    device_codec.MSGPACK_AVAILABLE = False
+    try:
+        for bad in (b'\x91' * 100000 + b'\x01', b'\x81\x91\x01\x02'):  # deep arrays, unhashable key
+            try:
+                unpackb(bad)
+                assert False, 'expected DecodeError'
+            except DecodeError:
+                pass
+        nested = b'\x91' * (device_codec.MAX_NESTING - 1) + b'\x01'
+        assert unpackb(nested) is not None
+    finally:
+        device_codec.MSGPACK_AVAILABLE = available
+
+    app = Flask(__name__)
+    for data, content_type in ((packb([1, 2]), MSGPACK_MIMETYPE), (b'[1, 2]', 'application/json')):
+        with app.test_request_context('/', method='POST', data=data, headers={'Content-Type': content_type}):
+            try:
+                read_payload()
+                assert False, 'expected DecodeError'
+            except DecodeError:
+                pass
+    with app.test_request_context('/', method='POST'):
+        assert read_payload() is None
+    print("✅ Hostile payload rejection working")
+
+
+if __name__ == "__main__":
+    test_msgpack_round_trip()
+    test_content_negotiation()
+    test_pure_python_fallback_matches()
+    test_hostile_payloads_are_decode_errors()
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+"""
+Fleet Telemetry Test
+Offline tests for heartbeat quantile sketches and per-firmware aggregation
+"""
+
+import os
+import sys
+import random
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import FleetTelemetrySketch
+from testing_utils import make_app
+from fleet_telemetry import FleetTelemetry, QuantileSketch
+
+BASE = 1_700_000_000 - 1_700_000_000 % 3600
+
+
+def test_sketch_accuracy_and_merge():
+    """Quantiles stay within the relative accuracy, also across merged sketches"""
+    rng = random.Random(7)
+    values = [rng.lognormvariate(11, 0.5) for _ in range(20000)]
+    rssi = [-rng.uniform(40, 90) for _ in range(5000)]
+
+    left, right = QuantileSketch(), QuantileSketch()
+    for i, value in enumerate(values):
+        (left if i % 2 else right).add(value)
+    merged = QuantileSketch.from_json(left.to_json()).merge(right)
+    assert merged.count == len(values)
+    ordered = sorted(values)
+    for q in (0.5, 0.95, 0.99):
+        exact = ordered[int(q * (len(ordered) - 1))]
+        assert abs(merged.quantile(q) - exact) / exact <= 0.02
+
+    sketch = QuantileSketch()
+    for value in rssi + [0]:
+        sketch.add(value)
+    ordered = sorted(rssi + [0])
+    assert abs(sketch.quantile(0.5) - ordered[len(ordered) // 2]) <= 1.0
+    assert sketch.quantile(1.0) == 0 and sketch.quantile(0.0) == sketch.min
+    assert len(sketch.negative) < 60
+    print("✅ Quantile sketch accuracy and merging working")
+
+
+def test_per_firmware_aggregation():
+    """Heartbeats are grouped per firmware build and partial sketches merge at query time"""
+    telemetry = FleetTelemetry(interval=300)
+    with make_app().app_context():
+        for i in range(200):
+            ts = BASE + i * 30
+            telemetry.record('1.0.0', 'ESP32_OTA', free_heap=200000 + i, wifi_rssi=-60, uptime=i * 30, ts=ts)
+            # The new build leaks memory
+            telemetry.record('1.1.0', 'ESP32_OTA', free_heap=200000 - i * 500, wifi_rssi=-61, ts=ts)
+            if i == 100:
+                assert telemetry.flush() > 0
+        telemetry.record('1.1.0', 'ESP32_OTA', free_heap='lots', wifi_rssi=None, ts=BASE)
+        telemetry.flush()
+        assert FleetTelemetrySketch.query.filter_by(bucket=BASE + 3000, firmware_version='1.0.0').count() == 6
+
+        groups = telemetry.summary('free_heap', BASE, BASE + 6000)
+        assert [g['firmware_version'] for g in groups] == ['1.1.0', '1.0.0']
+        assert groups[0]['count'] == 200 and groups[1]['count'] == 200
+        assert groups[0]['p50'] < groups[1]['p50'] * 0.8
+        assert groups[0]['min'] == 200000 - 199 * 500
+        assert telemetry.summary('uptime', BASE, BASE + 6000)[0]['firmware_version'] == '1.0.0'
+
+        series = telemetry.timeseries('free_heap', BASE, BASE + 6000, firmware_version='1.1.0', resolution=1800)
+        points = series['1.1.0']
+        assert [p['ts'] for p in points] == [BASE, BASE + 1800, BASE + 3600, BASE + 5400]
+        assert points[0]['p50'] > points[-1]['p50']
+
+        assert telemetry.apply_retention(now=BASE + 30 * 86400 + 3000) > 0
+        assert FleetTelemetrySketch.query.filter(FleetTelemetrySketch.bucket < BASE + 3000).count() == 0
+    print("✅ Fleet telemetry aggregation working")
+
+
+if __name__ == "__main__":
+    test_sketch_accuracy_and_merge()
+    test_per_firmware_aggregation()
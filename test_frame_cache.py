@@ -0,0 +1,111 @@
+#!/usr/bin/env python3
+"""
+Frame Cache Test
+Offline tests for the in-memory LRU of dashboard frames
+"""
+
+import os
+import sys
+import gzip
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from flask import Flask
+from models import Device, ImageProcessor
+from atomic_files import publish_blob, BLOB_DIR
+from frame_cache import FrameCache, frame_variant
+import unified_cms
+
+
+def test_render_populates_and_disk_changes_are_seen():
+    """Rendered frames are served from memory; frames replaced on disk by another process are re-read"""
+    with tempfile.TemporaryDirectory() as folder:
+        cache = FrameCache()
+        device = Device(device_id='esp-1', device_name='Kitchen', occupation='Test')
+        path, data, digest = ImageProcessor.generate_dashboard_frame(device, {}, app_config={'DASHBOARD_FOLDER': folder})
+        fallback = os.path.join(folder, 'esp-1_fallback.bmp')
+        cache.put(path, data, digest)
+        cache.put(fallback, data, digest)
+
+        frame = cache.get(path)
+        assert frame.data is data and frame.digest == digest
+        assert cache.get(fallback).data is data
+        status = cache.get_status()
+        assert (status['frames'], status['bytes'], status['hits'], status['misses']) == (1, len(data), 2, 0)
+
+        # Variants are built once and kept with the frame
+        assert gzip.decompress(cache.get(path, 'gzip').data) == data
+        raw = cache.get(path, 'raw').data
+        assert len(raw) == 800 * 480 // 8 and cache.get(path, 'raw').data is raw
+
+        # Another worker re-renders: the stat signature changes and the new frame is read from disk
+        publish_blob(b'BM new frame', [path, fallback], os.path.join(folder, BLOB_DIR), suffix='.bmp')
+        assert cache.get(path).data == b'BM new frame'
+        assert cache.get(fallback).data == b'BM new frame'
+        status = cache.get_status()
+        assert status['stale'] == 2 and status['frames'] == 2
+        assert cache.get(os.path.join(folder, 'missing.bmp')) is None
+    print("✅ Frame cache hits and disk fallback working")
+
+
+def test_lru_eviction_and_memory_cap():
+    """The least recently used frames go first and memory stays under the cap"""
+    with tempfile.TemporaryDirectory() as folder:
+        cache = FrameCache(max_bytes=3000)
+        paths = []
+        for i in range(4):
+            path = os.path.join(folder, f"esp-{i}_current.bmp")
+            with open(path, 'wb') as frame_file:
+                frame_file.write(bytes([i]) * 1000)
+            paths.append(path)
+        for path in paths[:3]:
+            cache.get(path)
+        cache.get(paths[0])  # esp-1 is now the least recently used
+        cache.get(paths[3])
+
+        status = cache.get_status()
+        assert status['bytes'] <= 3000 and status['frames'] == 3 and status['evictions'] == 1
+        cache.get(paths[0])
+        assert cache.get_status()['hits'] == 2
+        cache.get(paths[1])  # Evicted: read from disk again
+        assert cache.get_status()['misses'] == 5
+
+        disabled = FrameCache(max_bytes=0)
+        assert disabled.get(paths[0]).data == bytes([0]) * 1000
+        assert disabled.get_status()['frames'] == 0
+    print("✅ Frame cache LRU eviction working")
+
+
+def test_gzip_only_when_accepted():
+    """Gzip is served only to clients giving it a non-zero quality"""
+    assert frame_variant(None, 'gzip, deflate') == 'gzip'
+    assert frame_variant('raw', 'gzip') == 'raw'
+    assert frame_variant(None, None) == 'bmp'
+
+    with tempfile.TemporaryDirectory() as folder:
+        path = os.path.join(folder, 'esp-1_current.bmp')
+        with open(path, 'wb') as frame_file:
+            frame_file.write(b'BM' + bytes(1000))
+        app = Flask(__name__)
+        app.add_url_rule('/frame', 'frame', lambda: unified_cms.send_frame(path))
+        previous, unified_cms.frame_cache = unified_cms.frame_cache, FrameCache()
+        try:
+            client = app.test_client()
+            # arduino-esp32 HTTPClient's default header
+            response = client.get('/frame', headers={'Accept-Encoding': 'identity;q=1,chunked;q=0.1,*;q=0'})
+            assert response.content_encoding is None and response.data == b'BM' + bytes(1000)
+            response = client.get('/frame', headers={'Accept-Encoding': 'gzip;q=0'})
+            assert response.content_encoding is None and response.data.startswith(b'BM')
+            response = client.get('/frame', headers={'Accept-Encoding': 'gzip;q=0.5'})
+            assert response.content_encoding == 'gzip'
+            assert gzip.decompress(response.data) == b'BM' + bytes(1000)
+        finally:
+            unified_cms.frame_cache = previous
+    print("✅ Frame encoding negotiation working")
+
+
+if __name__ == "__main__":
+    test_render_populates_and_disk_changes_are_seen()
+    test_lru_eviction_and_memory_cap()
+    test_gzip_only_when_accepted()
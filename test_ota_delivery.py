@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+"""
+OTA Delivery Control Test
+Tests download slot admission, slot tokens and Retry-After estimation
+"""
+
+import os
+import sys
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from ota_delivery import DownloadGovernor
+
+
+def test_slot_tokens_reserve_capacity():
+    """Reserved slots are honoured and walk-ins are refused once full"""
+    governor = DownloadGovernor('test-secret', max_streams=2)
+
+    token_a = governor.issue_slot_token('ESP32_A', 'fw_1')
+    token_b = governor.issue_slot_token('ESP32_B', 'fw_1')
+    assert token_a and token_b
+    assert governor.issue_slot_token('ESP32_C', 'fw_1') is None
+
+    # Both slots are reserved, so a download without a token is refused
+    assert governor.admit('fw_1', '10.0.0.9') is None
+    assert governor.retry_after(1024 * 1024) >= governor.min_retry_after
+
+    lease_a = governor.admit('fw_1', '10.0.0.1', token_a)
+    assert lease_a is not None
+    lease_a.release()
+    lease_a.release()  # Idempotent
+
+    # Token for a different firmware does not redeem the reservation
+    assert governor.admit('fw_2', '10.0.0.2', token_b) is not None
+    print("✅ Slot reservation and admission working")
+
+
+def test_stream_file_releases_lease():
+    """Streaming a byte range yields exactly that range and frees the slot"""
+    governor = DownloadGovernor('test-secret', max_streams=1, subnet_bandwidth=1024 * 1024)
+    payload = os.urandom(100 * 1024)
+
+    with tempfile.NamedTemporaryFile(delete=False) as f:
+        f.write(payload)
+        path = f.name
+
+    try:
+        lease = governor.admit('fw_1', '192.168.1.20')
+        data = b''.join(governor.stream_file(lease, path, start=1000, length=5000))
+        assert data == payload[1000:6000]
+        assert governor.get_status()['active_streams'] == 0
+    finally:
+        os.remove(path)
+    print("✅ Shaped streaming working")
+
+
+def test_recheck_reuses_reservation():
+    """A device polling again before downloading keeps its one reserved slot"""
+    governor = DownloadGovernor('test-secret', max_streams=2)
+
+    tokens = [governor.issue_slot_token('ESP32_A', 'fw_1') for _ in range(8)]
+    assert all(tokens)
+    assert governor.get_status()['reserved_slots'] == 1
+    assert governor.issue_slot_token('ESP32_B', 'fw_1') is not None
+    assert governor.issue_slot_token('ESP32_C', 'fw_1') is None
+
+    # Any of the re-issued tokens redeems the same slot
+    lease = governor.admit('fw_1', '10.0.0.1', tokens[0])
+    assert lease is not None
+    assert governor.get_status()['reserved_slots'] == 1
+    print("✅ Slot reservation reuse working")
+
+
+def test_subnet_buckets_kept_while_streaming():
+    """Evicting idle subnet buckets never resets the limit of a subnet still downloading"""
+    governor = DownloadGovernor('test-secret', max_streams=1, subnet_bandwidth=1024)
+    lease = governor.admit('fw_1', '192.168.1.20')
+    bucket = governor._subnet_bucket(lease.client_ip)
+
+    for i in range(10):
+        governor._subnet_bucket(f"10.0.{i}.1")
+    assert governor._subnet_bucket('192.168.1.99') is bucket
+    assert len(governor._subnet_buckets) <= 4 * governor.max_streams + 1
+    print("✅ Subnet bucket eviction working")
+
+
+if __name__ == "__main__":
+    test_slot_tokens_reserve_capacity()
+    test_stream_file_releases_lease()
+    test_recheck_reuses_reservation()
+    test_subnet_buckets_kept_while_streaming()
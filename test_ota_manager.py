@@ -0,0 +1,348 @@
+#!/usr/bin/env python3
+"""
+OTA Manager Test
+Offline tests for firmware registry handling and update decisions
+"""
+
+import io
+import json
+import os
+import sys
+import time
+import hashlib
+import shutil
+import tempfile
+import threading
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from werkzeug.datastructures import FileStorage
+from models import db
+from testing_utils import make_app
+import ota_manager as ota_manager_module
+from ota_manager import OTAManager
+from ota_stats import DownloadCounterStore
+from registry_watcher import RegistryWatcher
+
+
+def make_manager():
+    """OTAManager backed by a throwaway upload folder"""
+    folder = tempfile.mkdtemp(prefix='ota_test_')
+    return OTAManager(upload_folder=folder), folder
+
+
+def upload(manager, payload, device_type='ESP32_PersonalCMS'):
+    file = FileStorage(stream=io.BytesIO(payload), filename='firmware.bin')
+    return manager.upload_firmware(file, device_type, 'test build')
+
+
+def use_compiled_folder(manager, folder):
+    """Point the manager's compiled firmware registry into the test folder"""
+    compiled_folder = os.path.join(folder, 'firmwares')
+    os.makedirs(compiled_folder)
+    manager.compiled_firmware_folder = compiled_folder
+    manager.compiled_metadata_file = os.path.join(compiled_folder, 'firmware_registry.json')
+    return compiled_folder
+
+
+def publish_compiled(manager, builds):
+    """Write a compiled firmware registry with {name: version} builds"""
+    with open(manager.compiled_metadata_file, 'w') as f:
+        json.dump({name: {
+            'filename': f'{name}.bin', 'version': version, 'compatible_devices': ['ESP32_OTA_Base'],
+            'description': 'compiled', 'size': 1024, 'build_date': '2030-01-01T00:00:00'
+        } for name, version in builds.items()}, f)
+
+
+def test_update_decisions_are_cached_per_generation():
+    """Repeated checks reuse the decision until the registry changes"""
+    manager, folder = make_manager()
+    try:
+        with make_app().app_context():
+            assert manager.check_update_for_device('ESP32_A', '1.0.0')['update_available'] is False
+
+            result = upload(manager, b'\xe9' + os.urandom(2048))
+            assert result['success']
+
+            first = manager.check_update_for_device('ESP32_A', '1.0.0')
+            first['firmware_url'] = 'mutated by caller'
+            second = manager.check_update_for_device('ESP32_B', '1.0.0')
+            assert second['update_available'] is True
+            assert second['firmware_url'].startswith('/api/ota/download/')
+
+            generation = manager.registry_generation
+            manager.delete_firmware(result['firmware_key'])
+            assert manager.registry_generation > generation
+            assert manager.check_update_for_device('ESP32_A', '1.0.0')['update_available'] is False
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Update decision cache working")
+
+
+def test_forced_update_lifecycle():
+    """Forced updates are shared through the database and delivered exactly once"""
+    manager, folder = make_manager()
+    other_worker, other_folder = make_manager()
+    forced = {
+        'update_available': True,
+        'version': '2.4.1',
+        'firmware_url': '/api/ota/download/ESP32_LED_Blink_2.4.1',
+        'target_firmware': 'ESP32_LED_Blink',
+        'update_type': 'forced_cross_firmware'
+    }
+    try:
+        with make_app().app_context():
+            assert manager.set_forced_update('ESP32_A', forced)
+            assert 'ESP32_A' in other_worker.get_forced_updates()
+
+            # Delivered by whichever worker sees the check first, then gone
+            assert other_worker.check_update_for_device('ESP32_A', '1.0.0')['version'] == '2.4.1'
+            assert manager.check_update_for_device('ESP32_A', '1.0.0').get('update_type') != 'forced_cross_firmware'
+
+            assert not manager.acknowledge_forced_update('ESP32_A', '1.0.0')
+            assert manager.acknowledge_forced_update('ESP32_A', '2.4.1')
+            statuses = {entry['device_id']: entry['status'] for entry in manager.forced_updates.get_all()}
+            assert statuses == {'ESP32_A': 'acknowledged'}
+
+            assert manager.set_forced_update('ESP32_B', forced)
+            assert manager.clear_forced_update('ESP32_B')
+            assert not manager.clear_forced_update('ESP32_B')
+    finally:
+        shutil.rmtree(folder)
+        shutil.rmtree(other_folder)
+    print("✅ Forced update queue working")
+
+
+def test_streaming_upload_hashes_and_deduplicates():
+    """Uploads are hashed in one pass and identical binaries share a file"""
+    manager, folder = make_manager()
+    payload = b'\xe9' + os.urandom(3 * 1024 * 1024)
+    try:
+        with make_app().app_context():
+            first = upload(manager, payload, 'ESP32_PersonalCMS')
+            second = upload(manager, payload, 'ESP32_OTA_Base')
+            assert first['success'] and second['success']
+
+            info = first['firmware_info']
+            assert info['file_hash'] == hashlib.sha256(payload).hexdigest()
+            assert info['file_md5'] == hashlib.md5(payload).hexdigest()
+            assert info['file_size'] == len(payload)
+            assert second['firmware_info']['filepath'] == info['filepath']
+            assert not [name for name in os.listdir(manager.firmware_folder) if name.endswith('.part')]
+
+            # The shared file survives until its last entry is deleted
+            manager.delete_firmware(first['firmware_key'])
+            assert os.path.exists(info['filepath'])
+            manager.delete_firmware(second['firmware_key'])
+            assert not os.path.exists(info['filepath'])
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Streaming upload hashing working")
+
+
+class FrozenDatetime(datetime):
+    """Every upload lands in the same second"""
+
+    @classmethod
+    def now(cls, tz=None):
+        return datetime(2030, 1, 1, 12, 0, 0)
+
+
+def test_upload_keeps_shared_files_and_cleans_up():
+    """A same-second upload never overwrites a file another entry shares, and failures leave no temp file"""
+    manager, folder = make_manager()
+    shared_payload = b'\xe9' + os.urandom(4096)
+    ota_manager_module.datetime = FrozenDatetime
+    try:
+        with make_app().app_context():
+            first = upload(manager, shared_payload, 'ESP32_PersonalCMS')
+            second = upload(manager, shared_payload, 'ESP32_OTA_Base')
+            assert second['firmware_info']['filepath'] == first['firmware_info']['filepath']
+
+            third = upload(manager, b'\xe9' + os.urandom(4096), 'ESP32_PersonalCMS')
+            assert third['success'] and third['firmware_key'] == first['firmware_key']
+            assert third['firmware_info']['filepath'] != first['firmware_info']['filepath']
+            with open(first['firmware_info']['filepath'], 'rb') as f:
+                assert hashlib.sha256(f.read()).hexdigest() == second['firmware_info']['file_hash']
+
+            def fail(file_hash):
+                raise OSError("registry unavailable")
+            manager._find_firmware_by_hash = fail
+            assert not upload(manager, b'\xe9' + os.urandom(4096))['success']
+            assert not [name for name in os.listdir(manager.firmware_folder) if name.endswith('.part')]
+    finally:
+        ota_manager_module.datetime = datetime
+        shutil.rmtree(folder)
+    print("✅ Upload file sharing and cleanup working")
+
+
+def test_compiled_firmware_hashed_lazily():
+    """Compiled entries get hashed once and re-hashed only when the file changes"""
+    manager, folder = make_manager()
+    path = os.path.join(use_compiled_folder(manager, folder), 'test.bin')
+    try:
+        with open(path, 'wb') as f:
+            f.write(b'first build')
+        publish_compiled(manager, {'test': '1.0.0'})
+        assert manager.reload_registry()
+
+        assert manager.get_firmware_hashes('compiled_test')[0] == hashlib.sha256(b'first build').hexdigest()
+        assert len(manager._hash_cache) == 1
+
+        with open(path, 'wb') as f:
+            f.write(b'second build!')
+        os.utime(path, (time.time() + 5, time.time() + 5))
+        assert manager.get_firmware_hashes('compiled_test')[1] == hashlib.md5(b'second build!').hexdigest()
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Lazy compiled firmware hashing working")
+
+
+def test_statistics_maintained_incrementally():
+    """Stats follow uploads, downloads and deletes without a registry rescan"""
+    manager, folder = make_manager()
+    try:
+        with make_app().app_context():
+            first = upload(manager, b'\xe9' + os.urandom(1024), 'ESP32_PersonalCMS')
+            assert manager.get_update_statistics()['total_firmware_versions'] == 1
+
+            time.sleep(1)  # Versions are timestamped to the second
+            second = upload(manager, b'\xe9' + os.urandom(1024), 'ESP32_PersonalCMS')
+            third = upload(manager, b'\xe9' + os.urandom(1024), 'ESP32_OTA_Base')
+            manager.record_download(second['firmware_key'])
+            manager.record_download(second['firmware_key'])
+            manager.record_download(third['firmware_key'])
+
+            stats = manager.get_update_statistics()
+            assert stats['total_firmware_versions'] == 3
+            assert stats['total_downloads'] == 3
+            assert stats['device_types']['ESP32_PersonalCMS']['total_downloads'] == 2
+            assert stats['device_types']['ESP32_PersonalCMS']['latest_version']['version'] == second['firmware_info']['version']
+            assert [fw['device_type'] for fw in stats['recent_uploads']][0] == 'ESP32_OTA_Base'
+
+            listed = {fw['key']: fw['download_count'] for fw in manager.list_firmware_versions()}
+            assert listed[second['firmware_key']] == 2
+
+            manager.delete_firmware(second['firmware_key'])
+            stats = manager.get_update_statistics()
+            assert stats['total_downloads'] == 1
+            assert stats['device_types']['ESP32_PersonalCMS']['latest_version']['version'] == first['firmware_info']['version']
+            assert len(stats['recent_uploads']) == 2
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Incremental OTA statistics working")
+
+
+def test_download_counter_across_workers():
+    """Counts come from the stored value, so syncs never double count and racing inserts retry"""
+    with make_app().app_context():
+        worker, other = DownloadCounterStore(), DownloadCounterStore()
+        assert worker.increment('fw_1') == 1
+        assert other.increment('fw_1') == 2  # Picks up the first worker's download with its own
+        assert worker.sync(force=True) == {'fw_1': 1}
+
+        # A sync that already saw this download leaves nothing for the increment to add
+        other.increment('fw_1')
+        worker._counts['fw_1'] = 3
+        assert worker.increment('fw_1') == 1 and worker.get('fw_1') == 4
+        assert worker.sync(force=True) == {}
+
+        # Both workers saw no row and insert: the loser retries as an UPDATE
+        worker.increment('fw_2')
+        execute = db.session.execute
+        calls = []
+
+        def lose_insert_race(statement, *args, **kwargs):
+            if not calls:  # The first UPDATE runs before the other worker's row exists
+                calls.append(statement)
+                return type('Result', (), {'rowcount': 0})()
+            return execute(statement, *args, **kwargs)
+        db.session.execute = lose_insert_race
+        try:
+            assert other.increment('fw_2') == 2
+        finally:
+            db.session.execute = execute
+        assert other.get('fw_2') == 2 and len(calls) == 1
+    print("✅ Download counters across workers working")
+
+
+def test_registry_hot_reload():
+    """Compiled builds published on disk are merged without a restart"""
+    manager, folder = make_manager()
+    use_compiled_folder(manager, folder)
+    watcher = RegistryWatcher(manager)
+
+    try:
+        with make_app().app_context():
+            watcher.start()
+            watcher.stop()
+            assert not watcher.check()
+
+            publish_compiled(manager, {'ota_base_1': '1.1.0'})
+            generation = manager.registry_generation
+            assert watcher.check()
+            assert manager.registry_generation > generation
+            assert manager.check_update_for_device('ESP32_A', '1.0.0')['version'] == '1.1.0'
+
+            # Unchanged entries keep their object
+            entry = manager.firmware_registry['firmware_versions']['compiled_ota_base_1']
+            publish_compiled(manager, {'ota_base_1': '1.1.0', 'ota_base_2': '1.2.0'})
+            os.utime(manager.compiled_metadata_file, (time.time() + 5, time.time() + 5))
+            assert watcher.check()
+            versions = manager.firmware_registry['firmware_versions']
+            assert versions['compiled_ota_base_1'] is entry
+            assert manager.get_update_statistics()['total_firmware_versions'] == 2
+
+            # Our own saves do not write compiled entries back or trigger a reload
+            upload(manager, b'\xe9' + os.urandom(1024))
+            with open(manager.metadata_file) as f:
+                assert not any(fw.get('is_compiled') for fw in json.load(f)['firmware_versions'].values())
+            assert not manager.reload_registry()
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Registry hot reload working")
+
+
+def test_readers_keep_their_snapshot():
+    """Writers publish a new snapshot; a reader's snapshot never changes under it"""
+    manager, folder = make_manager()
+    try:
+        with make_app().app_context():
+            before = manager.snapshot
+            result = upload(manager, b'\xe9' + os.urandom(1024))
+            assert result['firmware_key'] not in before.firmware_versions
+            assert manager.snapshot.generation == before.generation + 1
+            assert result['firmware_key'] in manager.firmware_registry['firmware_versions']
+
+            try:
+                manager.firmware_registry['firmware_versions']['rogue'] = {}
+                assert False, "published registry must be read-only"
+            except TypeError:
+                pass
+
+            # Concurrent uploads each land in the final snapshot
+            payloads = [b'\xe9' + os.urandom(1024) for _ in range(4)]
+            threads = [threading.Thread(target=upload, args=(manager, payload, f'ESP32_T{i}'))
+                       for i, payload in enumerate(payloads)]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            types = {fw['device_type'] for fw in manager.snapshot.firmware_versions.values()}
+            assert {f'ESP32_T{i}' for i in range(4)} <= types
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Registry snapshots working")
+
+
+if __name__ == "__main__":
+    test_update_decisions_are_cached_per_generation()
+    test_forced_update_lifecycle()
+    test_streaming_upload_hashes_and_deduplicates()
+    test_upload_keeps_shared_files_and_cleans_up()
+    test_compiled_firmware_hashed_lazily()
+    test_statistics_maintained_incrementally()
+    test_download_counter_across_workers()
+    test_registry_hot_reload()
+    test_readers_keep_their_snapshot()
@@ -0,0 +1,62 @@
+#!/usr/bin/env python3
+"""
+Poll Policy Test
+Offline tests for the next_poll_seconds hint given to devices
+"""
+
+import os
+import sys
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from poll_policy import PollPolicy
+
+
+def test_interval_jitter_and_schedule():
+    """Hints vary per device, stay stable per device and follow scheduled changes"""
+    policy = PollPolicy(base_interval=60, jitter=0.2, target_rps=0, spread=30)
+    now = time.time()
+    fleet = [f"esp-{i}" for i in range(200)]
+    hints = [policy.next_poll_seconds(device_id, now=now) for device_id in fleet]
+    assert all(48 <= hint <= 73 for hint in hints)
+    assert len(set(hints)) > 15  # Spread out, not lockstep
+    assert policy.next_poll_seconds('esp-7', now=now) == policy.next_poll_seconds('esp-7', now=now)
+
+    # A change due in 10 s brings devices back just after it, spread over 30 s
+    due = [policy.next_poll_seconds(device_id, due_in=10, now=now) for device_id in fleet]
+    assert all(10 <= hint <= 40 for hint in due) and max(due) - min(due) > 20
+    # A change further out than the interval doesn't delay the regular poll
+    assert policy.next_poll_seconds('esp-7', due_in=600, now=now) == hints[7]
+    print("✅ Poll interval jitter and scheduling working")
+
+
+def test_sleep_quiet_hours_and_load():
+    """Sleeping devices, quiet hours and load all stretch the interval"""
+    policy = PollPolicy(base_interval=60, jitter=0, target_rps=10, load_window=10, max_interval=900)
+    now = time.time()
+    assert policy.next_poll_seconds('esp-1', sleep_mode=True, now=now) == 240
+    assert policy.next_poll_seconds('esp-1', now=now) == 240  # Remembered
+    assert policy.next_poll_seconds('esp-1', sleep_mode=False, now=now) == 60
+
+    # 400 requests in the window = 40/s against a target of 10/s
+    for i in range(400):
+        policy.record_request(now - i % 10)
+    assert policy.load_factor(now) > 3.9
+    assert policy.next_poll_seconds('esp-2', now=now) >= 234
+    assert policy.load_factor(now + 60) == 1.0
+
+    local = datetime(2026, 1, 5, 23, 30).timestamp()
+    quiet = PollPolicy(base_interval=60, jitter=0, target_rps=0, quiet_hours=(23, 6), max_interval=900)
+    assert quiet.seconds_to_quiet_end(local) == 6.5 * 3600
+    assert quiet.next_poll_seconds('esp-3', now=local) == 900
+    near_end = datetime(2026, 1, 6, 5, 58).timestamp()
+    assert 120 <= quiet.next_poll_seconds('esp-3', now=near_end) <= 150
+    assert quiet.seconds_to_quiet_end(datetime(2026, 1, 6, 12, 0).timestamp()) is None
+    print("✅ Poll sleep, quiet hours and load handling working")
+
+
+if __name__ == "__main__":
+    test_interval_jitter_and_schedule()
+    test_sleep_quiet_hours_and_load()
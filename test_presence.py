@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+"""
+Presence Tracker Test
+Offline tests for coalesced last_seen writes and fresh reads of unflushed presence
+"""
+
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, Device
+from testing_utils import make_app
+from presence import PresenceTracker
+
+
+def add_device(device_id, last_seen):
+    db.session.add(Device(
+        device_id=device_id,
+        device_name=device_id,
+        occupation='Tester',
+        device_type='ESP32_DevKit_V1',
+        last_seen=last_seen,
+        is_active=False
+    ))
+    db.session.commit()
+
+
+def test_touches_coalesce_into_one_flush():
+    """Repeated touches keep only the latest value and flush in one batch"""
+    tracker = PresenceTracker()
+    old = datetime(2024, 1, 1)
+    with make_app().app_context():
+        add_device('esp-a', old)
+        add_device('esp-b', old)
+        for minute in range(10):
+            tracker.touch('esp-a', old + timedelta(minutes=minute))
+        tracker.touch('esp-b', old + timedelta(hours=1))
+        tracker.touch('esp-missing')
+
+        assert tracker.flush() == 3
+        assert tracker.flush() == 0
+        db.session.expire_all()
+        device = Device.query.filter_by(device_id='esp-a').one()
+        assert device.last_seen == old + timedelta(minutes=9) and device.is_active
+    print("✅ Presence touches coalesced into one flush")
+
+
+def test_reads_see_unflushed_presence():
+    """Loaded devices show pending last_seen without writing it back"""
+    tracker = PresenceTracker()
+    tracker.overlay_reads()
+    old = datetime(2024, 1, 1)
+    seen = datetime(2024, 6, 1, 12, 0)
+    try:
+        with make_app().app_context():
+            add_device('esp-c', old)
+            db.session.expire_all()
+            tracker.touch('esp-c', seen)
+
+            device = Device.query.filter_by(device_id='esp-c').one()
+            assert device.last_seen == seen and device.is_active
+            assert device.to_dict()['last_seen'] == seen.isoformat()
+            assert not db.session.dirty
+
+            # Unrelated changes do not persist the overlay
+            device.nickname = 'kitchen'
+            db.session.commit()
+            stored = db.session.execute(db.select(Device.__table__.c.last_seen)).scalar()
+            assert stored == old
+
+            # An older pending value never hides a newer stored one
+            tracker.touch('esp-c', old - timedelta(days=1))
+            db.session.expire_all()
+            assert Device.query.filter_by(device_id='esp-c').one().last_seen == old
+    finally:
+        tracker.remove_overlay()
+    print("✅ Presence reads see unflushed last_seen")
+
+
+def test_expiry_flips_only_devices_past_deadline():
+    """Devices go inactive once their deadline passes unless seen again"""
+    tracker = PresenceTracker(offline_timeout=300)
+    start = datetime(2024, 1, 1, 12, 0)
+    with make_app().app_context():
+        add_device('esp-stale', start - timedelta(hours=2))
+        add_device('esp-fresh', start - timedelta(minutes=1))
+        add_device('esp-late', start - timedelta(minutes=2))
+        add_device('esp-never', None)
+        db.session.execute(Device.__table__.update().values(is_active=True))
+        db.session.commit()
+
+        # Cold start settles the table and tracks only active devices
+        assert tracker.seed(now=start) == 2
+        active = {d.device_id for d in Device.query.filter_by(is_active=True)}
+        assert active == {'esp-fresh', 'esp-late'}
+
+        assert tracker.expire(now=start + timedelta(minutes=2)) == 0
+        tracker.touch('esp-late', start + timedelta(minutes=2))
+        tracker.flush()
+        assert tracker.expire(now=start + timedelta(minutes=5)) == 1
+        assert not Device.query.filter_by(device_id='esp-fresh').one().is_active
+        assert Device.query.filter_by(device_id='esp-late').one().is_active
+
+        # The late device expires later; a forgotten one is dropped silently
+        tracker.forget('esp-late')
+        assert tracker.expire(now=start + timedelta(hours=1)) == 0
+        assert tracker._heap == [] and tracker._deadlines == {}
+
+        # Seen again after going offline: back online and tracked again
+        tracker.touch('esp-fresh', start + timedelta(hours=1))
+        tracker.flush()
+        assert Device.query.filter_by(device_id='esp-fresh').one().is_active
+        assert tracker.expire(now=start + timedelta(hours=1, minutes=5)) == 1
+    print("✅ Presence expiry flips only expired devices")
+
+
+def test_device_cache_dropped_after_removal_elsewhere():
+    """A device removed by another worker stops existing here once the generation is checked"""
+    app = make_app()
+    worker, other = PresenceTracker(), PresenceTracker()
+    with app.app_context():
+        add_device('esp-1', None)
+        worker.sync_known_devices()
+        assert worker.device_exists('esp-1') and worker.is_known('esp-1')
+
+        # The other worker removes the device in the same transaction as the bump
+        other.bump_generation()
+        db.session.delete(Device.query.filter_by(device_id='esp-1').one())
+        db.session.commit()
+        other.forget('esp-1')
+
+        assert worker.is_known('esp-1')  # Until the flush thread checks the generation
+        assert worker.sync_known_devices() and not worker.sync_known_devices()
+        assert not worker.device_exists('esp-1')
+
+        # A lookup that raced with a cache drop is not cached under the new generation
+        stale = worker.known_generation
+        other.bump_generation()
+        db.session.commit()
+        worker.sync_known_devices()
+        worker.remember('esp-2', stale)
+        assert not worker.is_known('esp-2')
+    print("✅ Presence device cache invalidation working")
+
+
+if __name__ == "__main__":
+    test_touches_coalesce_into_one_flush()
+    test_reads_see_unflushed_presence()
+    test_expiry_flips_only_devices_past_deadline()
+    test_device_cache_dropped_after_removal_elsewhere()
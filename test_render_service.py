@@ -0,0 +1,121 @@
+#!/usr/bin/env python3
+"""
+Render Service Test
+Offline tests for the render worker pool: priority lanes, backpressure and timeouts
+"""
+
+import os
+import sys
+import time
+import tempfile
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from PIL import Image
+from models import Device
+from render_service import (RenderService, RenderQueueFull, RenderTimeout, DeviceSnapshot,
+                            render_dashboard_job, convert_bmp_job, PRIORITY_ADMIN)
+
+
+def test_render_jobs_in_worker_processes():
+    """Dashboards render from a snapshot in a worker process; inline mode gives the same result"""
+    device = Device(device_id='esp-1', device_name='Kitchen', nickname='Fridge', occupation='Chef',
+                    temperature=21.5, humidity=40.0, sensor_last_update=datetime(2026, 1, 5, 8, 30))
+    snapshot = DeviceSnapshot.from_device(device)
+    assert snapshot.nickname == 'Fridge' and snapshot.temperature == 21.5
+    content = {'jokes': {'dad_jokes': [{'title': 'A joke'}]}}
+
+    with tempfile.TemporaryDirectory() as folder:
+        inline = RenderService(workers=0)
+        inline.start()
+        path, data, digest = inline.run(render_dashboard_job, snapshot, content, folder)
+        assert path == os.path.join(folder, 'esp-1_current.bmp') and os.path.exists(path)
+        with open(path, 'rb') as frame:
+            assert frame.read() == data and len(digest) == 64
+        assert inline.get_status()['mode'] == 'inline'
+
+        service = RenderService(workers=1, timeout=30)
+        service.start()
+        try:
+            os.remove(path)
+            assert service.run(render_dashboard_job, snapshot, content, folder)[0] == path
+            with Image.open(path) as img:
+                assert img.mode == '1' and img.size == (800, 480)
+
+            Image.new('RGB', (1024, 768), 'blue').save(os.path.join(folder, 'upload.png'))
+            bmp_path = os.path.join(folder, 'upload.bmp')
+            assert service.run(convert_bmp_job, os.path.join(folder, 'upload.png'), bmp_path, priority=PRIORITY_ADMIN)
+            assert os.path.exists(bmp_path)
+
+            status = service.get_status()
+            assert status['mode'] == 'process' and status['completed'] == 2 and status['failed'] == 0
+        finally:
+            service.stop()
+    print("✅ Render worker processes working")
+
+
+def test_priority_backpressure_and_timeout():
+    """Device jobs overtake admin jobs, full lanes are refused and slow jobs time out"""
+    service = RenderService(workers=1, max_queue=2, timeout=30)
+    service.start()
+    try:
+        service.run(time.monotonic)  # Spawn the worker before timing anything
+        blocker = service.submit(time.sleep, 0.5)
+        time.sleep(0.1)  # The worker is now busy with the blocker
+
+        admin = service.submit(time.monotonic, priority=PRIORITY_ADMIN)
+        try:
+            service.submit(time.monotonic, priority=PRIORITY_ADMIN)
+            assert False, 'expected RenderQueueFull'
+        except RenderQueueFull:
+            pass  # Admin jobs may only use half the queue
+        device = service.submit(time.monotonic)
+        try:
+            service.submit(time.monotonic)
+            assert False, 'expected RenderQueueFull'
+        except RenderQueueFull:
+            pass
+        assert service.get_status()['queued'] == {'device': 1, 'admin': 1}
+
+        blocker.result(5)
+        assert device.result(5) < admin.result(5)  # Queued later, rendered first
+        assert service.get_status()['rejected'] == {'device': 1, 'admin': 1}
+
+        try:
+            service.run(time.sleep, 2, timeout=0.2)
+            assert False, 'expected RenderTimeout'
+        except RenderTimeout:
+            pass
+        assert service.get_status()['timeouts'] == 1
+    finally:
+        service.stop()
+    print("✅ Render priority lanes and backpressure working")
+
+
+def test_hung_job_recycles_pool():
+    """A job stuck in a worker past its timeout gets the pool replaced instead of holding the worker"""
+    service = RenderService(workers=1, timeout=30)
+    service.start()
+    try:
+        service.run(time.monotonic)
+        started = time.monotonic()
+        try:
+            service.run(time.sleep, 600, timeout=0.5)
+            assert False, 'expected RenderTimeout'
+        except RenderTimeout:
+            pass
+        # The only worker was stuck; the next job runs on a fresh pool
+        assert service.run(time.monotonic, timeout=20) > started
+        status = service.get_status()
+        assert status['pool_restarts'] == 1 and status['timeouts'] == 1
+        assert status['running'] == 0 and status['failed'] == 1
+    finally:
+        service.stop()
+    print("✅ Hung render job recovery working")
+
+
+if __name__ == "__main__":
+    test_render_jobs_in_worker_processes()
+    test_priority_backpressure_and_timeout()
+    test_hung_job_recycles_pool()
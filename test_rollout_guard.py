@@ -0,0 +1,168 @@
+#!/usr/bin/env python3
+"""
+Rollout Guard Test
+Offline tests for halting a firmware rollout when device health regresses
+"""
+
+import json
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from testing_utils import make_app
+from ota_manager import OTAManager
+from rollout_guard import RolloutGuard
+
+NOW = 1_800_000_000
+
+
+def make_manager(builds):
+    """OTAManager with compiled {name: (version, build_date)} builds"""
+    folder = tempfile.mkdtemp(prefix='ota_guard_test_')
+    manager = OTAManager(upload_folder=folder)
+    manager.compiled_firmware_folder = os.path.join(folder, 'firmwares')
+    manager.compiled_metadata_file = os.path.join(manager.compiled_firmware_folder, 'firmware_registry.json')
+    os.makedirs(manager.compiled_firmware_folder)
+    with open(manager.compiled_metadata_file, 'w') as f:
+        json.dump({name: {
+            'filename': f'{name}.bin', 'version': version, 'compatible_devices': ['ESP32_OTA_Base'],
+            'description': 'compiled', 'size': 1024, 'build_date': build_date
+        } for name, (version, build_date) in builds.items()}, f)
+    manager.reload_registry()
+    return manager, folder
+
+
+def heartbeats(guard, version, devices, minutes, free_heap, reboot_every=None, prefix='esp'):
+    """Feed one heartbeat per device per minute"""
+    for minute in range(minutes):
+        for i in range(devices):
+            uptime = minute * 60
+            if reboot_every:
+                uptime = (minute % reboot_every) * 60 + 1
+            guard.observe(f'{prefix}-{i}', version, free_heap=free_heap + i * 100, uptime=uptime,
+                          ts=NOW - (minutes - minute) * 60)
+    guard.flush()
+
+
+def test_memory_leak_halts_rollout():
+    """A build whose heap floor drops is halted and the previous build offered again"""
+    manager, folder = make_manager({
+        'v1': ('1.0.0', '2030-01-01T00:00:00'),
+        'v2': ('1.1.0', '2030-02-01T00:00:00')
+    })
+    guard = RolloutGuard(manager, window=1800)
+    try:
+        with make_app().app_context():
+            assert manager.check_update_for_device('esp-x', '1.0.0')['version'] == '1.1.0'
+            heartbeats(guard, '1.0.0', devices=20, minutes=20, free_heap=120000, prefix='old')
+
+            # Too few devices on the new build to judge yet
+            heartbeats(guard, '1.1.0', devices=3, minutes=5, free_heap=40000)
+            report = guard.check(now=NOW)
+            assert not report['judged'] and 'halted' not in report
+
+            heartbeats(guard, '1.1.0', devices=10, minutes=10, free_heap=40000)
+            report = guard.check(now=NOW)
+            assert report['halted'] and 'heap floor' in report['breaches'][0]
+            assert report['baseline']['version'] == '1.0.0'
+            assert 'compiled_v2' in manager.halted_builds
+
+            # Devices on the bad build are offered the previous one
+            decision = manager.check_update_for_device('esp-x', '1.1.0')
+            assert decision['update_available'] and decision['version'] == '1.0.0'
+            listed = {fw['key']: fw['halted'] for fw in manager.list_firmware_versions()}
+            assert listed['compiled_v2']['reason'] and listed['compiled_v1'] is None
+
+            # The halt survives a registry reload and can be lifted
+            manager.reload_registry()
+            assert 'compiled_v2' in manager.halted_builds
+            assert manager.resume_firmware('compiled_v2')
+            assert not manager.resume_firmware('compiled_v2')
+            assert manager.check_update_for_device('esp-x', '1.0.0')['version'] == '1.1.0'
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Rollout halted on heap regression")
+
+
+def test_reboot_loops_and_healthy_builds():
+    """Uptime resets count as reboots; a healthy build keeps rolling out"""
+    manager, folder = make_manager({
+        'v1': ('1.0.0', '2030-01-01T00:00:00'),
+        'v2': ('1.1.0', '2030-02-01T00:00:00')
+    })
+    try:
+        with make_app().app_context():
+            healthy = RolloutGuard(manager)
+            heartbeats(healthy, '1.0.0', devices=10, minutes=20, free_heap=100000, prefix='old')
+            heartbeats(healthy, '1.1.0', devices=10, minutes=20, free_heap=98000)
+            report = healthy.check(now=NOW)
+            assert report['judged'] and report['breaches'] == [] and not manager.halted_builds
+
+        with make_app().app_context():
+            looping = RolloutGuard(manager)
+            heartbeats(looping, '1.0.0', devices=10, minutes=20, free_heap=100000, prefix='old')
+            heartbeats(looping, '1.1.0', devices=10, minutes=20, free_heap=100000, reboot_every=3)
+            health = looping.version_health('1.1.0', now=NOW)
+            assert health['reboots_per_device'] >= 5
+            assert looping.version_health('1.0.0', now=NOW)['reboots'] == 0
+            report = looping.check(now=NOW)
+            assert report['halted'] and 'reboots per device' in report['breaches'][0]
+
+            # Old heartbeats age out of the window
+            assert looping.version_health('1.1.0', now=NOW + 3600)['devices'] == 0
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Reboot loops detected, healthy builds keep rolling out")
+
+
+def test_malformed_metrics_ignored():
+    """Strings, bools and non-finite numbers are dropped instead of failing the heartbeat"""
+    with make_app().app_context():
+        guard = RolloutGuard(None)
+        guard.observe('esp-1', '1.0.0', free_heap=float('inf'), uptime='123', ts=NOW)
+        guard.observe('esp-1', '1.0.0', free_heap=True, uptime='120', ts=NOW + 30)
+        guard.observe('esp-1', '1.0.0', free_heap=50000, uptime=float('nan'), ts=NOW + 60)
+        assert guard.flush() == 3
+        health = guard.version_health('1.0.0', now=NOW + 60)
+        assert health['heartbeats'] == 3 and health['reboots'] == 0 and health['heap_floor'] is not None
+    print("✅ Malformed heartbeat metrics ignored")
+
+
+def test_heartbeats_spread_across_workers():
+    """Workers that each see a slice of every device's heartbeats judge from the shared counts"""
+    manager, folder = make_manager({
+        'v1': ('1.0.0', '2030-01-01T00:00:00'),
+        'v2': ('1.1.0', '2030-02-01T00:00:00')
+    })
+    try:
+        with make_app().app_context():
+            # 8 gthread workers, devices heartbeat every 30 s through any of them
+            workers = [RolloutGuard(manager, flush_interval=10) for _ in range(8)]
+            for tick in range(40):
+                ts = NOW - (40 - tick) * 30
+                for i in range(10):
+                    workers[(tick + i) % 8].observe(f'old-{i}', '1.0.0', free_heap=100000, uptime=tick * 30 + 5, ts=ts)
+                    uptime = (tick % 6) * 30 + 5  # Reboots every 3 minutes
+                    workers[(tick + 3 * i) % 8].observe(f'esp-{i}', '1.1.0', free_heap=100000, uptime=uptime, ts=ts)
+                for worker in workers:
+                    worker.flush()
+
+            report = workers[5].evaluate(now=NOW)
+            baseline, candidate = report['baseline'], report['candidate']
+            assert baseline['devices'] == 10 and baseline['gap_rate'] == 0.0 and baseline['reboots'] == 0
+            assert candidate['gap_rate'] == 0.0
+            assert 5 <= candidate['reboots_per_device'] <= 7
+            assert workers[2].check(now=NOW)['halted'] and 'reboots per device' in report['breaches'][0]
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Rollout health shared across workers")
+
+
+if __name__ == "__main__":
+    test_memory_leak_halts_rollout()
+    test_reboot_loops_and_healthy_builds()
+    test_malformed_metrics_ignored()
+    test_heartbeats_spread_across_workers()
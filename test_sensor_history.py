@@ -0,0 +1,115 @@
+#!/usr/bin/env python3
+"""
+Sensor History Test
+Offline tests for batched sensor inserts, rollups, retention and range queries
+"""
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, SensorReading, SensorRollup
+from testing_utils import make_app
+from sensor_history import SensorHistory, MINUTE, HOUR, DAY
+
+BASE = 1_700_000_000 - 1_700_000_000 % DAY  # A day boundary
+
+
+def test_batched_inserts_and_rollups():
+    """Readings are written in one batch and rolled up into every tier"""
+    history = SensorHistory(retention={0: None, MINUTE: None, HOUR: None})
+    with make_app().app_context():
+        # Two hours of readings every 30 seconds: 20.00, 20.01, ...
+        for i in range(240):
+            history.record(1, temperature=20 + i / 100, humidity=50, motion=i % 4 == 0, ts=BASE + i * 30)
+        history.record(2, temperature=5.555, ts=BASE)
+        assert SensorReading.query.count() == 0
+        assert history.flush() == 241
+        assert SensorReading.query.filter_by(device_pk=1).first().temperature_centi == 2000
+
+        assert history.rollup() == 2
+        minute = history.query(1, BASE, BASE + 10 * MINUTE, resolution=MINUTE)['points']
+        assert minute[0]['count'] == 2
+        assert minute[0]['temperature'] == {'min': 20.0, 'max': 20.01, 'avg': 20.0}
+        assert minute[0]['motion_ratio'] == 0.5
+
+        hourly = history.query(1, BASE, BASE + 2 * HOUR, resolution=HOUR)['points']
+        assert [point['count'] for point in hourly] == [120, 120]
+        assert hourly[1]['temperature']['max'] == 22.39
+        daily = history.query(1, BASE, BASE + DAY, resolution=DAY)['points']
+        assert daily[0]['count'] == 240 and daily[0]['humidity']['avg'] == 50.0
+
+        # A late reading (device buffered it while asleep) updates its old buckets
+        history.record(1, temperature=-10, ts=BASE + 5)
+        history.flush()
+        history.rollup()
+        minute = history.query(1, BASE, BASE + MINUTE - 1, resolution=MINUTE)['points']
+        assert minute[0]['count'] == 3 and minute[0]['temperature']['min'] == -10.0
+        assert history.query(1, BASE, BASE + DAY, resolution=DAY)['points'][0]['count'] == 241
+        assert SensorRollup.query.filter_by(device_pk=2, resolution=DAY).one().temperature_sum == 556
+    print("✅ Sensor batching and rollups working")
+
+
+def test_query_tiers_and_retention():
+    """Range queries pick a tier by span and expired data is removed"""
+    history = SensorHistory()
+    now = int(time.time())
+    assert history.pick_resolution(now - HOUR, now, now=now) == 0
+    assert history.pick_resolution(now - 2 * DAY, now, now=now) == HOUR
+    assert history.pick_resolution(now - 60 * DAY, now, now=now) == DAY
+    assert history.pick_resolution(now - 6 * HOUR, now, max_points=1000, now=now) == MINUTE
+
+    with make_app().app_context():
+        history.record(1, temperature=20, ts=now - 40 * DAY)
+        history.record(1, temperature=21, ts=now - 8 * DAY)
+        history.record(1, temperature=22, ts=now - HOUR)
+        history.flush()
+        history.rollup()
+        history.apply_retention(now=now)
+        assert [row.ts for row in SensorReading.query.all()] == [now - HOUR]
+        assert SensorRollup.query.filter_by(resolution=MINUTE).count() == 2
+        assert SensorRollup.query.filter_by(resolution=HOUR).count() == 3
+
+        raw = history.query(1, now - 2 * HOUR, now)
+        assert raw['resolution'] == 0 and raw['points'][0]['temperature'] == 22.0
+
+        history.forget_device(1)
+        db.session.commit()
+        assert SensorRollup.query.count() == 0
+    print("✅ Sensor query tiers and retention working")
+
+
+def test_batch_validation():
+    """Buffered batches are validated together and timestamped from ts, age or uptime"""
+    history = SensorHistory()
+    now = int(time.time())
+    rows, rejected = history.rows_from_batch(7, [
+        {'ts': now - 600, 'temperature': 19.5, 'humidity': 41},
+        {'age': 300, 'temperature': 20.5},
+        {'uptime': 1000, 'humidity': 45, 'motion_detected': True},
+        {'ts': now + 3600, 'temperature': 20},
+        {'ts': now - 30 * DAY, 'temperature': 20},
+        {'temperature': 'warm'},
+        'not a reading'
+    ], uptime=1060, now=now)
+    assert [row['ts'] for row in rows] == [now - 600, now - 300, now - 60]
+    assert [entry['index'] for entry in rejected] == [3, 4, 5, 6]
+
+    latest = history.latest_values(rows)
+    assert latest['temperature'] == 20.5 and latest['humidity'] == 45.0
+    assert latest['motion_detected'] is True and latest['sleep_mode'] is False
+
+    with make_app().app_context():
+        history.insert_now(rows)
+        db.session.commit()
+        assert SensorReading.query.filter_by(device_pk=7).count() == 3
+        assert history.rollup() == 1
+    print("✅ Sensor batch validation working")
+
+
+if __name__ == "__main__":
+    test_batched_inserts_and_rollups()
+    test_query_tiers_and_retention()
+    test_batch_validation()
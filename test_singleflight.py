@@ -0,0 +1,108 @@
+#!/usr/bin/env python3
+"""
+Single-Flight Test
+Offline tests for coalescing concurrent dashboard renders, conversions and API fetches
+"""
+
+import os
+import sys
+import time
+import asyncio
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from singleflight import SingleFlight, FILE_LOCKS_AVAILABLE
+
+
+def test_concurrent_callers_share_one_call():
+    """Callers arriving while a call runs get its result (or its exception)"""
+    flights = SingleFlight()
+    started = threading.Event()
+    release = threading.Event()
+    runs = []
+
+    def render(device_id):
+        runs.append(device_id)
+        started.set()
+        release.wait(5)
+        return f"{device_id}_current.bmp"
+
+    results = []
+    leader = threading.Thread(target=lambda: results.append(flights.do(('dashboard', 'esp-1'), render, 'esp-1')))
+    leader.start()
+    started.wait(5)
+    followers = [threading.Thread(target=lambda: results.append(flights.do(('dashboard', 'esp-1'), render, 'esp-1')))
+                 for _ in range(5)]
+    for thread in followers:
+        thread.start()
+    while flights.get_status()['operations']['dashboard']['coalesced'] < 5:
+        time.sleep(0.01)
+    assert flights.do(('dashboard', 'esp-2'), lambda: 'other') == 'other'  # Other keys don't wait
+    release.set()
+    for thread in [leader] + followers:
+        thread.join(5)
+
+    assert runs == ['esp-1'] and results == ['esp-1_current.bmp'] * 6
+    stats = flights.get_status()['operations']['dashboard']
+    assert (stats['calls'], stats['executions'], stats['coalesced']) == (7, 2, 5)
+
+    # Once finished, the next call runs again; failures reach every waiter
+    def fail():
+        raise ValueError('conversion failed')
+    for _ in range(2):
+        try:
+            flights.do(('bmp', 'a.bmp'), fail)
+            assert False, 'expected ValueError'
+        except ValueError:
+            pass
+    assert flights.get_status()['operations']['bmp']['errors'] == 2
+    assert flights.get_status()['in_flight'] == 0
+    print("✅ Single-flight coalescing working")
+
+
+def test_cross_process_lock_and_async():
+    """Lock files serialize the same work across processes; async callers share one task"""
+    if FILE_LOCKS_AVAILABLE:
+        with tempfile.TemporaryDirectory() as lock_dir:
+            # A second instance on the same lock directory stands in for another worker
+            worker_a, worker_b = SingleFlight(lock_dir), SingleFlight(lock_dir)
+            inside = threading.Event()
+            order = []
+
+            def slow():
+                inside.set()
+                time.sleep(0.2)
+                order.append('a')
+
+            thread = threading.Thread(target=worker_a.do, args=(('bmp', 'x.bmp'), slow))
+            thread.start()
+            inside.wait(5)
+            worker_b.do(('bmp', 'x.bmp'), order.append, 'b')
+            worker_b.do(('api', 'news', 'tech'), order.append, 'c', cross_process=False)
+            thread.join(5)
+            assert order == ['a', 'b', 'c']
+            assert worker_b.get_status()['operations']['bmp']['lock_waits'] == 1
+
+    flights = SingleFlight()
+    fetches = []
+
+    async def fetch(url):
+        fetches.append(url)
+        await asyncio.sleep(0.05)
+        return [{'title': url}]
+
+    async def main():
+        waiters = [flights.do_async(('api', 'news', 'tech'), fetch, 'https://example.invalid') for _ in range(4)]
+        return await asyncio.gather(*waiters)
+
+    assert asyncio.run(main()) == [[{'title': 'https://example.invalid'}]] * 4
+    assert len(fetches) == 1
+    assert flights.get_status()['operations']['api']['coalesced'] == 3
+    print("✅ Single-flight file locks and async coalescing working")
+
+
+if __name__ == "__main__":
+    test_concurrent_callers_share_one_call()
+    test_cross_process_lock_and_async()
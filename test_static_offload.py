@@ -0,0 +1,64 @@
+#!/usr/bin/env python3
+"""
+Static Offload Test
+Checks the headers handed to the front proxy for each offload mode
+"""
+
+import os
+import sys
+import shutil
+import tempfile
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from flask import Flask
+from static_offload import send_offloaded, send_offloaded_from_directory, firmware_offload_mode, is_proxy_offload
+
+
+def test_offload_modes():
+    """x-accel maps to internal locations, x-sendfile sends the absolute path"""
+    folder = tempfile.mkdtemp(prefix='offload_test_')
+    path = os.path.join(folder, 'fw', 'build 1.bin')
+    os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as f:
+        f.write(b'\xe9' * 1024)
+
+    app = Flask(__name__)
+    config = {'STATIC_OFFLOAD_LOCATIONS': {os.path.join(folder, 'fw'): '/_offload/ota/'}}
+    try:
+        with app.test_request_context('/'):
+            config['STATIC_OFFLOAD_MODE'] = 'x-accel'
+            response = send_offloaded(path, config, download_name='fw.bin', limit_rate=65536)
+            assert response.headers['X-Accel-Redirect'] == '/_offload/ota/build 1.bin'
+            assert response.headers['X-Accel-Limit-Rate'] == '65536'
+            assert response.get_data() == b'' and is_proxy_offload(response)
+
+            config['STATIC_OFFLOAD_MODE'] = 'x-sendfile'
+            response = send_offloaded(path, config)
+            assert response.headers['X-Sendfile'] == os.path.abspath(path) and is_proxy_offload(response)
+
+            config['STATIC_OFFLOAD_MODE'] = 'sendfile'
+            response = send_offloaded(path, config)
+            response.direct_passthrough = False
+            assert len(response.get_data()) == 1024 and not is_proxy_offload(response)
+            response.close()
+
+            assert send_offloaded_from_directory(folder, '../etc/passwd', config) is None
+    finally:
+        shutil.rmtree(folder)
+    print("✅ Static offload headers working")
+
+
+def test_firmware_offload_keeps_shaping():
+    """Firmware only leaves Python in a mode that keeps the bandwidth limits"""
+    limited = {'OTA_GLOBAL_BANDWIDTH_BPS': 4 * 1024 * 1024, 'OTA_SUBNET_BANDWIDTH_BPS': 0}
+    for mode, expected in (('x-accel', 'x-accel'), ('x-sendfile', 'none'), ('sendfile', 'none'), ('none', 'none')):
+        assert firmware_offload_mode({**limited, 'STATIC_OFFLOAD_MODE': mode}) == expected
+    unlimited = {'OTA_GLOBAL_BANDWIDTH_BPS': 0, 'OTA_SUBNET_BANDWIDTH_BPS': 0, 'STATIC_OFFLOAD_MODE': 'x-sendfile'}
+    assert firmware_offload_mode(unlimited) == 'x-sendfile'
+    print("✅ Firmware offload shaping guard working")
+
+
+if __name__ == "__main__":
+    test_offload_modes()
+    test_firmware_offload_keeps_shaping()
@@ -0,0 +1,170 @@
+#!/usr/bin/env python3
+"""
+UDP Ingest Test
+Offline tests for signed heartbeat/sensor datagrams
+"""
+
+import os
+import sys
+import time
+import socket
+
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+from models import db, Device, DeviceIngestKey, SensorReading
+import testing_utils
+from presence import PresenceTracker
+from sensor_history import SensorHistory
+from fleet_telemetry import FleetTelemetry
+from poll_policy import PollPolicy
+from device_codec import unpackb
+from udp_ingest import (UdpIngest, encode_datagram, decode_datagram, KIND_HEARTBEAT, KIND_SENSOR,
+                        KIND_ACK, FLAG_ACK, TAG_SIZE)
+
+
+def make_app():
+    """Shared test app with one registered device"""
+    app = testing_utils.make_app()
+    with app.app_context():
+        db.session.add(Device(device_id='esp-1', device_name='Kitchen', occupation='Test', device_type='ESP32_OTA'))
+        db.session.commit()
+    return app
+
+
+def make_ingest(**kwargs):
+    return UdpIngest(PresenceTracker(), SensorHistory(), fleet_telemetry=FleetTelemetry(),
+                     poll_policy=PollPolicy(target_rps=0), **kwargs)
+
+
+def test_signed_datagrams_feed_pipelines():
+    """Valid datagrams update presence, Device columns, history and telemetry in batches"""
+    ingest = make_ingest(port=1)
+    now = int(time.time())
+    with make_app().app_context():
+        key = bytes.fromhex(ingest.issue_key('esp-1'))
+        db.session.commit()
+
+        heartbeat = encode_datagram(KIND_HEARTBEAT, 'esp-1', key,
+                                    {'version': '2.4.1', 'free_heap': 81234, 'wifi_rssi': -61, 'uptime': 420}, ts=now)
+        assert ingest.handle(heartbeat, now=now) is None
+        sensor = encode_datagram(KIND_SENSOR, 'esp-1', key, {'temperature': 21.5, 'sleep_mode': True},
+                                 ts=now, seq=1, flags=FLAG_ACK)
+        ack = ingest.handle(sensor, now=now)
+
+        kind, _, device_id, _, seq, body, message, tag = decode_datagram(ack)
+        assert kind == KIND_ACK | KIND_SENSOR and device_id == 'esp-1' and seq == 1
+        assert 'next_poll_seconds' in unpackb(bytes(body))
+        assert ingest.presence_tracker.last_seen('esp-1') is not None
+
+        device = Device.query.filter_by(device_id='esp-1').one()
+        assert device.free_heap == 0  # Not written until the batch flush
+        assert ingest.flush() == 1
+        db.session.expire_all()
+        device = Device.query.filter_by(device_id='esp-1').one()
+        assert (device.firmware_version, device.free_heap, device.wifi_rssi) == ('2.4.1', 81234, -61)
+        assert device.temperature == 21.5 and device.sleep_mode is True and device.is_connected
+
+        ingest.sensor_history.flush()
+        assert SensorReading.query.filter_by(device_pk=device.id).count() == 1
+        assert ingest.fleet_telemetry.flush() == 3
+        assert ingest.get_status()['accepted'] == 2
+    print("✅ UDP datagrams feeding presence and readings")
+
+
+def test_rejects_forged_replayed_and_stale():
+    """Bad signatures, replays, stale timestamps and unknown devices are dropped"""
+    ingest = make_ingest(port=1)
+    now = int(time.time())
+    with make_app().app_context():
+        key = bytes.fromhex(ingest.issue_key('esp-1'))
+        db.session.commit()
+
+        good = encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {'uptime': 5}, ts=now, seq=3)
+        forged = good[:-TAG_SIZE] + bytes(TAG_SIZE)
+        assert ingest.handle(forged, now=now) is None
+        ingest.handle(good, now=now)
+        ingest.handle(good, now=now)  # Replayed
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {}, ts=now, seq=2), now=now)  # Older
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {}, ts=now - 3600), now=now)
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-9', key, {}, ts=now), now=now)
+        ingest.handle(b'PC\x01garbage', now=now)
+
+        # Re-registering rotates the key; datagrams signed with the old one stop working
+        new_key = bytes.fromhex(ingest.issue_key('esp-1'))
+        db.session.commit()
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {}, ts=now, seq=9), now=now)
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', new_key, {}, ts=now, seq=9), now=now)
+
+        status = ingest.get_status()
+        assert status['accepted'] == 2
+        assert status['rejections'] == {'bad_signature': 2, 'replay': 2, 'stale': 1,
+                                        'unknown_device': 1, 'malformed': 1}
+    print("✅ UDP forged/replayed datagram rejection working")
+
+
+def test_bad_values_never_block_the_flush():
+    """Mistyped fields are malformed, and a row the database refuses is dropped, not retried forever"""
+    ingest = make_ingest(port=1)
+    now = int(time.time())
+    with make_app().app_context():
+        db.session.add(Device(device_id='esp-2', device_name='Hall', occupation='Test', device_type='ESP32_OTA'))
+        key = bytes.fromhex(ingest.issue_key('esp-1'))
+        db.session.commit()
+
+        for seq, body in enumerate([{'uptime': [1, 2]}, {'free_heap': float('inf')}, {'version': 7},
+                                    {'wifi_rssi': True}]):
+            assert ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, body, ts=now, seq=seq), now=now) is None
+        ingest.handle(encode_datagram(KIND_SENSOR, 'esp-1', key, {'sleep_mode': 'yes'}, ts=now, seq=5), now=now)
+        assert ingest.get_status()['rejections'] == {'malformed': 5}
+        assert ingest.get_status()['pending_devices'] == 0
+
+        # A value that slipped through anyway only costs its own device's update
+        ingest._queue('esp-1', {'uptime_seconds': [1, 2]})
+        ingest._queue('esp-2', {'uptime_seconds': 60})
+        assert ingest.flush() == 1
+        assert ingest.get_status()['pending_devices'] == 0
+        assert Device.query.filter_by(device_id='esp-2').one().uptime_seconds == 60
+
+        # Removed through another worker: the key is gone and the datagram is just an unknown device
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {}, ts=now, seq=9), now=now)
+        DeviceIngestKey.query.filter_by(device_id='esp-1').delete()
+        db.session.commit()
+        ingest.handle(encode_datagram(KIND_HEARTBEAT, 'esp-1', bytes(32), {}, ts=now, seq=10), now=now + 60)
+        assert ingest.get_status()['rejections']['unknown_device'] == 1
+        assert 'esp-1' not in ingest._devices
+    print("✅ UDP ingest bad values rejected")
+
+
+def test_listener_socket():
+    """The listener thread answers acknowledgement requests over a real socket"""
+    probe = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    probe.bind(('127.0.0.1', 0))
+    port = probe.getsockname()[1]
+    probe.close()
+
+    app = make_app()
+    ingest = make_ingest(host='127.0.0.1', port=port, flush_interval=0.2)
+    with app.app_context():
+        key = bytes.fromhex(ingest.issue_key('esp-1'))
+        db.session.commit()
+    assert ingest.start(app)
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(5)
+    try:
+        client.sendto(encode_datagram(KIND_HEARTBEAT, 'esp-1', key, {'free_heap': 4096}, flags=FLAG_ACK),
+                      ('127.0.0.1', port))
+        reply, _ = client.recvfrom(2048)
+        assert decode_datagram(reply)[0] == KIND_ACK | KIND_HEARTBEAT
+    finally:
+        client.close()
+        ingest.stop()
+    with app.app_context():
+        assert Device.query.filter_by(device_id='esp-1').one().free_heap == 4096
+    print("✅ UDP listener working")
+
+
+if __name__ == "__main__":
+    test_signed_datagrams_feed_pipelines()
+    test_rejects_forged_replayed_and_stale()
+    test_bad_values_never_block_the_flush()
+    test_listener_socket()
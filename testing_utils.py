@@ -0,0 +1,23 @@
+"""
+Test Utilities
+Helpers shared by the offline tests
+"""
+
+from flask import Flask
+from sqlalchemy.pool import StaticPool
+
+from models import db
+
+
+def make_app():
+    """Minimal app with an in-memory database shared across threads"""
+    app = Flask(__name__)
+    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite://'
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+        'poolclass': StaticPool,
+        'connect_args': {'check_same_thread': False}
+    }
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+    return app
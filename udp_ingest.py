@@ -0,0 +1,458 @@
+"""
+UDP Telemetry Ingest
+Optional listener for signed heartbeat and sensor datagrams, so battery devices can send
+a reading without a TCP connect or an HTTP round trip and go back to sleep sooner.
+Datagrams feed the same presence, sensor history and fleet telemetry pipelines as the
+HTTP endpoints; Device status columns are written in batches.
+
+Datagram layout (big endian):
+    2  magic b'PC'
+    1  format version (1)
+    1  kind (1 = heartbeat, 2 = sensor data)
+    1  flags (bit 0: acknowledgement requested)
+    1  device_id length n, then n bytes of device_id (UTF-8)
+    4  timestamp (unix seconds)
+    2  sequence number within that second
+    *  body: MessagePack map, same fields as the HTTP heartbeat / sensor-data bodies
+   16  HMAC-SHA256 of everything above, truncated, keyed with the device's ingest key
+
+Acknowledgements use the same layout with kind 0x80 | kind and a body of
+{'next_poll_seconds': n}.
+"""
+
+import hmac
+import math
+import time
+import socket
+import struct
+import secrets
+import hashlib
+import threading
+import logging
+from datetime import datetime
+from sqlalchemy import bindparam, select
+
+from models import db, Device, DeviceIngestKey
+from device_codec import packb, unpackb, DecodeError
+
+logger = logging.getLogger(__name__)
+
+MAGIC = b'PC'
+FORMAT_VERSION = 1
+KIND_HEARTBEAT = 1
+KIND_SENSOR = 2
+KIND_ACK = 0x80
+FLAG_ACK = 0x01
+TAG_SIZE = 16
+MAX_DATAGRAM = 1232  # Fits one IPv6 packet without fragmentation
+
+_HEADER = struct.Struct('>2sBBBB')
+_STAMP = struct.Struct('>IH')
+
+HEARTBEAT_FIELDS = {'version': 'firmware_version', 'uptime': 'uptime_seconds',
+                    'free_heap': 'free_heap', 'wifi_rssi': 'wifi_rssi'}
+SENSOR_FIELDS = ('temperature', 'humidity', 'motion_detected', 'sleep_mode')
+
+
+def _is_number(value):
+    return isinstance(value, (int, float)) and not isinstance(value, bool) and math.isfinite(value)
+
+
+# What each body field must hold before it goes near a Device column
+FIELD_CHECKS = {
+    'version': lambda value: isinstance(value, str) and len(value) <= 50,
+    'uptime': _is_number,
+    'free_heap': _is_number,
+    'wifi_rssi': _is_number,
+    'temperature': _is_number,
+    'humidity': _is_number,
+    'motion_detected': lambda value: isinstance(value, bool),
+    'sleep_mode': lambda value: isinstance(value, bool)
+}
+
+
+class DatagramError(ValueError):
+    """Malformed, unsigned or replayed datagram"""
+
+
+def encode_datagram(kind, device_id, key, body, ts=None, seq=0, flags=0):
+    """
+    Build a signed datagram (used by acknowledgements, tests and simulators)
+
+    Args:
+        key: The device's ingest key (bytes)
+        body: Dict encoded as MessagePack
+    """
+    device = device_id.encode('utf-8')
+    ts = int(ts if ts is not None else time.time())
+    message = (_HEADER.pack(MAGIC, FORMAT_VERSION, kind, flags, len(device)) + device
+               + _STAMP.pack(ts, seq) + packb(body))
+    return message + hmac.new(key, message, hashlib.sha256).digest()[:TAG_SIZE]
+
+
+def decode_datagram(data):
+    """
+    Split a datagram into its fields without verifying the signature
+
+    Returns:
+        tuple: (kind, flags, device_id, ts, seq, body bytes, signed message, tag)
+    """
+    if len(data) < _HEADER.size + _STAMP.size + TAG_SIZE:
+        raise DatagramError("Datagram too short")
+    magic, version, kind, flags, id_length = _HEADER.unpack_from(data)
+    if magic != MAGIC or version != FORMAT_VERSION:
+        raise DatagramError("Not a PersonalCMS datagram")
+    offset = _HEADER.size + id_length
+    if offset + _STAMP.size + TAG_SIZE > len(data):
+        raise DatagramError("Truncated header")
+    try:
+        device_id = data[_HEADER.size:offset].decode('utf-8')
+    except UnicodeDecodeError:
+        raise DatagramError("Invalid device_id")
+    ts, seq = _STAMP.unpack_from(data, offset)
+    body_start = offset + _STAMP.size
+    return kind, flags, device_id, ts, seq, data[body_start:-TAG_SIZE], data[:-TAG_SIZE], data[-TAG_SIZE:]
+
+
+class _DeviceState:
+    """What the listener keeps per device between datagrams"""
+
+    __slots__ = ('key', 'pk', 'device_type', 'firmware_version', 'last_stamp', 'loaded_at')
+
+    def __init__(self, key, pk, device_type, firmware_version, loaded_at):
+        self.key = key
+        self.pk = pk
+        self.device_type = device_type
+        self.firmware_version = firmware_version
+        self.last_stamp = (0, 0)
+        self.loaded_at = loaded_at
+
+
+class UdpIngest:
+    """Signed datagram listener feeding the batched presence and readings writers"""
+
+    def __init__(self, presence_tracker, sensor_history, fleet_telemetry=None, rollout_guard=None,
+                 ota_manager=None, poll_policy=None, host='0.0.0.0', port=0,
+                 flush_interval=2.0, replay_window=300, key_reload_interval=30):
+        self.presence_tracker = presence_tracker
+        self.sensor_history = sensor_history
+        self.fleet_telemetry = fleet_telemetry
+        self.rollout_guard = rollout_guard
+        self.ota_manager = ota_manager
+        self.poll_policy = poll_policy
+        self.host = host
+        self.port = port
+        self.flush_interval = flush_interval
+        self.replay_window = replay_window
+        self.key_reload_interval = key_reload_interval
+        self._devices = {}  # device_id -> _DeviceState
+        self._unknown = {}  # device_id -> when a lookup last found no key
+        self._pending = {}  # device_id -> Device column values (latest wins)
+        self._acknowledge = set()  # Devices whose reported version may complete a forced update
+        self._stats = {'accepted': 0, 'rejected': 0, 'acks': 0}
+        self._rejections = {}  # reason -> count
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._socket = None
+
+    @classmethod
+    def from_config(cls, config, **services):
+        return cls(
+            host=config.get('UDP_INGEST_HOST', '0.0.0.0'),
+            port=config.get('UDP_INGEST_PORT', 0),
+            flush_interval=config.get('UDP_INGEST_FLUSH_SECONDS', 2.0),
+            replay_window=config.get('UDP_INGEST_REPLAY_WINDOW_SECONDS', 300),
+            **services
+        )
+
+    @property
+    def enabled(self):
+        return bool(self.port)
+
+    def issue_key(self, device_id):
+        """
+        Create (or replace) a device's ingest key; the caller commits
+
+        Returns:
+            str: The key as hex, for the registration response
+        """
+        secret = secrets.token_hex(32)
+        row = DeviceIngestKey.query.filter_by(device_id=device_id).first()
+        if row:
+            row.secret = secret
+            row.created_at = datetime.utcnow()
+        else:
+            db.session.add(DeviceIngestKey(device_id=device_id, secret=secret))
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._unknown.pop(device_id, None)
+        return secret
+
+    def forget(self, device_id):
+        """Drop a removed device's key; the caller commits"""
+        DeviceIngestKey.query.filter_by(device_id=device_id).delete()
+        with self._lock:
+            self._devices.pop(device_id, None)
+            self._pending.pop(device_id, None)
+
+    def _load_device(self, device_id, now):
+        row = db.session.execute(
+            select(DeviceIngestKey.secret, Device.id, Device.device_type, Device.firmware_version)
+            .join(Device, Device.device_id == DeviceIngestKey.device_id)
+            .where(DeviceIngestKey.device_id == device_id)
+        ).first()
+        db.session.rollback()  # End the read transaction; the listener holds no connection
+        if row is None:
+            return None
+        return _DeviceState(bytes.fromhex(row[0]), row[1], row[2], row[3], now)
+
+    def _device_state(self, device_id, now, refresh=False):
+        state = self._devices.get(device_id)
+        if state is not None and not refresh:
+            return state
+        if state is not None and now - state.loaded_at < self.key_reload_interval:
+            return state  # Recently reloaded; a bad signature is just bad
+        if state is None and now - self._unknown.get(device_id, float('-inf')) < self.key_reload_interval:
+            return None  # Don't let unknown senders cost a query per datagram
+        loaded = self._load_device(device_id, now)
+        if loaded is None:
+            if len(self._unknown) > 10000:
+                self._unknown.clear()
+            self._unknown[device_id] = now
+            return None
+        if state is not None:
+            loaded.last_stamp = state.last_stamp
+        self._devices[device_id] = loaded
+        return loaded
+
+    def _reject(self, reason):
+        self._stats['rejected'] += 1
+        self._rejections[reason] = self._rejections.get(reason, 0) + 1
+        return None
+
+    def handle(self, data, now=None):
+        """
+        Verify and apply one datagram (needs an app context for key lookups)
+
+        Returns:
+            bytes: Acknowledgement to send back, or None
+        """
+        now = now if now is not None else time.time()
+        try:
+            kind, flags, device_id, ts, seq, body, message, tag = decode_datagram(data)
+        except DatagramError:
+            return self._reject('malformed')
+        if kind not in (KIND_HEARTBEAT, KIND_SENSOR):
+            return self._reject('unknown_kind')
+        if abs(now - ts) > self.replay_window:
+            return self._reject('stale')
+
+        state = self._device_state(device_id, now)
+        if state is None:
+            return self._reject('unknown_device')
+        if not hmac.compare_digest(hmac.new(state.key, message, hashlib.sha256).digest()[:TAG_SIZE], tag):
+            # The device may have re-registered through another worker
+            state = self._device_state(device_id, now, refresh=True)
+            if state is None:
+                # The key was deleted, e.g. the device was removed through another worker
+                with self._lock:
+                    self._devices.pop(device_id, None)
+                return self._reject('unknown_device')
+            if not hmac.compare_digest(hmac.new(state.key, message, hashlib.sha256).digest()[:TAG_SIZE], tag):
+                return self._reject('bad_signature')
+        if (ts, seq) <= state.last_stamp:
+            return self._reject('replay')
+
+        try:
+            payload = unpackb(bytes(body)) if body else {}
+        except DecodeError:
+            return self._reject('malformed')
+        if not isinstance(payload, dict):
+            return self._reject('malformed')
+        fields = HEARTBEAT_FIELDS if kind == KIND_HEARTBEAT else SENSOR_FIELDS
+        if not all(FIELD_CHECKS[field](payload[field]) for field in fields if field in payload):
+            return self._reject('malformed')
+        state.last_stamp = (ts, seq)
+
+        self.presence_tracker.touch(device_id, datetime.utcfromtimestamp(min(ts, now)))
+        if kind == KIND_HEARTBEAT:
+            self._apply_heartbeat(device_id, state, payload, ts)
+        else:
+            self._apply_sensor(device_id, state, payload, ts)
+        self._stats['accepted'] += 1
+
+        if not flags & FLAG_ACK:
+            return None
+        self._stats['acks'] += 1
+        reply = {}
+        if self.poll_policy is not None:
+            reply['next_poll_seconds'] = self.poll_policy.next_poll_seconds(device_id)
+        return encode_datagram(KIND_ACK | kind, device_id, state.key, reply, ts=now, seq=seq)
+
+    def _queue(self, device_id, values):
+        with self._lock:
+            self._pending.setdefault(device_id, {}).update(values)
+
+    def _apply_heartbeat(self, device_id, state, payload, ts):
+        values = {column: payload[field] for field, column in HEARTBEAT_FIELDS.items() if field in payload}
+        values['is_connected'] = True
+        if 'version' in payload:
+            state.firmware_version = payload['version']
+            with self._lock:
+                self._acknowledge.add(device_id)
+        self._queue(device_id, values)
+
+        if self.rollout_guard is not None:
+            self.rollout_guard.observe(device_id, state.firmware_version, free_heap=payload.get('free_heap'),
+                                       uptime=payload.get('uptime'), ts=ts)
+        if self.fleet_telemetry is not None:
+            self.fleet_telemetry.record(state.firmware_version, state.device_type, free_heap=payload.get('free_heap'),
+                                        wifi_rssi=payload.get('wifi_rssi'), uptime=payload.get('uptime'), ts=ts)
+
+    def _apply_sensor(self, device_id, state, payload, ts):
+        values = {field: payload[field] for field in SENSOR_FIELDS if field in payload}
+        if not values:
+            return
+        values['sensor_last_update'] = datetime.utcfromtimestamp(ts)
+        self._queue(device_id, values)
+        self.sensor_history.record(
+            state.pk,
+            temperature=payload.get('temperature'),
+            humidity=payload.get('humidity'),
+            motion=payload.get('motion_detected'),
+            sleep=payload.get('sleep_mode'),
+            ts=ts
+        )
+
+    def flush(self):
+        """
+        Write the pending Device column values, grouped into executemany batches
+
+        Returns:
+            int: Number of devices updated
+        """
+        with self._lock:
+            if not self._pending:
+                return 0
+            pending, self._pending = self._pending, {}
+            acknowledge, self._acknowledge = self._acknowledge, set()
+
+        table = Device.__table__
+        groups = {}
+        for device_id, values in pending.items():
+            groups.setdefault(tuple(sorted(values)), []).append(device_id)
+        try:
+            for columns, device_ids in groups.items():
+                self._write(table, columns, [{**pending[device_id], 'device_id': device_id}
+                                             for device_id in device_ids])
+            db.session.commit()
+            written = set(pending)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"UDP ingest flush failed, writing devices one by one: {e}")
+            written = self._write_each(table, pending)
+
+        if self.ota_manager is not None:
+            for device_id in acknowledge & written:
+                version = pending[device_id].get('firmware_version')
+                if version:
+                    self.ota_manager.acknowledge_forced_update(device_id, version)
+        return len(written)
+
+    @staticmethod
+    def _write(table, columns, rows):
+        stmt = table.update().where(table.c.device_id == bindparam('_device_id')).values(
+            **{column: bindparam(f'_{column}') for column in columns}
+        )
+        db.session.execute(stmt, [{f'_{column}': value for column, value in row.items()} for row in rows])
+
+    def _write_each(self, table, pending):
+        """
+        Write each device's values in its own transaction after a batch failed
+
+        A row that still fails is dropped rather than kept for the next flush,
+        so one bad row can't block every other device's updates.
+
+        Returns:
+            set: Device IDs whose values were written
+        """
+        written = set()
+        for device_id, values in pending.items():
+            try:
+                self._write(table, sorted(values), [{**values, 'device_id': device_id}])
+                db.session.commit()
+                written.add(device_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"Dropped UDP ingest update for device {device_id}: {e}")
+        return written
+
+    def get_status(self):
+        """Listener state and counters for diagnostics"""
+        with self._lock:
+            pending = len(self._pending)
+        return {
+            'enabled': self.enabled,
+            'listening': self._socket is not None,
+            'address': f"{self.host}:{self.port}" if self.enabled else None,
+            'pending_devices': pending,
+            **self._stats,
+            'rejections': dict(self._rejections)
+        }
+
+    def start(self, app):
+        """
+        Bind the UDP socket and start the listener thread
+
+        Only one process can bind the port; other workers log it and keep serving HTTP.
+        """
+        if not self.enabled or (self._thread and self._thread.is_alive()):
+            return False
+        family = socket.AF_INET6 if ':' in self.host else socket.AF_INET
+        sock = socket.socket(family, socket.SOCK_DGRAM)
+        try:
+            sock.bind((self.host, self.port))
+        except OSError as e:
+            sock.close()
+            logger.info(f"UDP ingest not started in this process ({self.host}:{self.port}: {e})")
+            return False
+        sock.settimeout(min(1.0, self.flush_interval))
+        self._socket = sock
+
+        def run():
+            next_flush = time.monotonic() + self.flush_interval
+            with app.app_context():
+                while not self._stop.is_set():
+                    try:
+                        data, address = sock.recvfrom(MAX_DATAGRAM)
+                    except socket.timeout:
+                        data = None
+                    except OSError:
+                        break
+                    if data:
+                        try:
+                            reply = self.handle(data)
+                            if reply:
+                                sock.sendto(reply, address)
+                        except Exception as e:
+                            db.session.rollback()
+                            logger.error(f"UDP datagram from {address[0]} failed: {e}")
+                    if time.monotonic() >= next_flush:
+                        self.flush()
+                        next_flush = time.monotonic() + self.flush_interval
+                self.flush()
+
+        self._stop.clear()
+        self._thread = threading.Thread(target=run, name='udp-ingest', daemon=True)
+        self._thread.start()
+        logger.info(f"UDP ingest listening on {self.host}:{self.port}")
+        return True
+
+    def stop(self):
+        self._stop.set()
+        if self._thread:
+            self._thread.join(timeout=2)
+        if self._socket:
+            self._socket.close()
+            self._socket = None
@@ -7,17 +7,38 @@ PersonalCMS - Unified Per-Device Content Management System
 - Server-side content override capabilities
 """
 
-from flask import Flask, request, jsonify, render_template, send_file, redirect, url_for, flash, send_from_directory
+from flask import Flask, Response, request, jsonify, render_template, send_file, redirect, url_for, flash, send_from_directory
 from werkzeug.utils import secure_filename
+from werkzeug.security import safe_join
+from sqlalchemy import event
 import json
 import os
 import io
 from datetime import datetime, timedelta
 import uuid
+import time
+import atexit
+import threading
 import logging
 from typing import Dict, List, Optional, Tuple
 import random
 from ota_manager import OTAManager
+from ota_delivery import DownloadGovernor
+from presence import PresenceTracker
+from content_versions import ContentVersionBoard, ALL_DEVICES
+from poll_policy import PollPolicy
+from udp_ingest import UdpIngest
+from singleflight import SingleFlight
+from frame_cache import FrameCache, frame_variant
+from render_service import (RenderService, RenderBusy, DeviceSnapshot, render_dashboard_job, convert_bmp_job,
+                            PRIORITY_DEVICE, PRIORITY_ADMIN)
+from registry_watcher import RegistryWatcher
+from rollout_guard import RolloutGuard
+from device_codec import read_payload, device_response, DecodeError
+import device_api
+from fleet_telemetry import FleetTelemetry, METRICS as TELEMETRY_METRICS
+from sensor_history import SensorHistory, ROLLUP_RESOLUTIONS, MAX_BATCH_READINGS, to_unix
+from static_offload import send_offloaded, send_offloaded_from_directory, get_offload_mode, firmware_offload_mode, is_proxy_offload
 try:
     from jsonpath_ng import parse as jsonpath_parse
     JSONPATH_AVAILABLE = True
@@ -25,7 +46,7 @@ except ImportError:
     JSONPATH_AVAILABLE = False
     jsonpath_parse = None
 
-# Initialize Flask app
+# Initialize Flask app (configured and started by create_app)
 app = Flask(__name__, template_folder='templates')
 app.config['SECRET_KEY'] = 'personalcms-unified-server-2024'
 app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///unified_cms.db'  # Use relative path in project root
@@ -37,19 +58,70 @@ app.config['DEVICE_CONTENT_FOLDER'] = 'data/device_content'
 app.config['OTA_FOLDER'] = 'data/ota'
 app.config['MAX_CONTENT_LENGTH'] = 16 * 1024 * 1024  # 16MB max file size
 app.config['DEVICE_ACTIVE_TIMEOUT_SECONDS'] = 300  # Consider offline if no ping within 5 minutes
+app.config['PRESENCE_FLUSH_INTERVAL_SECONDS'] = 5  # Batched last_seen write-behind interval
+app.config['DEVICE_OFFLINE_TIMEOUT_SECONDS'] = 300  # Devices not seen for this long are marked inactive
+app.config['SENSOR_HISTORY_FLUSH_SECONDS'] = 2  # Batched sensor reading inserts
+app.config['SENSOR_ROLLUP_INTERVAL_SECONDS'] = 60  # Sensor min/max/avg rollup refresh
+app.config['STATIC_OFFLOAD_MODE'] = os.environ.get('PERSONALCMS_STATIC_OFFLOAD', 'none')  # none, sendfile, x-accel, x-sendfile
+app.config['STATIC_OFFLOAD_LOCATIONS'] = {  # Local folder -> nginx internal location (x-accel mode)
+    'data/ota/firmware': '/_offload/ota/',
+    'firmwares': '/_offload/firmwares/',
+    'dashboards': '/_offload/dashboards/',
+    'data/uploads': '/_offload/uploads/'
+}
+app.config['OTA_MAX_CONCURRENT_DOWNLOADS'] = 8  # In-flight firmware streams
+app.config['OTA_GLOBAL_BANDWIDTH_BPS'] = 4 * 1024 * 1024  # Total firmware bandwidth (0 = unlimited)
+app.config['OTA_SUBNET_BANDWIDTH_BPS'] = 1024 * 1024  # Per /24 (or /64) subnet bandwidth (0 = unlimited)
+app.config['OTA_SLOT_TOKEN_TTL_SECONDS'] = 120  # How long a slot reserved by an OTA check is held
+app.config['OTA_FORCED_UPDATE_TTL_SECONDS'] = 24 * 3600  # Undelivered forced updates expire after a day
+app.config['FLEET_TELEMETRY_INTERVAL_SECONDS'] = 300  # Heartbeat metric aggregation interval
+app.config['FLEET_TELEMETRY_FLUSH_SECONDS'] = 30
+app.config['OTA_ROLLOUT_WINDOW_SECONDS'] = 1800  # Heartbeat history compared between firmware builds
+app.config['OTA_ROLLOUT_CHECK_SECONDS'] = 30  # Rollout health check interval (0 = no automatic halts)
+app.config['OTA_ROLLOUT_FLUSH_SECONDS'] = 10  # Heartbeat health write interval (keep below the heartbeat interval)
+app.config['OTA_REGISTRY_POLL_SECONDS'] = 2  # Firmware registry change detection interval (0 = disabled)
+app.config['CONTENT_REFRESH_SECONDS'] = 900  # Rotating content (jokes, news) counts as changed this often (0 = never)
+app.config['CONTENT_LONGPOLL_TIMEOUT_SECONDS'] = 55  # Longest a content-version request is held
+app.config['CONTENT_VERSION_POLL_SECONDS'] = 1  # How quickly other workers' content changes wake waiters
+app.config['POLL_BASE_INTERVAL_SECONDS'] = 60  # next_poll_seconds when no change is scheduled sooner
+app.config['POLL_MIN_INTERVAL_SECONDS'] = 5
+app.config['POLL_MAX_INTERVAL_SECONDS'] = 900
+app.config['POLL_JITTER'] = 0.2  # Per-device spread of the interval (+/-20%)
+app.config['POLL_SLEEP_FACTOR'] = 4.0  # Devices in sleep mode poll this much less often
+app.config['POLL_QUIET_HOURS'] = None  # e.g. (23, 6): devices poll at most every POLL_MAX_INTERVAL_SECONDS
+app.config['POLL_TARGET_RPS'] = 100  # Device requests/second per worker before intervals stretch (0 = ignore load)
+app.config['UDP_INGEST_HOST'] = os.environ.get('PERSONALCMS_UDP_HOST', '0.0.0.0')
+app.config['UDP_INGEST_PORT'] = int(os.environ.get('PERSONALCMS_UDP_PORT', 0))  # Signed heartbeat/sensor datagrams (0 = disabled)
+app.config['UDP_INGEST_FLUSH_SECONDS'] = 2  # Batched Device column writes for datagrams
+app.config['UDP_INGEST_REPLAY_WINDOW_SECONDS'] = 300  # Datagram timestamps further from server time are dropped
+app.config['RENDER_WORKERS'] = 2  # Processes for dashboard/BMP rendering (0 = render in the request thread)
+app.config['RENDER_MAX_QUEUE'] = 32  # Render jobs waiting beyond this are refused (admin previews get half)
+app.config['RENDER_TIMEOUT_SECONDS'] = 20
+app.config['FRAME_CACHE_MAX_BYTES'] = 128 * 1024 * 1024  # Encoded frames kept in memory per worker (0 = serve from disk)
+app.config['FRAME_FSYNC'] = 'file'  # Dashboard/BMP writes: 'none', 'file' (data before rename) or 'full' (+ directory)
+app.config['SINGLE_FLIGHT_LOCK_DIR'] = 'data/locks'  # Render/conversion lock files shared by workers (None = per process only)
 
-# Ensure directories exist
-for folder in ['data', 'data/uploads', 'data/generated', 'data/device_content', 'data/ota', 'data/ota/firmware', 'templates', 'static', 'dashboards']:
-    os.makedirs(folder, exist_ok=True)
-
-# Initialize database
+# Initialize database models (bound to the app in create_app)
 from models import db, Device, DeviceContent, UserImage, ContentAPI, ContentSource, DefaultContent, PerDeviceCMS, ImageProcessor
-db.init_app(app)
 
-# Initialize CMS components after database setup
-per_device_cms = PerDeviceCMS()
-image_processor = ImageProcessor()
-ota_manager = OTAManager(app.config['OTA_FOLDER'])
+# Per-worker services, built by create_app() in each process after any fork
+per_device_cms = None
+image_processor = None
+ota_manager = None
+download_governor = None
+presence_tracker = None
+rollout_guard = None
+registry_watcher = None
+sensor_history = None
+fleet_telemetry = None
+content_versions = None
+poll_policy = None
+udp_ingest = None
+single_flight = None
+render_service = None
+frame_cache = None
+_services_pid = None
+_factory_lock = threading.Lock()
 
 # Add Jinja2 filter for JSON parsing
 @app.template_filter('from_json')
@@ -78,20 +150,206 @@ def datetime_filter(date, format='%Y-%m-%d %H:%M'):
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
-# Create all tables
-with app.app_context():
-    db.create_all()
+
+def _enable_sqlite_wal(dbapi_connection, connection_record):
+    """Let worker processes read while another one writes"""
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA busy_timeout=5000')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.close()
+
+
+def create_app(config=None):
+    """
+    Configure the app and start this process's services
+    
+    Each process gets its own OTA manager, CMS components, background writers
+    and database connections, so the app can run under a preforking server.
+    Calling it again in the same process returns the running app; calling it
+    in a forked worker rebuilds the services, because threads, locks and open
+    connections are not safely inherited across fork.
+    
+    Args:
+        config: Config overrides, applied before anything is started
+        
+    Returns:
+        Flask: The configured app
+    """
+    global per_device_cms, image_processor, ota_manager, download_governor, presence_tracker
+    global rollout_guard, registry_watcher, sensor_history, fleet_telemetry, content_versions, poll_policy, udp_ingest, _services_pid
+    global single_flight, render_service, frame_cache
+    
+    with _factory_lock:
+        if _services_pid == os.getpid():
+            return app
+        if config:
+            app.config.update(config)
+        
+        # Ensure directories exist
+        for folder in ['data', 'data/uploads', 'data/generated', 'data/device_content', 'data/ota', 'data/ota/firmware', 'templates', 'static', 'dashboards']:
+            os.makedirs(folder, exist_ok=True)
+        
+        if 'sqlalchemy' not in app.extensions:
+            db.init_app(app)
+            with app.app_context():
+                if db.engine.dialect.name == 'sqlite':
+                    event.listen(db.engine, 'connect', _enable_sqlite_wal)
+        else:
+            # Forked worker: leave the parent's pooled connections to the parent
+            with app.app_context():
+                db.engine.dispose(close=False)
+        
+        if presence_tracker is not None:
+            presence_tracker.remove_overlay()  # Inherited from the parent, with its pending values
+        
+        # Initialize CMS components after database setup
+        single_flight = SingleFlight.from_config(app.config)
+        render_service = RenderService.from_config(app.config)
+        frame_cache = FrameCache.from_config(app.config)
+        per_device_cms = PerDeviceCMS(single_flight)
+        image_processor = ImageProcessor()
+        ota_manager = OTAManager(app.config['OTA_FOLDER'], app.config['OTA_FORCED_UPDATE_TTL_SECONDS'])
+        download_governor = DownloadGovernor.from_config(app.config)
+        presence_tracker = PresenceTracker(app.config['PRESENCE_FLUSH_INTERVAL_SECONDS'], app.config['DEVICE_OFFLINE_TIMEOUT_SECONDS'])
+        rollout_guard = RolloutGuard(ota_manager, app.config['OTA_ROLLOUT_WINDOW_SECONDS'], app.config['OTA_ROLLOUT_CHECK_SECONDS'],
+                                     flush_interval=app.config['OTA_ROLLOUT_FLUSH_SECONDS'])
+        registry_watcher = RegistryWatcher(ota_manager, app.config['OTA_REGISTRY_POLL_SECONDS'])
+        sensor_history = SensorHistory(app.config['SENSOR_HISTORY_FLUSH_SECONDS'], app.config['SENSOR_ROLLUP_INTERVAL_SECONDS'])
+        fleet_telemetry = FleetTelemetry(app.config['FLEET_TELEMETRY_INTERVAL_SECONDS'], app.config['FLEET_TELEMETRY_FLUSH_SECONDS'])
+        content_versions = ContentVersionBoard(app.config['CONTENT_REFRESH_SECONDS'], app.config['CONTENT_VERSION_POLL_SECONDS'])
+        poll_policy = PollPolicy.from_config(app.config)
+        udp_ingest = UdpIngest.from_config(
+            app.config,
+            presence_tracker=presence_tracker,
+            sensor_history=sensor_history,
+            fleet_telemetry=fleet_telemetry,
+            rollout_guard=rollout_guard,
+            ota_manager=ota_manager,
+            poll_policy=poll_policy
+        )
+        
+        # Create all tables
+        with app.app_context():
+            db.create_all()
+        
+        # Start background writers
+        presence_tracker.start(app)
+        presence_tracker.overlay_reads()
+        sensor_history.start(app)
+        fleet_telemetry.start(app)
+        content_versions.start(app)
+        udp_ingest.start(app)  # Only the first process to bind the port listens
+        render_service.start()
+        if app.config['OTA_REGISTRY_POLL_SECONDS']:
+            registry_watcher.start()
+        rollout_guard.start(app)  # Checks only when OTA_ROLLOUT_CHECK_SECONDS is set
+        
+        if firmware_offload_mode(app.config) != get_offload_mode(app.config):
+            logger.warning(f"STATIC_OFFLOAD_MODE '{get_offload_mode(app.config)}' can't apply the OTA bandwidth limits; "
+                           f"firmware downloads are streamed by the server (use x-accel to offload them shaped)")
+        
+        _services_pid = os.getpid()
+        logger.info(f"PersonalCMS services started in process {_services_pid}")
+    return app
+
+
+@atexit.register
+def _stop_services():
+    """Write anything still buffered when this process exits"""
+    if _services_pid != os.getpid():
+        return
+    udp_ingest.stop()  # Flushes its pending Device updates
+    presence_tracker.stop(app)
+    sensor_history.stop(app)
+    fleet_telemetry.stop(app)
+    rollout_guard.stop(app)  # Writes its buffered heartbeat health
+    content_versions.stop()
+    registry_watcher.stop()
+    render_service.stop()
+
+def next_poll(device_id, due_in=None, sleep_mode=None):
+    """
+    next_poll_seconds hint for a device response
+    
+    Args:
+        due_in: Seconds until a known change (defaults to the next content refresh)
+        sleep_mode: The device's sleep mode, when the route loaded it
+    """
+    if due_in is None:
+        due_in = content_versions.seconds_to_refresh()
+    return poll_policy.next_poll_seconds(device_id, due_in, sleep_mode)
+
+def render_dashboard(device, content, priority=PRIORITY_DEVICE):
+    """
+    Render a device's dashboard BMP in the render pool, or wait for the render already running for it
+    
+    When the pool is too busy, devices get their previous dashboard if there is one.
+    
+    Raises:
+        RenderBusy: The pool is overloaded and there is no previous dashboard
+    """
+    try:
+        return single_flight.do(('dashboard', device.device_id), _render_and_cache,
+                                DeviceSnapshot.from_device(device), content, priority)
+    except RenderBusy as e:
+        previous = os.path.join(app.config['DASHBOARD_FOLDER'], f"{device.device_id}_current.bmp")
+        if priority != PRIORITY_DEVICE or not os.path.exists(previous):
+            raise
+        logger.warning(f"Keeping the previous dashboard for {device.device_id}: {e}")
+        return previous
+
+def _render_and_cache(snapshot, content, priority):
+    path, data, digest = render_service.run(render_dashboard_job, snapshot, content, app.config['DASHBOARD_FOLDER'],
+                                            app.config['FRAME_FSYNC'], priority=priority)
+    # Both files hold this frame; the serving routes answer from memory from now on
+    frame_cache.put(path, data, digest)
+    frame_cache.put(os.path.join(app.config['DASHBOARD_FOLDER'], f"{snapshot.device_id}_fallback.bmp"), data, digest)
+    return path
+
+def send_frame(filepath, mimetype='image/bmp'):
+    """
+    Serve a dashboard or converted BMP from the frame cache
+    
+    ?format=raw gives the packed 1-bit pixels; clients accepting gzip get the
+    compressed BMP. ETag/If-None-Match and Range requests are honoured.
+    
+    Returns:
+        Response, or None if the file doesn't exist
+    """
+    variant = frame_variant(request.args.get('format'), request.headers.get('Accept-Encoding'))
+    frame = frame_cache.get(filepath, variant) if filepath else None
+    if frame is None:
+        return None
+    response = Response(frame.data, mimetype='application/octet-stream' if variant == 'raw' else mimetype)
+    if variant == 'gzip':
+        response.content_encoding = 'gzip'
+    response.vary.add('Accept-Encoding')
+    response.set_etag(f"{frame.digest[:32]}-{variant}")
+    response.last_modified = frame.mtime
+    response.cache_control.no_cache = True
+    return response.make_conditional(request, accept_ranges=True, complete_length=len(frame.data))
+
+def convert_upload_bmp(original_path, bmp_path):
+    """
+    Bring an upload's BMP version up to date, one conversion per upload at a time
+    
+    Returns:
+        bool: False if the conversion failed
+    """
+    return single_flight.do(('bmp', bmp_path), _convert_if_stale, original_path, bmp_path)
+
+def _convert_if_stale(original_path, bmp_path):
+    # Re-checked under the lock: another worker may have just converted it
+    if os.path.exists(bmp_path) and os.path.getmtime(original_path) <= os.path.getmtime(bmp_path):
+        return True
+    return render_service.run(convert_bmp_job, original_path, bmp_path, (800, 480), app.config['FRAME_FSYNC'])
 
 # Basic homepage route 
 @app.route('/')
 def index():
     """Main dashboard with per-device overview"""
-    from models import refresh_device_activity_statuses
-    # Refresh device is_active flags based on last_seen timeout
-    try:
-        refresh_device_activity_statuses()
-    except Exception:
-        pass
+    # is_active is maintained by the presence tracker's expiry task
     devices = Device.query.order_by(Device.last_seen.desc()).all()
     recent_content = DeviceContent.query.order_by(DeviceContent.created_at.desc()).limit(10).all()
     images = UserImage.query.order_by(UserImage.uploaded_at.desc()).limit(5).all()
@@ -121,59 +379,37 @@ def index():
 def register_device():
     """Register or update a device"""
     try:
-        data = request.get_json(force=True)
+        data = read_payload(force_json=True)
         device_id = data.get('device_id')
-        device_name = data.get('device_name')
-        occupation = data.get('occupation')
-        device_type = data.get('device_type')
-        wifi_ssid = data.get('wifi_ssid')
-        preferences = json.dumps(data.get('preferences', {}))
-        nickname = data.get('nickname')
-
-        if not device_id or not device_name or not occupation or not device_type:
-            return jsonify({'success': False, 'message': 'Missing required fields'}), 400
+        fields = device_api.registration_fields(data)
+        if fields is None:
+            return device_response({'success': False, 'message': 'Missing required fields'}, status=400)
 
         device = Device.query.filter_by(device_id=device_id).first()
-        if device:
-            # Update existing device
-            device.device_name = device_name
-            device.occupation = occupation
-            device.device_type = device_type
-            device.wifi_ssid = wifi_ssid
-            device.preferences = preferences
-            device.nickname = nickname
-            device.last_seen = datetime.utcnow()
-            device.is_connected = True
-            device.is_active = True
-        else:
-            # Create new device
-            device = Device(
-                device_id=device_id,
-                device_name=device_name,
-                occupation=occupation,
-                device_type=device_type,
-                wifi_ssid=wifi_ssid,
-                preferences=preferences,
-                nickname=nickname,
-                last_seen=datetime.utcnow(),
-                is_connected=True,
-                is_active=True
-            )
-            db.session.add(device)
+        new_device = device_api.apply_registration(device, device_id, fields)
+        if new_device is not None:
+            db.session.add(new_device)
         
+        # A fresh UDP signing key on every registration
+        ingest_key = udp_ingest.issue_key(device_id) if udp_ingest.enabled else None
         db.session.commit()
-        logger.info(f"Device registered: {device_id} ({device_name})")
-        return jsonify({'success': True, 'message': 'Device registered successfully', 'device_id': device_id})
+        presence_tracker.touch(device_id)  # Start tracking its offline deadline
+        content_versions.bump(device_id, 'registered')
+        logger.info(f"Device registered: {device_id} ({fields['device_name']})")
+        payload, compact = device_api.registration_response(device_id, next_poll(device_id), ingest_key, udp_ingest.port)
+        return device_response(payload, compact=compact)
     
+    except DecodeError as e:
+        return device_response({'success': False, 'message': f'Invalid payload: {e}'}, status=400)
     except Exception as e:
         logger.error(f"Device registration error: {str(e)}")
-        return jsonify({'success': False, 'message': f'Registration failed: {str(e)}'}), 500
+        return device_response({'success': False, 'message': f'Registration failed: {str(e)}'}, status=500)
 
 @app.route('/api/devices/<device_id>/sensor-data', methods=['POST'])
 def update_sensor_data(device_id):
     """Update sensor data for a specific device"""
     try:
-        data = request.get_json()
+        data = read_payload()
         
         # Enhanced logging for debugging
         logger.info(f"🌡️  Sensor data received for {device_id}")
@@ -181,44 +417,24 @@ def update_sensor_data(device_id):
         
         if not data:
             logger.warning(f"❌ No JSON data provided for {device_id}")
-            return jsonify({'error': 'No JSON data provided'}), 400
+            return device_response({'error': 'No JSON data provided'}, status=400)
         
         # Find the device
         device = Device.query.filter_by(device_id=device_id).first()
         if not device:
             logger.warning(f"❌ Device {device_id} not found")
-            return jsonify({'error': 'Device not found'}), 404
+            return device_response({'error': 'Device not found'}, status=404)
         
         # Log current values before update
         logger.info(f"📊 Current stored values - Temperature: {device.temperature}°C, Humidity: {device.humidity}%")
         
         # Update sensor data
-        updated_fields = []
-        if 'temperature' in data:
-            old_temp = device.temperature
-            device.temperature = data['temperature']
-            updated_fields.append('temperature')
-            logger.info(f"🌡️  Temperature: {old_temp}°C → {device.temperature}°C")
-        if 'humidity' in data:
-            old_humidity = device.humidity
-            device.humidity = data['humidity']
-            updated_fields.append('humidity')
-            logger.info(f"💧 Humidity: {old_humidity}% → {device.humidity}%")
-        if 'motion_detected' in data:
-            device.motion_detected = data['motion_detected']
-            updated_fields.append('motion_detected')
-            logger.info(f"👁️  Motion: {device.motion_detected}")
-        if 'sleep_mode' in data:
-            device.sleep_mode = data['sleep_mode']
-            updated_fields.append('sleep_mode')
-            logger.info(f"💤 Sleep mode: {device.sleep_mode}")
+        updated_fields = device_api.apply_sensor_data(device, data)
+        db.session.commit()
+        presence_tracker.touch(device_id)
         
         if updated_fields:
-            device.sensor_last_update = datetime.utcnow()
-            device.last_seen = datetime.utcnow()
-            device.is_active = True
-            
-        db.session.commit()
+            device_api.record_sensor_reading(sensor_history, device, data)
         logger.info(f"✅ Database committed successfully")
         
         # Verify the data was saved correctly
@@ -227,14 +443,90 @@ def update_sensor_data(device_id):
         
         logger.info(f"Sensor data updated for {device_id}: {updated_fields}")
         
-        return jsonify({
-            'status': 'success',
-            'message': f'Sensor data updated: {", ".join(updated_fields)}',
-            'device': device.to_dict()
-        }), 200
+        # Binary clients only get the status; the device dict is for JSON callers
+        payload, compact = device_api.sensor_response(device, updated_fields,
+                                                      next_poll(device_id, sleep_mode=device.sleep_mode))
+        return device_response(payload, compact=compact)
         
+    except DecodeError as e:
+        return device_response({'error': f'Invalid payload: {e}'}, status=400)
     except Exception as e:
         logger.error(f"Sensor data update failed for {device_id}: {e}")
+        return device_response({'error': 'Internal server error'}, status=500)
+
+@app.route('/api/devices/<device_id>/sensor-data/batch', methods=['POST'])
+def update_sensor_data_batch(device_id):
+    """Store a batch of buffered sensor readings in one transaction"""
+    try:
+        data = read_payload()
+        readings = data.get('readings') if isinstance(data, dict) else None
+        if not isinstance(readings, list) or not readings:
+            return device_response({'error': 'Expected a non-empty "readings" array'}, status=400)
+        if len(readings) > MAX_BATCH_READINGS:
+            return device_response({'error': f'At most {MAX_BATCH_READINGS} readings per batch'}, status=413)
+        
+        device_pk = db.session.query(Device.id).filter_by(device_id=device_id).scalar()
+        if device_pk is None:
+            return device_response({'error': 'Device not found'}, status=404)
+        
+        rows, rejected = sensor_history.rows_from_batch(device_pk, readings, uptime=data.get('uptime'))
+        latest = sensor_history.latest_values(rows) if rows else {}
+        if rows:
+            sensor_history.insert_now(rows)
+            db.session.execute(
+                Device.__table__.update().where(Device.__table__.c.id == device_pk).values(**latest)
+            )
+            db.session.commit()
+        presence_tracker.touch(device_id)
+        
+        logger.info(f"Sensor batch for {device_id}: {len(rows)} stored, {len(rejected)} rejected")
+        return device_response({
+            'accepted': len(rows),
+            'rejected': rejected,
+            'next_poll_seconds': next_poll(device_id, sleep_mode=latest.get('sleep_mode'))
+        })
+        
+    except DecodeError as e:
+        return device_response({'error': f'Invalid payload: {e}'}, status=400)
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Sensor batch failed for {device_id}: {e}")
+        return device_response({'error': 'Internal server error'}, status=500)
+
+@app.route('/api/devices/<device_id>/sensor-history', methods=['GET'])
+def get_sensor_history(device_id):
+    """Sensor history for a device, read from the rollup tier that fits the range"""
+    try:
+        device = Device.query.filter_by(device_id=device_id).first()
+        if not device:
+            return jsonify({'error': 'Device not found'}), 404
+        
+        # start/end accept unix seconds or ISO timestamps; default is the last 24 hours
+        end = to_unix(request.args.get('end'))
+        if end is None:
+            end = int(time.time())
+        start = to_unix(request.args.get('start'))
+        if start is None:
+            start = end - 24 * 3600
+        if start >= end:
+            return jsonify({'error': 'start must be before end'}), 400
+        max_points = min(request.args.get('max_points', 500, type=int), 5000)
+        resolution = request.args.get('resolution', type=int)
+        if resolution is not None and resolution not in (0,) + ROLLUP_RESOLUTIONS:
+            return jsonify({'error': f'resolution must be one of 0, {", ".join(map(str, ROLLUP_RESOLUTIONS))}'}), 400
+        
+        history = sensor_history.query(device.id, start, end, max_points, resolution)
+        return jsonify({
+            'device_id': device_id,
+            'start': start,
+            'end': end,
+            **history
+        })
+        
+    except ValueError as e:
+        return jsonify({'error': f'Invalid time range: {e}'}), 400
+    except Exception as e:
+        logger.error(f"Sensor history query failed for {device_id}: {e}")
         return jsonify({'error': 'Internal server error'}), 500
 
 @app.route('/api/devices/<device_id>/images-sequence', methods=['GET'])
@@ -245,62 +537,55 @@ def get_images_sequence(device_id):
         device = Device.query.filter_by(device_id=device_id).first()
         if not device:
             logger.warning(f"❌ Device not found: {device_id}")
-            return jsonify({'success': False, 'message': 'Device not found'}), 404
+            return device_response({'success': False, 'message': 'Device not found'}, status=404)
         
         logger.info(f"✅ Device found: {device.device_name} ({device_id})")
         
-        # Update last seen
-        device.last_seen = datetime.utcnow()
-        device.is_active = True
-        db.session.commit()
+        # Update last seen (written in the next batched flush)
+        presence_tracker.touch(device_id)
         
         # Generate content for device
         content = per_device_cms.get_content_for_device(device)
         
         # Generate dashboard image
-        dashboard_path = image_processor.generate_dashboard(device, content, app_config=app.config)
+        dashboard_path = render_dashboard(device, content)
         
         # Get assigned user images for this device
-        assigned_images = []
-        images = UserImage.query.all()
+        images = [img for img in UserImage.query.all() if device_api.is_assigned(img, device_id)]
+        
+        logger.info(f"📊 Found {len(images)} assigned images for {device_id}")
         for img in images:
-            assignments = json.loads(img.device_assignments or '[]')
-            if device_id in assignments:
-                assigned_images.append({
-                    'id': img.id,
-                    'filename': img.filename,
-                    'url': f"/uploads/{img.filename}",
-                    'bmp_url': f"/uploads/{img.filename}/bmp",
-                    'file_size': img.file_size
-                })
-        
-        logger.info(f"📊 Found {len(assigned_images)} assigned images for {device_id}")
-        for img in assigned_images:
-            logger.info(f"  - {img['filename']} -> BMP: {img['bmp_url']}")
-        
-        response_data = {
-            'success': True,
-            'message': 'Content generated',
-            'device_id': device_id,
-            'dashboard_url': f"/dashboards/{device_id}_current.bmp",
-            'fallback_url': f"/dashboards/{device_id}_fallback.bmp",
-            'assigned_images': assigned_images,
-            'content_categories': list(content.keys()) if content else []
-        }
+            logger.info(f"  - {img.filename} -> BMP: /uploads/{img.filename}/bmp")
         
-        logger.info(f"📤 ESP32 Response: dashboard={response_data['dashboard_url']}, images={len(assigned_images)}")
-        return jsonify(response_data)
+        response_data, compact = device_api.images_sequence_response(
+            device_id, images, content, content_versions.current_version(device_id),
+            next_poll(device_id, sleep_mode=device.sleep_mode)
+        )
         
+        logger.info(f"📤 ESP32 Response: dashboard={response_data['dashboard_url']}, images={len(images)}")
+        return device_response(response_data, compact=compact)
+        
+    except RenderBusy as e:
+        logger.warning(f"Images sequence for {device_id} refused, renderer busy: {e}")
+        response = device_response({'success': False, 'message': str(e)}, status=503)
+        response.headers['Retry-After'] = str(e.retry_after)
+        return response
     except Exception as e:
         logger.error(f"Images sequence error for {device_id}: {str(e)}")
-        return jsonify({'success': False, 'message': str(e)}), 500
+        return device_response({'success': False, 'message': str(e)}, status=500)
 
 # Dashboard BMP file serving
 @app.route('/dashboards/<filename>')
 def serve_dashboard(filename):
     """Serve generated dashboard BMP files"""
     try:
-        return send_from_directory(app.config['DASHBOARD_FOLDER'], filename)
+        if get_offload_mode(app.config) == 'none':
+            response = send_frame(safe_join(os.path.join(app.root_path, app.config['DASHBOARD_FOLDER']), filename))
+        else:
+            response = send_offloaded_from_directory(app.config['DASHBOARD_FOLDER'], filename, app.config)
+        if response is None:
+            return jsonify({'error': 'Dashboard file not found'}), 404
+        return response
     except Exception as e:
         logger.error(f"Dashboard file serve error: {str(e)}")
         return jsonify({'error': 'Dashboard file not found'}), 404
@@ -337,12 +622,20 @@ def serve_uploaded_image_bmp(filename):
         
         # Convert to BMP if not already exists or if original is newer
         if not os.path.exists(bmp_path) or os.path.getmtime(original_path) > os.path.getmtime(bmp_path):
-            success = ImageProcessor.convert_to_bmp(original_path, bmp_path, size=(800, 480))
+            success = convert_upload_bmp(original_path, bmp_path)
             if not success:
                 return jsonify({'error': 'BMP conversion failed'}), 500
         
-        return send_from_directory(bmp_dir, bmp_filename)
+        if get_offload_mode(app.config) == 'none':
+            response = send_frame(bmp_path)
+            if response is None:
+                return jsonify({'error': 'BMP file not found'}), 404
+            return response
+        return send_offloaded(bmp_path, app.config, mimetype='image/bmp')
         
+    except RenderBusy as e:
+        logger.warning(f"BMP conversion of {filename} refused, renderer busy: {e}")
+        return jsonify({'error': 'Renderer busy'}), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.error(f"BMP image serve error: {str(e)}")
         return jsonify({'error': 'BMP conversion error'}), 500
@@ -358,63 +651,71 @@ def api_device_content(device_id):
         device = Device.query.filter_by(device_id=device_id).first()
         if not device:
             logger.warning(f"Device {device_id} not found, creating new device")
-            device = Device(
-                device_id=device_id,
-                device_name=f"ESP32 Device {device_id}",
-                device_type="ESP32_DevKit_V1",
-                occupation="Auto-registered Device"
-            )
+            device = device_api.auto_registered_device(device_id)
             db.session.add(device)
             db.session.commit()
         
-        # Update last seen
-        device.last_seen = datetime.utcnow()
-        db.session.commit()
+        # Update last seen (written in the next batched flush)
+        presence_tracker.touch(device_id)
         
         # Get device content using the per-device CMS
         content = per_device_cms.get_content_for_device(device)
         
         # Generate dashboard image
-        dashboard_path = image_processor.generate_dashboard(device, content, app_config=app.config)
+        dashboard_path = render_dashboard(device, content)
         
         # Get assigned images
-        images = []
-        user_images = UserImage.query.all()
-        for img in user_images:
-            assignments = json.loads(img.device_assignments or '[]')
-            if device_id in assignments:
-                images.append({
-                    'filename': img.filename,
-                    'bmp_url': f"/uploads/{img.filename}/bmp",
-                    'upload_date': img.upload_date.isoformat() if img.upload_date else None
-                })
+        images = [img for img in UserImage.query.all() if device_api.is_assigned(img, device_id)]
         
         logger.info(f"📊 Content for {device_id}: dashboard + {len(images)} images")
         for img in images:
-            logger.info(f"  - {img['filename']} -> BMP: {img['bmp_url']}")
+            logger.info(f"  - {img.filename} -> BMP: /uploads/{img.filename}/bmp")
         
         # Return JSON response for ESP32
-        response_data = {
-            'device_id': device_id,
-            'timestamp': datetime.utcnow().isoformat(),
-            'dashboard_url': f"/dashboards/{device_id}_current.bmp",
-            'fallback_url': f"/dashboards/{device_id}_fallback.bmp",
-            'images': images,
-            'content': content,
-            'status': 'success'
-        }
+        response_data = device_api.content_response(device_id, images, content,
+                                                     content_versions.current_version(device_id),
+                                                     next_poll(device_id, sleep_mode=device.sleep_mode))
         
         logger.info(f"✅ Content API response prepared for {device_id}")
         return jsonify(response_data)
         
+    except RenderBusy as e:
+        logger.warning(f"Content for {device_id} refused, renderer busy: {e}")
+        return jsonify(device_api.content_error_response(device_id, e, 'busy')), 503, {'Retry-After': str(e.retry_after)}
     except Exception as e:
         logger.error(f"❌ Content API error for {device_id}: {str(e)}")
-        return jsonify({
-            'device_id': device_id,
-            'error': str(e),
-            'status': 'error',
-            'timestamp': datetime.utcnow().isoformat()
-        }), 500
+        return jsonify(device_api.content_error_response(device_id, e)), 500
+
+@app.route('/api/devices/<device_id>/content-version', methods=['GET'])
+def wait_content_version(device_id):
+    """
+    Long-poll for a content change
+    
+    With ?since=<version> the request is held until the device's content version
+    differs or ?timeout= seconds pass (capped by CONTENT_LONGPOLL_TIMEOUT_SECONDS).
+    Without it the current version is returned at once. Held requests each occupy a
+    thread here; large fleets should long-poll through the ASGI device API.
+    """
+    try:
+        if not presence_tracker.device_exists(device_id):
+            return device_response({'error': 'Device not found'}, status=404)
+        presence_tracker.touch(device_id)
+        
+        since = request.args.get('since', type=int)
+        limit = app.config['CONTENT_LONGPOLL_TIMEOUT_SECONDS']
+        timeout = min(max(request.args.get('timeout', limit, type=float), 0), limit)
+        if since is None:
+            version = content_versions.current_version(device_id)
+        else:
+            version = content_versions.wait(device_id, since, timeout)
+        
+        # Long-poll clients reconnect right away; the hint only spreads the reconnects
+        payload, compact = device_api.content_version_response(device_id, version, since, next_poll(device_id, due_in=0))
+        return device_response(payload, compact=compact)
+        
+    except Exception as e:
+        logger.error(f"Content version wait failed for {device_id}: {str(e)}")
+        return device_response({'error': 'Content version check failed'}, status=500)
 
 # ESP32 Diagnostic endpoint
 @app.route('/api/esp32-debug/<device_id>')
@@ -511,6 +812,23 @@ def preview_dashboard(device_id):
         logger.error(f"Dashboard preview error: {str(e)}")
         return jsonify({'error': str(e)}), 500
 
+@app.route('/device/<device_id>/dashboard-preview.bmp')
+def preview_dashboard_bmp(device_id):
+    """Render and show the dashboard BMP exactly as the device will get it"""
+    try:
+        device = Device.query.filter_by(device_id=device_id).first()
+        if not device:
+            return jsonify({'error': 'Device not found'}), 404
+        
+        content = per_device_cms.get_content_for_device(device)
+        dashboard_path = render_dashboard(device, content, priority=PRIORITY_ADMIN)
+        return send_file(os.path.abspath(dashboard_path), mimetype='image/bmp', max_age=0)
+    except RenderBusy as e:
+        return jsonify({'error': f'Renderer busy: {e}'}), 503, {'Retry-After': str(e.retry_after)}
+    except Exception as e:
+        logger.error(f"Dashboard BMP preview error: {str(e)}")
+        return jsonify({'error': str(e)}), 500
+
 @app.route('/content-management')
 def content_management():
     """Content management page"""
@@ -643,6 +961,7 @@ def toggle_content_source():
             db.session.add(content_source)
         
         db.session.commit()
+        content_versions.bump(ALL_DEVICES, f'{category}/{subcategory} source')
         flash(f'Updated {category} -> {subcategory} to use {source_type}', 'success')
         return redirect(url_for('content_sources'))
         
@@ -679,6 +998,7 @@ def assign_device_images():
     try:
         devices = Device.query.all()
         images = UserImage.query.all()
+        before = {image.id: set(json.loads(image.device_assignments or '[]')) for image in images}
         
         for device in devices:
             # Get selected image IDs for this device
@@ -701,6 +1021,12 @@ def assign_device_images():
                 image.device_assignments = json.dumps(current_assignments)
         
         db.session.commit()
+        
+        # Only devices whose image set changed have new content
+        changed = set()
+        for image in images:
+            changed |= before[image.id] ^ set(json.loads(image.device_assignments or '[]'))
+        content_versions.bump(changed, 'image assignment')
         flash('Device image assignments updated successfully!', 'success')
         
     except Exception as e:
@@ -745,9 +1071,15 @@ def api_remove_device(device_id):
         
         logger.info(f"Removed device from {unassigned_images} image assignments")
         
-        # Delete the device
+        # Delete the device and its sensor history
+        sensor_history.forget_device(device.id)
+        content_versions.forget(device_id)
+        udp_ingest.forget(device_id)
+        rollout_guard.forget(device_id)
+        presence_tracker.bump_generation()  # Other workers drop their cached lookup
         db.session.delete(device)
         db.session.commit()
+        presence_tracker.forget(device_id)
         
         logger.info(f"Device removed successfully: {device_id} ({device_name})")
         
@@ -836,6 +1168,7 @@ def api_update_device_preferences(device_id):
         # Update device preferences
         device.preferences = json.dumps(cleaned_prefs)
         db.session.commit()
+        content_versions.bump(device_id, 'preferences')
         
         logger.info(f"Device preferences updated successfully: {device_id} ({device_name})")
         
@@ -878,9 +1211,8 @@ def api_get_device_preferences(device_id):
 def check_ota_update(device_id):
     """Check for OTA updates for a specific device"""
     try:
-        # Get device info to determine type
-        device = Device.query.filter_by(device_id=device_id).first()
-        if not device:
+        # Only existence matters here; positive lookups are cached
+        if not presence_tracker.device_exists(device_id):
             return jsonify({'error': 'Device not found'}), 404
         
         # Get current version from headers
@@ -892,17 +1224,13 @@ def check_ota_update(device_id):
         # Check for updates
         update_info = ota_manager.check_update_for_device(device_id, current_version, device_type)
         
-        # Update device last seen
-        device.last_seen = datetime.utcnow()
-        device.is_active = True
-        db.session.commit()
+        # Update device last seen (written in the next batched flush)
+        presence_tracker.touch(device_id)
         
-        # If update available, provide full URL
+        # If update available, provide full URL and a download slot
         if update_info.get('update_available'):
-            # Fix URL duplication - only add if not already present
-            firmware_url = update_info['firmware_url']
-            if not firmware_url.startswith('http'):
-                update_info['firmware_url'] = request.url_root.rstrip('/') + firmware_url
+            device_api.offer_firmware(update_info, device_id, request.url_root, download_governor)
+        update_info['next_poll_seconds'] = next_poll(device_id, due_in=update_info.get('retry_after'))
         
         logger.info(f"OTA response for {device_id}: {update_info}")
         return jsonify(update_info)
@@ -913,14 +1241,87 @@ def check_ota_update(device_id):
 
 @app.route('/api/ota/download/<firmware_key>')
 def download_firmware(firmware_key):
-    """Download firmware file"""
+    """Download firmware file (slot-admitted and bandwidth-shaped)"""
     try:
-        firmware_path = ota_manager.get_firmware_file(firmware_key)
+        firmware_path = ota_manager.get_firmware_path(firmware_key)
         if not firmware_path or not os.path.exists(firmware_path):
             return jsonify({'error': 'Firmware not found'}), 404
         
-        logger.info(f"Serving firmware download: {firmware_key}")
-        return send_file(firmware_path, as_attachment=True, download_name=f"{firmware_key}.bin")
+        integrity_headers = device_api.firmware_integrity_headers(ota_manager, firmware_key)
+        
+        if request.method == 'HEAD':
+            # Metadata only - no bytes to shape, so skip admission
+            response = send_file(firmware_path, as_attachment=True, download_name=f"{firmware_key}.bin")
+            response.headers.update(integrity_headers)
+            return response
+        
+        file_size = os.path.getsize(firmware_path)
+        requested = device_api.firmware_range(request.range, file_size)
+        if requested is None:
+            response = jsonify({'error': 'Requested range not satisfiable'})
+            response.status_code = 416
+            response.headers['Content-Range'] = f"bytes */{file_size}"
+            return response
+        byte_range, counts = requested
+        
+        lease = download_governor.admit(firmware_key, request.remote_addr or '', request.args.get('slot'))
+        if lease is None:
+            retry_after = download_governor.retry_after(file_size)
+            logger.warning(f"Firmware download refused (at capacity): {firmware_key}, retry in {retry_after}s")
+            response = jsonify({'error': 'Download capacity exhausted', 'retry_after': retry_after})
+            response.status_code = 503
+            response.headers['Retry-After'] = str(retry_after)
+            return response
+        
+        offload_mode = firmware_offload_mode(app.config)
+        if offload_mode != 'none':
+            try:
+                # Accounting stays in Python; the proxy serves the same range
+                if counts:
+                    ota_manager.record_download(firmware_key)
+                
+                per_stream_rate = download_governor.per_stream_rate()
+                response = send_offloaded(firmware_path, app.config, download_name=f"{firmware_key}.bin",
+                                          limit_rate=per_stream_rate)
+                if is_proxy_offload(response):
+                    # The proxy moves (and range-serves) the bytes; hold the slot for the estimated transfer
+                    lease.hold_for(file_size / per_stream_rate if per_stream_rate else 0)
+                else:
+                    # sendfile via wsgi.file_wrapper: the slot is freed when the server closes the response
+                    response.call_on_close(lease.release)
+            except Exception:
+                lease.release()
+                raise
+            
+            response.headers.update(integrity_headers)
+            logger.info(f"Offloaded firmware download ({offload_mode}): {firmware_key}")
+            return response
+        
+        try:
+            start, stop = byte_range if byte_range else (0, file_size)
+            if counts:
+                ota_manager.record_download(firmware_key)
+            
+            response = Response(
+                download_governor.stream_file(lease, firmware_path, start, stop - start),
+                status=206 if byte_range else 200,
+                mimetype='application/octet-stream',
+                direct_passthrough=True
+            )
+        except Exception:
+            lease.release()
+            raise
+        
+        response.call_on_close(lease.release)
+        response.headers['Content-Length'] = str(stop - start)
+        response.headers['Accept-Ranges'] = 'bytes'
+        response.headers.update(integrity_headers)
+        response.headers['Content-Disposition'] = f'attachment; filename={firmware_key}.bin'
+        if byte_range:
+            response.headers['Content-Range'] = f"bytes {start}-{stop - 1}/{file_size}"
+        
+        logger.info(f"Serving firmware download: {firmware_key} ({start}-{stop - 1}/{file_size})")
+        return response
         
     except Exception as e:
         logger.error(f"Firmware download failed for {firmware_key}: {str(e)}")
@@ -971,6 +1372,7 @@ def force_firmware_update(device_id):
             'version': latest_firmware['version'],
             'description': f"Forced update to {target_firmware_type}: {latest_firmware['description']}",
             'firmware_url': request.url_root.rstrip('/') + f"/api/ota/download/{firmware_key}",
+            'firmware_key': firmware_key,
             'file_size': latest_firmware['file_size'],
             'release_date': latest_firmware['upload_date'],
             'update_type': 'forced_cross_firmware',
@@ -982,6 +1384,7 @@ def force_firmware_update(device_id):
         
         if not success:
             return jsonify({'error': 'Failed to set forced update'}), 500
+        content_versions.bump(device_id, 'forced update')
         
         logger.info(f"Forced firmware update set for {device_id}: {target_firmware_type}")
         return jsonify(update_info)
@@ -990,6 +1393,23 @@ def force_firmware_update(device_id):
         logger.error(f"Forced update failed for {device_id}: {str(e)}")
         return jsonify({'error': 'Forced update failed'}), 500
 
+@app.route('/api/ota/force-update/<device_id>', methods=['DELETE'])
+def clear_forced_firmware_update(device_id):
+    """Cancel a forced update that has not been delivered yet"""
+    if ota_manager.clear_forced_update(device_id):
+        content_versions.bump(device_id, 'forced update cleared')
+        return jsonify({'success': True, 'device_id': device_id})
+    return jsonify({'error': 'No pending forced update for device'}), 404
+
+@app.route('/api/ota/forced-updates')
+def list_forced_updates():
+    """List forced updates with their delivery state"""
+    try:
+        return jsonify({'forced_updates': ota_manager.forced_updates.get_all()})
+    except Exception as e:
+        logger.error(f"Failed to list forced updates: {str(e)}")
+        return jsonify({'error': 'Failed to list forced updates'}), 500
+
 @app.route('/api/ota/upload', methods=['POST'])
 def upload_firmware():
     """Upload new firmware file with automatic versioning"""
@@ -1041,6 +1461,59 @@ def delete_firmware(firmware_key):
         logger.error(f"Failed to delete firmware {firmware_key}: {str(e)}")
         return jsonify({'error': 'Delete failed'}), 500
 
+@app.route('/api/ota/rollout')
+def ota_rollout_status():
+    """Health of the firmware build being rolled out compared to the previous build"""
+    try:
+        return jsonify({
+            'evaluation': rollout_guard.evaluate(),
+            'halted_builds': ota_manager.halted_builds,
+            'thresholds': rollout_guard.thresholds
+        })
+    except Exception as e:
+        logger.error(f"Failed to evaluate rollout: {str(e)}")
+        return jsonify({'error': 'Failed to evaluate rollout'}), 500
+
+@app.route('/api/ota/halt/<firmware_key>', methods=['POST'])
+def halt_firmware_rollout(firmware_key):
+    """Stop offering a firmware build (devices get the previous build)"""
+    data = request.get_json(silent=True) or {}
+    if ota_manager.halt_firmware(firmware_key, data.get('reason', 'Halted manually')):
+        return jsonify({'success': True, 'firmware_key': firmware_key})
+    return jsonify({'success': False, 'error': 'Firmware not found or already halted'}), 400
+
+@app.route('/api/ota/resume/<firmware_key>', methods=['POST'])
+def resume_firmware_rollout(firmware_key):
+    """Offer a halted firmware build again"""
+    if ota_manager.resume_firmware(firmware_key):
+        return jsonify({'success': True, 'firmware_key': firmware_key})
+    return jsonify({'success': False, 'error': 'Firmware is not halted'}), 400
+
+@app.route('/api/ota/delivery')
+def ota_delivery_status():
+    """Get firmware download admission and bandwidth status"""
+    return jsonify(download_governor.get_status())
+
+@app.route('/api/render')
+def render_status():
+    """Render pool queue depth per lane and job counters"""
+    return jsonify(render_service.get_status())
+
+@app.route('/api/frames')
+def frame_cache_status():
+    """In-memory frame cache hit rate, size and evictions"""
+    return jsonify(frame_cache.get_status())
+
+@app.route('/api/single-flight')
+def single_flight_status():
+    """Calls coalesced onto an in-flight dashboard render, BMP conversion or API fetch"""
+    return jsonify(single_flight.get_status())
+
+@app.route('/api/ingest/udp')
+def udp_ingest_status():
+    """UDP datagram listener state and accept/reject counters"""
+    return jsonify(udp_ingest.get_status())
+
 @app.route('/api/ota/stats')
 def ota_statistics():
     """Get OTA update statistics"""
@@ -1056,45 +1529,102 @@ def ota_statistics():
 def device_heartbeat(device_id):
     """Receive heartbeat from OTA-enabled devices"""
     try:
-        data = request.get_json()
+        data = read_payload() or {}
         
         device = Device.query.filter_by(device_id=device_id).first()
         if not device:
             # Create device if it doesn't exist (for OTA-enabled devices)
-            device = Device(
-                device_id=device_id,
-                device_name=data.get('device_name', device_id),
-                occupation=data.get('occupation', 'Device User'),  # Provide default occupation
-                device_type=data.get('device_type', 'ESP32_OTA'),
-                last_seen=datetime.utcnow(),
-                is_connected=True,
-                is_active=True
-            )
+            device = device_api.heartbeat_device(device_id, data)
             db.session.add(device)
-        else:
-            # Update existing device
-            device.last_seen = datetime.utcnow()
-            device.is_active = True
-            device.is_connected = True
+        device_api.apply_heartbeat(device, data)
+        presence_tracker.touch(device_id)
+        db.session.commit()
         
-        # Update additional heartbeat data if provided
+        # A reported version may complete a delivered forced update
         if 'version' in data:
-            device.firmware_version = data['version']
-        if 'uptime' in data:
-            device.uptime_seconds = data['uptime']
-        if 'free_heap' in data:
-            device.free_heap = data['free_heap']
-        if 'wifi_rssi' in data:
-            device.wifi_rssi = data['wifi_rssi']
+            ota_manager.acknowledge_forced_update(device_id, data['version'])
         
-        db.session.commit()
+        device_api.observe_heartbeat(device, data, rollout_guard, fleet_telemetry)
         
         logger.info(f"Heartbeat received from {device_id}")
-        return jsonify({'status': 'heartbeat_received', 'timestamp': datetime.utcnow().isoformat()})
+        payload, compact = device_api.heartbeat_response(next_poll(device_id, sleep_mode=device.sleep_mode))
+        return device_response(payload, compact=compact)
         
+    except DecodeError as e:
+        return device_response({'error': f'Invalid payload: {e}'}, status=400)
     except Exception as e:
         logger.error(f"Heartbeat processing failed for {device_id}: {str(e)}")
-        return jsonify({'error': 'Heartbeat processing failed'}), 500
+        return device_response({'error': 'Heartbeat processing failed'}, status=500)
+
+def _telemetry_query_args():
+    """Shared arguments of the fleet telemetry endpoints"""
+    metric = request.args.get('metric', 'free_heap')
+    if metric not in TELEMETRY_METRICS:
+        raise ValueError(f"metric must be one of {', '.join(TELEMETRY_METRICS)}")
+    end = to_unix(request.args.get('end'))
+    if end is None:
+        end = int(time.time())
+    start = to_unix(request.args.get('start'))
+    if start is None:
+        start = end - request.args.get('hours', 24, type=int) * 3600
+    if start >= end:
+        raise ValueError("start must be before end")
+    return {
+        'metric': metric,
+        'start': start,
+        'end': end,
+        'firmware_version': request.args.get('firmware_version'),
+        'device_type': request.args.get('device_type')
+    }
+
+@app.route('/api/telemetry/fleet', methods=['GET'])
+def get_fleet_telemetry():
+    """Heartbeat metric percentiles per firmware version and device type"""
+    try:
+        args = _telemetry_query_args()
+        groups = fleet_telemetry.summary(**args)
+        return jsonify({**args, 'groups': groups})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Fleet telemetry query failed: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/api/telemetry/fleet/timeseries', methods=['GET'])
+def get_fleet_telemetry_timeseries():
+    """Heartbeat metric percentiles over time, one series per firmware version"""
+    try:
+        args = _telemetry_query_args()
+        series = fleet_telemetry.timeseries(resolution=request.args.get('resolution', type=int), **args)
+        return jsonify({**args, 'interval': fleet_telemetry.interval, 'series': series})
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        logger.error(f"Fleet telemetry timeseries failed: {e}")
+        return jsonify({'error': 'Internal server error'}), 500
+
+@app.route('/fleet-telemetry')
+def fleet_telemetry_panel():
+    """Admin panel comparing on-device metrics across firmware builds"""
+    try:
+        hours = request.args.get('hours', 24, type=int)
+        device_type = request.args.get('device_type') or None
+        end = int(time.time())
+        start = end - hours * 3600
+        metrics = {
+            metric: fleet_telemetry.summary(metric, start, end, device_type=device_type)
+            for metric in TELEMETRY_METRICS
+        }
+        device_types = [row[0] for row in db.session.query(Device.device_type).distinct().order_by(Device.device_type)]
+        return render_template('fleet_telemetry.html',
+                             metrics=metrics,
+                             hours=hours,
+                             device_type=device_type,
+                             device_types=device_types)
+    except Exception as e:
+        logger.error(f"Fleet telemetry panel error: {e}")
+        flash(f'Error loading fleet telemetry: {e}', 'error')
+        return redirect(url_for('index'))
 
 @app.route('/device/<device_id>/preferences', methods=['POST'])
 def update_device_preferences(device_id):
@@ -1121,6 +1651,7 @@ def update_device_preferences(device_id):
         # Update device preferences
         device.preferences = json.dumps(preferences)
         db.session.commit()
+        content_versions.bump(device_id, 'preferences')
         
         flash(f'Content preferences updated for {device.nickname or device.device_name}', 'success')
         logger.info(f"Device preferences updated via web: {device_id}")
@@ -1261,5 +1792,7 @@ if __name__ == '__main__':
     print("   ✅ Default + custom content")
     print("   ✅ Server-managed overrides")
     print("🌐 Server starting on http://0.0.0.0:5000/")
-    app.run(host='0.0.0.0', port=5000, debug=True)
+    print("   (development server; use wsgi.py with gunicorn or waitress in production)")
+    # The reloader would start every background service twice
+    create_app().run(host='0.0.0.0', port=5000, debug=True, use_reloader=False)
 
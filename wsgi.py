@@ -0,0 +1,11 @@
+"""
+PersonalCMS WSGI Entry Point
+Production servers import `app` from here:
+
+    gunicorn -c gunicorn.conf.py wsgi:app
+    waitress-serve --threads=16 --port=5000 wsgi:app
+"""
+
+from unified_cms import create_app
+
+app = create_app()